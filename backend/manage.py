@@ -0,0 +1,380 @@
+"""Maintenance commands for the POS backend.
+
+Usage (from the backend directory, with the same .env as the server):
+
+    python manage.py verify-indexes
+    python manage.py recount-categories
+    python manage.py recompute-customer-stats [--customer ID]
+    python manage.py rebuild-ar-ledger
+    python manage.py rebuild-sales-rollups [--from 2026-01-01 --to 2026-03-31]
+    python manage.py bench-serialization [--rows 500]
+    python manage.py bench-dashboard [--days 365 --per-day 200]
+    python manage.py bench-vat [--lines 1000000]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import orjson
+from pydantic import TypeAdapter
+
+import server
+from server import (
+    INDEX_REGISTRY, Document, DocumentItem, DocumentType, Payment, PaymentMethod, Product, Unit, client, db,
+    VAT_LINE_EXPORT_FIELDS, _serialise_rows, dashboard_from_facets, dashboard_pipeline, ensure_indexes,
+    explain_query_shapes, _plan_stages, rebuild_ar_ledger, rebuild_sales_rollups, recompute_all_customer_stats, recompute_customer_stats,
+    recount_category_counts, rollup_date_query, vat_line_pipeline, vat_line_rows, vat_report_from_groups,
+    vat_report_pipeline
+)
+
+
+async def verify_indexes(args) -> int:
+    """Build the registered indexes, then fail if any registered query shape does a COLLSCAN or cannot be verified"""
+    if not args.no_create:
+        await ensure_indexes()
+
+    failures = unverified = 0
+    for result in await explain_query_shapes():
+        status = "COLLSCAN" if result["collscan"] else "UNVERIFIED" if result["unverified"] else "ok"
+        failures += result["collscan"]
+        unverified += result["unverified"] and not result["collscan"]
+        sort = f" sort={result['sort']}" if result["sort"] else ""
+        print(f"[{status:>10}] {result['collection']} {result['filter']}{sort} -> {', '.join(result['stages'])}")
+
+    # Indexes present in the database but not declared in the registry
+    registered = {}
+    for spec in INDEX_REGISTRY:
+        registered.setdefault(spec["collection"], set()).add(tuple(spec["keys"]))
+    for collection, keys in registered.items():
+        info = await db[collection].index_information()
+        for name, index in info.items():
+            if name != "_id_" and tuple(index["key"]) not in keys:
+                print(f"[     extra] {collection}.{name} {index['key']} is not in INDEX_REGISTRY")
+
+    if failures:
+        print(f"{failures} query shape(s) without an index")
+    if unverified:
+        print(f"{unverified} query shape(s) not verified: the collection does not exist, so explain() returns EOF")
+    if not failures and not unverified:
+        print("All registered query shapes use an index")
+    return 1 if failures or unverified else 0
+
+
+async def recount_categories(args) -> int:
+    """Rebuild the stored category product / in-stock counts from the products"""
+    count = await recount_category_counts()
+    print(f"Recounted {count} categories")
+    return 0
+
+
+async def recompute_customer_stats_command(args) -> int:
+    """Rebuild customer_stats from the documents (all customers, or one)"""
+    if args.customer:
+        stats = await recompute_customer_stats(args.customer)
+        print(f"{args.customer}: {stats['documents_count']} documents, spent {stats['spent']:.2f}, unpaid {stats['unpaid']:.2f}")
+    else:
+        print(f"Recomputed stats for {await recompute_all_customer_stats()} customers")
+    return 0
+
+
+async def rebuild_ar_ledger_command(args) -> int:
+    """Replay the documents into a fresh receivables ledger and reset customer balances"""
+    print(f"Posted {await rebuild_ar_ledger()} ledger entries")
+    return 0
+
+
+async def rebuild_sales_rollups_command(args) -> int:
+    """Recompute the sales_daily rows of a date range (default: everything) from the documents"""
+    rows = await rebuild_sales_rollups(args.date_from, args.date_to)
+    print(f"Rebuilt {rows} daily rollup rows for {args.date_from or 'the beginning'} .. {args.date_to or 'today'}")
+    return 0
+
+
+def _sample_rows(count: int):
+    documents = [
+        Document(
+            number=f"FA260101-{i:05d}",
+            doc_type=DocumentType.INVOICE,
+            customer_id="c001",
+            customer_name="Jean Dupont",
+            items=[
+                DocumentItem(product_id=f"p{j:03d}", sku=f"SKU-{j}", name=f"Produit {j}", qty=j, unit_price=9.95,
+                             line_subtotal=9.95 * j, line_vat=2.09 * j, line_total=12.04 * j)
+                for j in range(1, 6)
+            ],
+            subtotal=149.25, vat_total=31.34, total=180.59
+        ).model_dump()
+        for i in range(count)
+    ]
+    products = [
+        Product(sku=f"SKU-{i}", name_fr=f"Produit {i}", name_nl=f"Product {i}", category_id="cat-tools",
+                unit=Unit.PIECE, price_retail=9.95, stock_qty=i, barcode=f"54123{i:08d}").model_dump()
+        for i in range(count)
+    ]
+    return {"documents": (Document, documents), "products": (Product, products)}
+
+
+def _timed(func, repeat: int) -> float:
+    """Best time of `repeat` runs, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def bench_serialization(args) -> int:
+    """Per-row cost of the response_model path vs the orjson fast path"""
+    print(f"{args.rows}-row responses, best of {args.repeat}")
+    for name, (model, rows) in _sample_rows(args.rows).items():
+        adapter = TypeAdapter(list[model])
+
+        def response_model_path():
+            # What FastAPI does for response_model=List[Model]: validate, dump, stdlib json
+            validated = adapter.validate_python(rows)
+            json.dumps(adapter.dump_python(validated, mode="json"), ensure_ascii=False, separators=(",", ":")).encode()
+
+        def fast_path():
+            orjson.dumps(rows, default=str)
+
+        def fast_path_gzip():
+            gzip.compress(orjson.dumps(rows, default=str), compresslevel=5)
+
+        size = len(orjson.dumps(rows, default=str))
+        print(f"\n{name} ({size / 1024:.0f} KiB)")
+        for label, func in (("response_model + json", response_model_path), ("orjson", fast_path), ("orjson + gzip", fast_path_gzip)):
+            seconds = _timed(func, args.repeat)
+            print(f"  {label:<22} {seconds * 1000:8.2f} ms  {seconds / args.rows * 1e6:7.1f} us/row")
+    return 0
+
+
+def _execution_stats(explain: dict) -> dict:
+    """Server-side cost of an explain(verbosity="executionStats"): documents and index keys
+    examined, rows returned, milliseconds, and the $group accumulator memory when the
+    server reports it (MongoDB 5.0+)"""
+    totals = {"docs": 0, "keys": 0, "returned": 0, "ms": 0, "group_bytes": 0}
+
+    def walk(node):
+        if isinstance(node, dict):
+            stats = node.get("executionStats")
+            if isinstance(stats, dict):
+                totals["docs"] += stats.get("totalDocsExamined", 0)
+                totals["keys"] += stats.get("totalKeysExamined", 0)
+                totals["returned"] += stats.get("nReturned", 0)
+            for key in ("executionTimeMillis", "executionTimeMillisEstimate"):
+                if isinstance(node.get(key), (int, float)):
+                    totals["ms"] = max(totals["ms"], node[key])
+            if isinstance(node.get("maxAccumulatorMemoryUsageBytes"), dict):
+                totals["group_bytes"] += sum(node["maxAccumulatorMemoryUsageBytes"].values())
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain)
+    stages = set(_plan_stages(explain))
+    totals["collscan"] = "COLLSCAN" in stages
+    totals["sort"] = "SORT" in stages  # Sorted in memory rather than read in index order
+    return totals
+
+
+async def _explain_aggregate(database, collection: str, pipeline: list) -> dict:
+    return _execution_stats(await database.command(
+        "explain", {"aggregate": collection, "pipeline": pipeline, "cursor": {}}, verbosity="executionStats"
+    ))
+
+
+async def _explain_find(database, collection: str, query: dict) -> dict:
+    return _execution_stats(await database.command(
+        "explain", {"find": collection, "filter": query}, verbosity="executionStats"
+    ))
+
+
+async def _timed_call(coro_factory):
+    """Result and wall time of one awaited call"""
+    start = time.perf_counter()
+    result = await coro_factory()
+    return result, time.perf_counter() - start
+
+
+async def bench_dashboard(args) -> int:
+    """Dashboard over growing date ranges: the $facet pipeline on the documents vs the daily rollups.
+    
+    Runs against a scratch <db>_bench database, dropped afterwards, with the server
+    module pointed at it so the rollups are built and read by the server's own code.
+    Costs are the server's, from explain executionStats. Exits 1 if a plan scans the
+    whole collection or the rollup read examines more rows than it returns.
+    """
+    bench_db = client[f"{db.name}_bench"]
+    await bench_db.documents.drop()
+    await bench_db.documents.create_index([("doc_type", 1), ("created_at", -1)])
+    for spec in INDEX_REGISTRY:
+        if spec["collection"] in ("sales_daily", "sales_daily_customers"):
+            await bench_db[spec["collection"]].create_index(spec["keys"], unique=spec.get("unique", False))
+    template = _sample_rows(1)["documents"][1][0]
+    start = datetime.now(timezone.utc) - timedelta(days=args.days)
+    print(f"Seeding {args.days * args.per_day} documents into {bench_db.name}...")
+    for day in range(args.days):
+        created = start + timedelta(days=day)
+        await bench_db.documents.insert_many([
+            {**template, "id": f"{day}-{i}", "number": f"FA-{day:03d}-{i:04d}", "status": "paid",
+             "doc_type": "receipt" if i % 3 else "invoice", "customer_id": f"c{i % 50:03d}",
+             "created_at": (created + timedelta(seconds=i * 30)).isoformat(),
+             "payments": [Payment(method=PaymentMethod.CARD if i % 2 else PaymentMethod.CASH, amount=template["total"]).model_dump()]}
+            for i in range(args.per_day)
+        ])
+
+    server_db = server.db
+    server.db = bench_db
+    failures = []
+    try:
+        print(f"Built {await rebuild_sales_rollups()} rollup rows")
+        print(f"\n{'range':>10} | {'$facet: wall':>12} {'server':>9} {'docs read':>10} {'$group mem':>10} "
+              f"| {'rollups: wall':>13} {'server':>9} {'rows read':>10}")
+        for days in sorted({d for d in (7, 30, 90, 180) if d < args.days} | {args.days}):
+            date_from = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+            _, facet_seconds = await _timed_call(lambda: _dashboard(bench_db, date_from))
+            facet = await _explain_aggregate(bench_db, "documents", dashboard_pipeline(date_from, None))
+            _, rollup_seconds = await _timed_call(lambda: server.get_reports_dashboard(date_from, None, source="rollups"))
+            rollup = await _explain_find(bench_db, "sales_daily", {"doc_type": {"$in": ["invoice", "receipt"]}, **rollup_date_query(date_from, None)})
+            group_memory = f"{facet['group_bytes'] / 2**20:>6.2f} MiB" if facet["group_bytes"] else f"{'n/a':>10}"
+            print(f"{days:>8} d | {facet_seconds * 1000:>9.0f} ms {facet['ms']:>6.0f} ms {facet['docs']:>10} {group_memory} "
+                  f"| {rollup_seconds * 1000:>10.0f} ms {rollup['ms']:>6.0f} ms {rollup['docs']:>10}")
+            if facet["collscan"] or rollup["collscan"]:
+                failures.append(f"{days} d: COLLSCAN")
+            if rollup["docs"] > rollup["returned"]:
+                failures.append(f"{days} d: rollup read examined {rollup['docs']} rows for {rollup['returned']} returned")
+    finally:
+        server.db = server_db
+        await client.drop_database(bench_db.name)
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+async def _dashboard(database, date_from: str):
+    facets = await database.documents.aggregate(dashboard_pipeline(date_from, None)).to_list(1)
+    return dashboard_from_facets(facets[0])
+
+
+async def bench_vat(args) -> int:
+    """VAT report aggregation and streamed line export over `--lines` per-rate lines.
+    
+    Seeds a scratch <db>_bench database (4 VAT rates per document, every 10th a credit
+    note), dropped afterwards. Costs are the server's, from explain executionStats.
+    Exits 1 if a plan scans the whole collection, or if the export sorts in server
+    memory instead of reading the (created_at, id) index in order: that sort would
+    grow with the period exported.
+    """
+    bench_db = client[f"{db.name}_bench"]
+    await bench_db.documents.drop()
+    await bench_db.documents.create_index([("doc_type", 1), ("created_at", -1)])
+    await bench_db.documents.create_index([("created_at", -1), ("id", -1)])
+    rates = [(0, 10.0), (6, 20.0), (12, 30.0), (21, 40.0)]
+    documents = args.lines // len(rates)
+    start = datetime.now(timezone.utc) - timedelta(days=90)
+    print(f"Seeding {documents} documents ({documents * len(rates)} VAT lines) into {bench_db.name}...")
+    for first in range(0, documents, 5000):
+        batch = []
+        for i in range(first, min(first + 5000, documents)):
+            sign = -1 if i % 10 == 9 else 1
+            batch.append({
+                "id": f"d{i}", "number": f"FA-{i:07d}", "doc_type": "credit_note" if sign < 0 else "invoice",
+                "status": "paid", "customer_id": f"c{i % 500:03d}", "customer_name": f"Client {i % 500}",
+                "created_at": (start + timedelta(seconds=i * 7776000 // documents)).isoformat(),
+                "vat_breakdown": [
+                    {"rate": rate, "base": sign * base, "vat": sign * round(base * rate / 100, 2), "total": sign * round(base * (1 + rate / 100), 2)}
+                    for rate, base in rates
+                ]
+            })
+        await bench_db.documents.insert_many(batch)
+
+    failures = []
+    try:
+        async def report():
+            facets = (await bench_db.documents.aggregate(vat_report_pipeline(None, None), allowDiskUse=True).to_list(1))[0]
+            groups = [{**g["_id"], "base": g["base"], "vat": g["vat"], "total": g["total"]} for g in facets["lines"]]
+            return vat_report_from_groups(groups, {c["_id"]: c["count"] for c in facets["documents"]}, None, None)
+
+        async def export(date_to=None):
+            size = 0
+            async for chunk in _serialise_rows(vat_line_rows(bench_db.documents, None, date_to), VAT_LINE_EXPORT_FIELDS, "csv"):
+                size += len(chunk)
+            return size
+
+        result, seconds = await _timed_call(report)
+        stats = await _explain_aggregate(bench_db, "documents", vat_report_pipeline(None, None))
+        group_memory = f"{stats['group_bytes'] / 2**20:.2f} MiB" if stats["group_bytes"] else "n/a"
+        print(f"\nreport      {seconds:8.2f} s  server {stats['ms'] / 1000:6.2f} s  {stats['docs']} docs read  "
+              f"$group memory {group_memory}  grids {result['grids']}")
+        if stats["collscan"]:
+            failures.append("report: COLLSCAN")
+
+        tenth = (start + timedelta(days=8)).strftime("%Y-%m-%d")
+        for label, date_to in (("9 days", tenth), ("90 days", None)):
+            size, seconds = await _timed_call(lambda: export(date_to))
+            stats = await _explain_aggregate(bench_db, "documents", vat_line_pipeline(None, date_to))
+            plan = "in-memory SORT" if stats["sort"] else "index order"
+            print(f"csv export {label:>7}  {seconds:8.2f} s  server {stats['ms'] / 1000:6.2f} s  {stats['docs']} docs read  "
+                  f"{plan}  {size / 2**20:.1f} MiB written")
+            if stats["collscan"] or stats["sort"]:
+                failures.append(f"export over {label}: {'COLLSCAN' if stats['collscan'] else 'sorted in server memory'}")
+    finally:
+        await client.drop_database(bench_db.name)
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="POS backend maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    verify = commands.add_parser("verify-indexes", help="explain() every registered query shape, fail on COLLSCAN or an EOF plan")
+    verify.add_argument("--no-create", action="store_true", help="only check, do not build missing indexes")
+    verify.set_defaults(handler=verify_indexes)
+
+    recount = commands.add_parser("recount-categories", help="rebuild category product_count / in_stock_count")
+    recount.set_defaults(handler=recount_categories)
+
+    stats = commands.add_parser("recompute-customer-stats", help="rebuild customer_stats from the documents")
+    stats.add_argument("--customer", help="only this customer id")
+    stats.set_defaults(handler=recompute_customer_stats_command)
+
+    ledger = commands.add_parser("rebuild-ar-ledger", help="rebuild ar_ledger and customer balances from the documents")
+    ledger.set_defaults(handler=rebuild_ar_ledger_command)
+
+    rollups = commands.add_parser("rebuild-sales-rollups", help="recompute sales_daily from the documents")
+    rollups.add_argument("--from", dest="date_from", help="first day, YYYY-MM-DD (inclusive)")
+    rollups.add_argument("--to", dest="date_to", help="last day, YYYY-MM-DD (inclusive)")
+    rollups.set_defaults(handler=rebuild_sales_rollups_command)
+
+    bench = commands.add_parser("bench-serialization", help="per-row cost of list responses (no database needed)")
+    bench.add_argument("--rows", type=int, default=500)
+    bench.add_argument("--repeat", type=int, default=20)
+    bench.set_defaults(handler=bench_serialization)
+
+    dashboard = commands.add_parser("bench-dashboard", help="dashboard server cost over growing ranges, documents vs rollups (scratch database)")
+    dashboard.add_argument("--days", type=int, default=365)
+    dashboard.add_argument("--per-day", type=int, default=200)
+    dashboard.set_defaults(handler=bench_dashboard)
+
+    vat = commands.add_parser("bench-vat", help="VAT report and line export server cost over a million lines (scratch database)")
+    vat.add_argument("--lines", type=int, default=1_000_000)
+    vat.set_defaults(handler=bench_vat)
+
+    args = parser.parse_args()
+    try:
+        return asyncio.run(args.handler(args))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,51 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query, Body
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Body, Request, Response, UploadFile, File, Header
 from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import os
+import asyncio
+import time
+import json
+import base64
+import gzip
+import csv
+import re
+import unicodedata
 import logging
+import tempfile
+import socket
+import ipaddress
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from urllib.parse import urljoin, urlsplit
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, TypeAdapter
+from typing import Callable, List, Optional, Dict, Any, Type, Set, Tuple, get_args
 import uuid
+from collections import defaultdict, deque, OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+import numpy as np
+import orjson
 from enum import Enum
-from io import BytesIO
+from io import BytesIO, StringIO
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
 from reportlab.platypus import Table, TableStyle
+from PIL import Image, ImageOps, features as pil_features
+
+try:
+    import zstandard
+except ImportError:  # Optional: fast JSON responses then only offer gzip
+    zstandard = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -108,7 +137,9 @@ class Category(BaseModel):
     parent_id: Optional[str] = None  # For hierarchy
     shopify_collection_id: Optional[str] = None
     active: bool = True
-    product_count: int = 0  # Will be calculated dynamically
+    # Maintained with $inc by the product write paths (recount: manage.py recount-categories)
+    product_count: int = 0
+    in_stock_count: int = 0  # Products with stock_qty > 0
 
 class Product(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -130,6 +161,7 @@ class Product(BaseModel):
     vat_rate: float = 21.0
     stock_qty: int = 0
     min_stock: int = 0
+    prevent_negative_stock: bool = False  # Refuse sales that would take stock below zero
     # Physical attributes
     weight: Optional[float] = None  # Poids en kg
     weight_unit: str = "kg"  # kg, g, lb
@@ -157,6 +189,24 @@ class Product(BaseModel):
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updated_at: Optional[str] = None
 
+# Bulk price / attribute update: products matching the filter get every price field
+# adjusted as price * (1 + percent/100) + fixed, rounded to round_to
+class ProductBulkUpdate(BaseModel):
+    # Filter (at least one)
+    category_id: Optional[str] = None
+    vendor: Optional[str] = None
+    tag: Optional[str] = None  # One tag of the comma-separated tags
+    origin: Optional[ProductOrigin] = None
+    # Price expression
+    price_fields: List[str] = ["price_retail"]
+    percent: float = 0.0
+    fixed: float = 0.0
+    round_to: float = 0.01  # Price step, e.g. 0.05 or 1.00
+    rounding: str = "nearest"  # nearest (half up), up, down
+    # Plain attributes to set on every matched product
+    set: Dict[str, Any] = {}
+    dry_run: bool = False  # Only return the match count and a preview
+
 class Customer(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -211,6 +261,32 @@ class DocumentItem(DocumentItemCreate):
     line_vat: float = 0.0
     line_total: float = 0.0
 
+# Per VAT rate totals of a document (computed once by calculate_document_totals)
+class VatBreakdown(BaseModel):
+    rate: float
+    base: float = 0.0
+    vat: float = 0.0
+    total: float = 0.0
+
+# Totals preview (what-if pricing, nothing is stored)
+class PreviewItem(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    qty: float
+    unit_price: float
+    discount_type: Optional[str] = None
+    discount_value: float = 0.0
+    vat_rate: float = 21.0
+
+class PreviewCart(BaseModel):
+    label: Optional[str] = None
+    items: List[PreviewItem]
+    global_discount_type: Optional[str] = None
+    global_discount_value: float = 0.0
+
+class PreviewTotalsRequest(BaseModel):
+    carts: List[PreviewCart]
+    include_lines: bool = False
+
 # Payments
 class PaymentCreate(BaseModel):
     method: PaymentMethod
@@ -259,6 +335,7 @@ class Document(BaseModel):
     subtotal: float = 0.0
     vat_total: float = 0.0
     total: float = 0.0
+    vat_breakdown: List[VatBreakdown] = []
     paid_total: float = 0.0
     global_discount_type: Optional[str] = None
     global_discount_value: float = 0.0
@@ -268,6 +345,7 @@ class Document(BaseModel):
     source_document_id: Optional[str] = None
     related_documents: List[str] = []
     shift_id: Optional[str] = None
+    register_number: Optional[int] = None  # Caisse of the shift the document was made in
     created_by: Optional[str] = None
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updated_at: Optional[str] = None
@@ -566,6 +644,455 @@ class CreditNoteCreate(BaseModel):
     restock_items: bool = True  # Whether to add items back to stock
     refund_method: Optional[PaymentMethod] = None  # If immediate refund
 
+# Slim list models (view=summary)
+class DocumentSummary(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    number: str
+    doc_type: DocumentType
+    status: DocumentStatus
+    customer_id: Optional[str] = None
+    customer_name: Optional[str] = None
+    total: float = 0.0
+    paid_total: float = 0.0
+    created_at: str
+
+class ShiftSummary(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    status: ShiftStatus
+    register_number: int = 1
+    cashier_name: Optional[str] = None
+    sales_count: int = 0
+    sales_total: float = 0.0
+    discrepancy: Optional[float] = None
+    opened_at: str
+    closed_at: Optional[str] = None
+
+class AuditLogSummary(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    action: AuditLogAction
+    entity_type: str
+    entity_id: str
+    entity_number: Optional[str] = None
+    description: str
+    user_name: Optional[str] = None
+    created_at: str
+
+# ============= AUDIT LOG BUFFER =============
+AUDIT_FLUSH_INTERVAL_MS = int(os.environ.get("AUDIT_FLUSH_INTERVAL_MS", "200"))
+AUDIT_FLUSH_BATCH_SIZE = int(os.environ.get("AUDIT_FLUSH_BATCH_SIZE", "200"))
+AUDIT_SPILL_PATH = Path(os.environ.get("AUDIT_SPILL_PATH", str(ROOT_DIR / "audit_spill.jsonl")))
+
+class AuditLogBuffer:
+    """Write-behind queue for audit_logs, journaled on disk.
+    
+    add() appends the entry to the spill file before it returns, so an acknowledged
+    entry survives a crash or SIGKILL of the process. A background task moves the file
+    aside and writes it with insert_many every AUDIT_FLUSH_INTERVAL_MS or as soon as
+    AUDIT_FLUSH_BATCH_SIZE entries are waiting; a batch Mongo refuses is appended back
+    (fsync'ed) and retried on the next flush. The unique index on audit_logs.id makes
+    replays idempotent. add() does not fsync: a power loss of the host, unlike a process
+    crash, can still lose the entries of the last flush interval.
+    """
+    
+    def __init__(self, interval_ms: int, batch_size: int, spill_path: Path):
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.spill_path = spill_path
+        self.waiting = 0
+        self._journal = None
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+    
+    def add(self, entry: Dict[str, Any]):
+        self._write([entry])
+        self.waiting += 1
+        if self.waiting >= self.batch_size:
+            self._wakeup.set()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Audit log flush failed: {str(e)}")
+    
+    async def flush(self):
+        async with self._lock:
+            await self._replay_spill()
+    
+    async def _insert(self, batch: List[Dict[str, Any]]) -> bool:
+        try:
+            # Copies: insert_many adds an ObjectId _id to the documents it is given
+            await db.audit_logs.insert_many([dict(entry) for entry in batch], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate ids come from replaying entries that were already written
+            return all(err.get("code") == 11000 for err in e.details.get("writeErrors", []))
+        except PyMongoError as e:
+            logger.warning(f"Audit logs unavailable, spilling {len(batch)} entries: {str(e)}")
+            return False
+        return True
+    
+    def _write(self, entries: List[Dict[str, Any]]):
+        if self._journal is None:
+            self._journal = open(self.spill_path, "a+b")
+            # A line torn by a crash mid-write must not swallow the first entry appended after it
+            if self._journal.tell():
+                self._journal.seek(-1, os.SEEK_END)
+                if self._journal.read(1) != b"\n":
+                    self._journal.write(b"\n")
+        for entry in entries:
+            self._journal.write(json.dumps(entry, default=str).encode("utf-8") + b"\n")
+        self._journal.flush()
+    
+    def _spill(self, batch: List[Dict[str, Any]]):
+        self._write(batch)
+        os.fsync(self._journal.fileno())
+    
+    def _read_spill(self, path: Path) -> List[Dict[str, Any]]:
+        """Entries of a spill file; lines that do not parse are moved to <spill>.quarantine"""
+        entries, bad = [], []
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    bad.append(line if line.endswith("\n") else line + "\n")
+        if bad:
+            logger.warning(f"Quarantined {len(bad)} unreadable audit spill lines")
+            with open(self.spill_path.with_suffix(".quarantine"), "a", encoding="utf-8") as f:
+                f.writelines(bad)
+                f.flush()
+                os.fsync(f.fileno())
+        return entries
+    
+    async def _replay_spill(self):
+        # A .replay file still there means the previous replay died part way: finish it
+        # before moving the spill file over, so unflushed entries are never overwritten
+        replay_path = self.spill_path.with_suffix(".replay")
+        if not replay_path.exists():
+            if not self.spill_path.exists():
+                return
+            # No await in between: entries added from here on start a new spill file
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self.waiting = 0
+            os.replace(self.spill_path, replay_path)
+        entries = self._read_spill(replay_path)
+        for i in range(0, len(entries), self.batch_size):
+            batch = entries[i:i + self.batch_size]
+            if not await self._insert(batch):
+                self._spill(entries[i:])
+                break
+        os.remove(replay_path)
+
+audit_buffer = AuditLogBuffer(AUDIT_FLUSH_INTERVAL_MS, AUDIT_FLUSH_BATCH_SIZE, AUDIT_SPILL_PATH)
+
+# ============= PRODUCT SEARCH INDEX =============
+SEARCH_NGRAM = 3
+
+def fold_text(text: Optional[str]) -> str:
+    """Lowercase and strip accents, so "Béton" and "beton" match"""
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def search_terms(text: Optional[str]) -> List[str]:
+    return re.findall(r"\w+", fold_text(text))
+
+class ProductSearchIndex:
+    """Process-local search index over the product catalog for search-as-you-type.
+    
+    Words of name_fr, name_nl, sku and barcode are folded (lowercase, no accents) and
+    indexed by SEARCH_NGRAM-grams, so a term matches anywhere inside a word like the
+    old $regex did; terms shorter than an n-gram match word prefixes. SKU and barcode also have exact maps for scans.
+    The full product documents are kept so searches never touch Mongo.
+    
+    Kept fresh by the product write paths (upsert/remove/adjust_stock) and, when
+    Mongo runs as a replica set, by a change stream that also picks up writes made
+    by other workers. Until load() has succeeded, `ready` is False and callers fall
+    back to the regex query.
+    """
+    
+    def __init__(self):
+        self.ready = False
+        self._products: Dict[str, Dict[str, Any]] = {}
+        self._haystacks: Dict[str, str] = {}
+        self._keys: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+        self._by_sku: Dict[str, str] = {}
+        self._by_barcode: Dict[str, str] = {}
+        self._oids: Dict[Any, str] = {}  # Mongo _id -> id, for change stream deletes
+        self._oid_of: Dict[str, Any] = {}  # id -> Mongo _id, to drop _oids entries on remove
+        self._watch_task: Optional[asyncio.Task] = None
+    
+    def __len__(self):
+        return len(self._products)
+    
+    @staticmethod
+    def _word_keys(word: str) -> Set[str]:
+        keys = {"p:" + word[:i] for i in range(1, min(len(word), SEARCH_NGRAM - 1) + 1)}
+        keys.update("g:" + word[i:i + SEARCH_NGRAM] for i in range(len(word) - SEARCH_NGRAM + 1))
+        return keys
+    
+    def upsert(self, product: Dict[str, Any]):
+        product_id = product["id"]
+        # Write paths pass products without _id: keep the one already known
+        oid = product.get("_id", self._oid_of.get(product_id))
+        product = {k: v for k, v in product.items() if k != "_id"}
+        self.remove(product_id)
+        if oid is not None:
+            self._oids[oid] = product_id
+            self._oid_of[product_id] = oid
+        self._products[product_id] = product
+        words = search_terms(" ".join(str(product.get(f) or "") for f in ("name_fr", "name_nl", "sku", "barcode")))
+        self._haystacks[product_id] = " ".join(words)
+        keys = set()
+        for word in set(words):
+            keys.update(self._word_keys(word))
+        for key in keys:
+            self._postings[key].add(product_id)
+        self._keys[product_id] = keys
+        if product.get("sku"):
+            self._by_sku[fold_text(product["sku"])] = product_id
+        if product.get("barcode"):
+            self._by_barcode[product["barcode"]] = product_id
+    
+    def remove(self, product_id: str):
+        oid = self._oid_of.pop(product_id, None)
+        if oid is not None:
+            self._oids.pop(oid, None)
+        product = self._products.pop(product_id, None)
+        if product is None:
+            return
+        for key in self._keys.pop(product_id, ()):
+            ids = self._postings.get(key)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del self._postings[key]
+        self._haystacks.pop(product_id, None)
+        if self._by_sku.get(fold_text(product.get("sku"))) == product_id:
+            del self._by_sku[fold_text(product.get("sku"))]
+        if self._by_barcode.get(product.get("barcode")) == product_id:
+            del self._by_barcode[product["barcode"]]
+    
+    def adjust_stock(self, product_id: str, delta: int):
+        product = self._products.get(product_id)
+        if product is not None:
+            product["stock_qty"] = product.get("stock_qty", 0) + delta
+    
+    def get_by_code(self, code: str) -> Optional[Dict[str, Any]]:
+        """Exact barcode or SKU lookup"""
+        product_id = self._by_barcode.get(code) or self._by_sku.get(fold_text(code))
+        return self._products.get(product_id) if product_id else None
+    
+    def _term_ids(self, term: str) -> Set[str]:
+        if len(term) < SEARCH_NGRAM:
+            return self._postings.get("p:" + term, set())
+        grams = [self._postings.get("g:" + term[i:i + SEARCH_NGRAM], set()) for i in range(len(term) - SEARCH_NGRAM + 1)]
+        ids = set.intersection(*sorted(grams, key=len))
+        # n-grams can co-occur without being contiguous: confirm the substring
+        return {pid for pid in ids if term in self._haystacks[pid]}
+    
+    def search(self, text: str, limit: int = 500, where: Optional[Callable[[Dict[str, Any]], bool]] = None) -> List[Dict[str, Any]]:
+        """Products whose names, SKU or barcode contain every term of `text` (and that
+        `where` accepts, checked before the limit).
+        
+        Exact SKU/barcode hits come first, then products with a word starting with
+        the first term, then the rest by French name.
+        """
+        terms = search_terms(text)
+        if not terms:
+            return []
+        ids = None
+        for term in sorted(terms, key=len, reverse=True):
+            term_ids = self._term_ids(term)
+            ids = term_ids if ids is None else ids & term_ids
+            if not ids:
+                return []
+        if where is not None:
+            ids = {pid for pid in ids if where(self._products[pid])}
+        exact = self.get_by_code(text.strip())
+        exact_id = exact["id"] if exact else None
+        first = terms[0]
+        
+        def rank(product_id: str):
+            product = self._products[product_id]
+            prefix = any(word.startswith(first) for word in self._haystacks[product_id].split())
+            return (product_id != exact_id, not prefix, fold_text(product.get("name_fr")))
+        
+        return [self._products[pid] for pid in sorted(ids, key=rank)[:limit]]
+    
+    async def load(self):
+        products = await db.products.find({}).to_list(None)
+        fresh = ProductSearchIndex()
+        for product in products:
+            fresh.upsert(product)
+        self._products, self._haystacks, self._keys = fresh._products, fresh._haystacks, fresh._keys
+        self._postings, self._by_sku, self._by_barcode = fresh._postings, fresh._by_sku, fresh._by_barcode
+        self._oids, self._oid_of = fresh._oids, fresh._oid_of
+        self.ready = True
+        logger.info(f"Product search index loaded ({len(products)} products)")
+    
+    async def refresh(self, product_ids: List[str]):
+        """Re-read a few products after a write that changed more than stock"""
+        products = await db.products.find({"id": {"$in": list(product_ids)}}).to_list(None)
+        found = set()
+        for product in products:
+            self.upsert(product)
+            found.add(product["id"])
+        for product_id in set(product_ids) - found:
+            self.remove(product_id)
+    
+    def start_watch(self):
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+    
+    async def stop_watch(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+    
+    async def _watch(self):
+        """Apply product changes from other workers via a change stream (replica sets only)"""
+        while True:
+            try:
+                async with db.products.watch(full_document="updateLookup") as stream:
+                    async for change in stream:
+                        if change["operationType"] in ("insert", "update", "replace") and change.get("fullDocument"):
+                            self.upsert(change["fullDocument"])
+                            product_scan_cache.invalidate(change["fullDocument"]["id"])
+                        elif change["operationType"] == "delete":
+                            # Delete events carry the Mongo _id only
+                            product_id = self._oids.get(change["documentKey"]["_id"])
+                            if product_id:
+                                self.remove(product_id)
+                                product_scan_cache.invalidate(product_id)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                if getattr(e, "code", None) == 40573 or "replica set" in str(e):
+                    logger.info("Product search index: no change stream (standalone Mongo), using local updates only")
+                    return
+                logger.warning(f"Product search change stream interrupted, reloading: {str(e)}")
+                await asyncio.sleep(5)
+                await self.load()
+            except Exception as e:
+                logger.info(f"Product search index: change stream unavailable ({str(e)})")
+                return
+
+product_search_index = ProductSearchIndex()
+
+# --- Barcode / SKU scan cache ---
+PRODUCT_SCAN_CACHE_SIZE = int(os.environ.get("PRODUCT_SCAN_CACHE_SIZE", "5000"))
+PRODUCT_SCAN_CACHE_TTL_SECONDS = float(os.environ.get("PRODUCT_SCAN_CACHE_TTL_SECONDS", "30"))
+
+class ProductScanCache:
+    """Bounded LRU of scanned code (barcode, GTIN or SKU) -> product document.
+    
+    Entries are dropped per product by invalidate() when the product or its stock
+    changes (locally, or on another worker through the search index's change stream),
+    and all at once by clear() after a Shopify sync. Each entry also expires after
+    `ttl` seconds, which bounds staleness when Mongo has no change stream (standalone).
+    """
+    
+    def __init__(self, max_size: int, ttl: float = PRODUCT_SCAN_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()  # code -> (expires, product)
+        self._codes: Dict[str, Set[str]] = defaultdict(set)  # product id -> cached codes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(code)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._drop(code)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(code)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, code: str, product: Dict[str, Any]):
+        self._drop(code)
+        self._entries[code] = (time.monotonic() + self.ttl, product)
+        self._codes[product["id"]].add(code)
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+    
+    def _drop(self, code: str):
+        entry = self._entries.pop(code, None)
+        if entry is not None:
+            codes = self._codes[entry[1]["id"]]
+            codes.discard(code)
+            if not codes:
+                del self._codes[entry[1]["id"]]
+    
+    def invalidate(self, product_id: str):
+        for code in self._codes.pop(product_id, ()):
+            self._entries.pop(code, None)
+            self.invalidations += 1
+    
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._codes.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+product_scan_cache = ProductScanCache(PRODUCT_SCAN_CACHE_SIZE)
+
 # ============= HELPERS =============
 async def log_audit(
     action: AuditLogAction,
@@ -578,7 +1105,7 @@ async def log_audit(
     new_values: Optional[Dict] = None,
     metadata: Optional[Dict] = None
 ):
-    """Log an action for audit trail (Peppol compliance)"""
+    """Log an action for audit trail (Peppol compliance), written behind by audit_buffer"""
     audit = AuditLog(
         action=action,
         entity_type=entity_type,
@@ -590,72 +1117,398 @@ async def log_audit(
         new_values=new_values,
         metadata=metadata
     )
-    await db.audit_logs.insert_one(audit.model_dump())
+    audit_buffer.add(audit.model_dump())
     return audit
 
 # ============= HELPERS =============
+DOCUMENT_PREFIXES = {
+    DocumentType.QUOTE: "DV",
+    DocumentType.INVOICE: "FA",
+    DocumentType.RECEIPT: "RC",
+    DocumentType.PROFORMA: "PF",
+    DocumentType.CREDIT_NOTE: "CN",
+    DocumentType.DELIVERY_NOTE: "BL",
+}
+
+# Numbers reserved per (prefix, day) and per worker process. 1 = strictly sequential
+# numbering (callers reserve only once the document is accepted, just before its
+# insert); a larger block avoids a Mongo round trip per sale but may leave gaps
+# when a worker restarts with unused numbers.
+DOCUMENT_NUMBER_BLOCK_SIZE = max(1, int(os.environ.get("DOCUMENT_NUMBER_BLOCK_SIZE", "1")))
+
+_number_blocks: Dict[str, List[int]] = {}  # counter key -> [next, last] reserved by this worker
+_number_lock = asyncio.Lock()
+
+async def _highest_number(key: str) -> int:
+    """Highest sequence already used under a counter key (documents numbered before the
+    counter existed). Read from the number index only, once per key."""
+    highest = 0
+    async for row in db.documents.find({"number": {"$regex": f"^{key}-\\d+$"}}, {"_id": 0, "number": 1}):
+        highest = max(highest, int(row["number"].rsplit("-", 1)[1]))
+    return highest
+
+async def _reserve_numbers(key: str, count: int) -> int:
+    """Atomically reserve `count` numbers for a counter key, returns the last one"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": key},
+        {"$inc": {"seq": count}},
+        return_document=ReturnDocument.AFTER
+    )
+    if counter is None:
+        # First number under this key: start after anything numbered without the counter.
+        # $max is idempotent, so workers racing here still hand out distinct numbers.
+        await db.counters.update_one({"_id": key}, {"$max": {"seq": await _highest_number(key)}}, upsert=True)
+        counter = await db.counters.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"seq": count}},
+            return_document=ReturnDocument.AFTER
+        )
+    return counter["seq"]
+
 async def generate_document_number(doc_type: DocumentType) -> str:
     today = datetime.now(timezone.utc).strftime("%y%m%d")
-    prefix_map = {
-        DocumentType.QUOTE: "DV",
-        DocumentType.INVOICE: "FA",
-        DocumentType.RECEIPT: "RC",
-        DocumentType.PROFORMA: "PF",
-        DocumentType.CREDIT_NOTE: "CN",
-        DocumentType.DELIVERY_NOTE: "BL",
-    }
-    prefix = prefix_map.get(doc_type, "XX")
-    count = await db.documents.count_documents({
-        "number": {"$regex": f"^{prefix}{today}"}
-    })
-    return f"{prefix}{today}-{str(count + 1).zfill(3)}"
+    prefix = DOCUMENT_PREFIXES.get(doc_type, "XX")
+    key = f"{prefix}{today}"
+    
+    if DOCUMENT_NUMBER_BLOCK_SIZE == 1:
+        seq = await _reserve_numbers(key, 1)
+    else:
+        async with _number_lock:
+            block = _number_blocks.get(key)
+            if not block or block[0] > block[1]:
+                last = await _reserve_numbers(key, DOCUMENT_NUMBER_BLOCK_SIZE)
+                block = [last - DOCUMENT_NUMBER_BLOCK_SIZE + 1, last]
+                # Drop blocks left over from previous days
+                for stale in [k for k in _number_blocks if not k.endswith(today)]:
+                    del _number_blocks[stale]
+                _number_blocks[key] = block
+            seq = block[0]
+            block[0] += 1
+    
+    return f"{key}-{str(seq).zfill(3)}"
+
+# --- Money engine: amounts are computed in integer cents, rounded half-up ---
+def _round_cents(amount: Decimal) -> int:
+    return int(amount.quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def to_cents(value: float) -> int:
+    return _round_cents(Decimal(str(value)) * 100)
+
+def from_cents(cents: int) -> float:
+    return round(cents / 100, 2)
+
+def line_subtotal_cents(qty: float, unit_price: float, discount_type: Optional[str], discount_value: float) -> int:
+    amount = Decimal(str(qty)) * Decimal(str(unit_price))
+    if discount_type == "percent":
+        amount -= amount * Decimal(str(discount_value)) / 100
+    elif discount_type == "fixed":
+        amount -= Decimal(str(discount_value))
+    return _round_cents(amount * 100)
+
+def vat_cents(base_cents: int, vat_rate: float) -> int:
+    return _round_cents(Decimal(base_cents) * Decimal(str(vat_rate)) / 100)
+
+def global_discount_cents(subtotal_cents: int, global_discount_type: Optional[str], global_discount_value: float) -> int:
+    if global_discount_type == "percent":
+        return _round_cents(Decimal(subtotal_cents) * Decimal(str(global_discount_value)) / 100)
+    if global_discount_type == "fixed":
+        return to_cents(global_discount_value)
+    return 0
+
+def allocate_discount(discount: int, bases: Dict[float, int]) -> Dict[float, int]:
+    """Split a discount (cents) across VAT rates in proportion to their base.
+    
+    The rounding remainder goes to the rate with the largest base (highest rate on
+    a tie) so the shares always add up to the discount exactly.
+    """
+    total_base = sum(bases.values())
+    if not discount or not total_base:
+        return {rate: 0 for rate in bases}
+    shares = {rate: _round_cents(Decimal(discount) * base / total_base) for rate, base in bases.items()}
+    largest = max(bases, key=lambda rate: (bases[rate], rate))
+    shares[largest] += discount - sum(shares.values())
+    return shares
 
 def calculate_document_totals(items: List[DocumentItemCreate], global_discount_type: Optional[str], global_discount_value: float):
+    """Compute line amounts, document totals and per-rate VAT totals in one pass.
+    
+    Each line is rounded to the cent once; a global discount is allocated across VAT
+    rates in proportion to their base, and VAT is computed per rate on the
+    discounted base. Returns (items, subtotal, vat_total, total, vat_breakdown).
+    """
     calculated_items = []
-    subtotal = 0.0
-    vat_total = 0.0
+    bases: Dict[float, int] = {}
     
     for item in items:
-        line_subtotal = item.qty * item.unit_price
-        if item.discount_type == "percent":
-            line_subtotal -= line_subtotal * (item.discount_value / 100)
-        elif item.discount_type == "fixed":
-            line_subtotal -= item.discount_value
-        
-        line_vat = line_subtotal * (item.vat_rate / 100)
-        line_total = line_subtotal + line_vat
+        line_subtotal = line_subtotal_cents(item.qty, item.unit_price, item.discount_type, item.discount_value)
+        line_vat = vat_cents(line_subtotal, item.vat_rate)
         
         calc_item = DocumentItem(
             **item.model_dump(),
             id=str(uuid.uuid4()),
-            line_subtotal=round(line_subtotal, 2),
-            line_vat=round(line_vat, 2),
-            line_total=round(line_total, 2)
+            line_subtotal=from_cents(line_subtotal),
+            line_vat=from_cents(line_vat),
+            line_total=from_cents(line_subtotal + line_vat)
         )
         calculated_items.append(calc_item)
-        subtotal += line_subtotal
-        vat_total += line_vat
-    
-    # Apply global discount
-    if global_discount_type == "percent":
-        discount = subtotal * (global_discount_value / 100)
-        subtotal -= discount
-        vat_total = subtotal * 0.21
-    elif global_discount_type == "fixed":
-        subtotal -= global_discount_value
-        vat_total = subtotal * 0.21
+        bases[item.vat_rate] = bases.get(item.vat_rate, 0) + line_subtotal
+    
+    # Apply global discount per VAT rate
+    discount = global_discount_cents(sum(bases.values()), global_discount_type, global_discount_value)
+    shares = allocate_discount(discount, bases)
+    
+    vat_breakdown = []
+    subtotal = 0
+    vat_total = 0
+    for rate in sorted(bases):
+        base = bases[rate] - shares[rate]
+        vat = vat_cents(base, rate)
+        subtotal += base
+        vat_total += vat
+        vat_breakdown.append(VatBreakdown(
+            rate=rate, base=from_cents(base), vat=from_cents(vat), total=from_cents(base + vat)
+        ))
     
-    return calculated_items, round(subtotal, 2), round(vat_total, 2), round(subtotal + vat_total, 2)
+    return calculated_items, from_cents(subtotal), from_cents(vat_total), from_cents(subtotal + vat_total), vat_breakdown
+
+# Products are checked against this bound, so the int64 sum or difference taken after
+# them cannot wrap around either
+PREVIEW_INT64_LIMIT = 2.0 ** 62
+
+def _fixed_point(values: List[float]) -> Tuple[np.ndarray, int]:
+    """Values as exact int64 integers sharing one number of decimals (read like
+    Decimal(str(v))); OverflowError when they do not fit"""
+    # Prices, rates and discounts repeat a lot: convert each distinct value once
+    unique, index = np.unique(np.array(values, dtype=np.float64), return_inverse=True)
+    exact = [Decimal(str(v)) for v in unique.tolist()]
+    places = max([0] + [-d.as_tuple().exponent for d in exact])
+    scaled = [int(d.scaleb(places)) for d in exact]
+    if any(abs(v) >= PREVIEW_INT64_LIMIT for v in scaled + [10 ** places]):
+        raise OverflowError("fixed-point value out of int64 range")
+    return np.array(scaled, dtype=np.int64)[index.reshape(-1)], places
+
+def _mul(a, b) -> np.ndarray:
+    """a * b in int64, OverflowError instead of wrapping around"""
+    if np.any(np.abs(np.asarray(a, dtype=np.float64)) * np.abs(np.asarray(b, dtype=np.float64)) >= PREVIEW_INT64_LIMIT):
+        raise OverflowError("product out of int64 range")
+    return np.multiply(np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64))
+
+def _sum_by(index: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    """Exact int64 sums of values per index (np.bincount would go through float64)"""
+    if np.abs(values.astype(np.float64)).sum() >= PREVIEW_INT64_LIMIT:
+        raise OverflowError("sum out of int64 range")
+    sums = np.zeros(size, dtype=np.int64)
+    np.add.at(sums, index, values)
+    return sums
+
+def _half_up_divide(numerator: np.ndarray, denominator) -> np.ndarray:
+    """numerator / denominator of int64 integers, rounded half-up like _round_cents"""
+    denominator = np.asarray(denominator, dtype=np.int64)
+    negative = (numerator < 0) != (denominator < 0)
+    quotient, remainder = np.divmod(np.abs(numerator), np.abs(denominator))
+    quotient += 2 * remainder >= np.abs(denominator)
+    return np.where(negative, -quotient, quotient)
+
+def _preview_result(cart: PreviewCart, discount: int, breakdown: List[Tuple[float, int, int]], lines: Optional[List[Tuple[int, int]]]) -> Dict[str, Any]:
+    """Result of one cart from cents: breakdown is (rate, base, vat), lines (subtotal, vat)"""
+    subtotal = sum(base for _, base, _ in breakdown)
+    vat_total = sum(vat for _, _, vat in breakdown)
+    result = {
+        "label": cart.label,
+        "discount": from_cents(discount),
+        "subtotal": from_cents(subtotal),
+        "vat_total": from_cents(vat_total),
+        "total": from_cents(subtotal + vat_total),
+        "vat_breakdown": [
+            {"rate": float(rate), "base": from_cents(base), "vat": from_cents(vat), "total": from_cents(base + vat)}
+            for rate, base, vat in breakdown
+        ]
+    }
+    if lines is not None:
+        result["lines"] = [
+            {"line_subtotal": from_cents(ls), "line_vat": from_cents(lv), "line_total": from_cents(ls + lv)}
+            for ls, lv in lines
+        ]
+    return result
+
+def _preview_cart_exact(cart: PreviewCart, include_lines: bool) -> Dict[str, Any]:
+    """One cart through the Decimal helpers of calculate_document_totals"""
+    lines, bases = [], {}
+    for item in cart.items:
+        line_subtotal = line_subtotal_cents(item.qty, item.unit_price, item.discount_type, item.discount_value)
+        lines.append((line_subtotal, vat_cents(line_subtotal, item.vat_rate)))
+        bases[item.vat_rate] = bases.get(item.vat_rate, 0) + line_subtotal
+    # As allocate_discount, a cart without a base takes no discount
+    discount = global_discount_cents(sum(bases.values()), cart.global_discount_type, cart.global_discount_value) if sum(bases.values()) else 0
+    shares = allocate_discount(discount, bases)
+    breakdown = [(rate, bases[rate] - shares[rate], vat_cents(bases[rate] - shares[rate], rate)) for rate in sorted(bases)]
+    return _preview_result(cart, discount, breakdown, lines if include_lines else None)
+
+def preview_cart_totals(carts: List[PreviewCart], include_lines: bool = False) -> List[Dict[str, Any]]:
+    """Vectorised calculate_document_totals over many carts at once.
+    
+    All lines of all carts are processed as int64 NumPy arrays with the same rounding
+    rules (cent per line, half-up, discount allocated per rate with the remainder on
+    the largest base, VAT per rate on the discounted base). Inputs are read as exact
+    fixed-point integers, so the results match the Decimal engine to the cent. A batch
+    whose values would overflow int64 (e.g. a price with 15 decimals) goes through
+    the Decimal helpers cart by cart instead.
+    """
+    if not carts:
+        return []
+    try:
+        return _preview_cart_totals_int64(carts, include_lines)
+    except OverflowError:
+        return [_preview_cart_exact(cart, include_lines) for cart in carts]
+
+def _preview_cart_totals_int64(carts: List[PreviewCart], include_lines: bool) -> List[Dict[str, Any]]:
+    lines = [item for cart in carts for item in cart.items]
+    line_cart = np.array([c for c, cart in enumerate(carts) for _ in cart.items], dtype=np.int64).reshape(-1)
+    n_carts = len(carts)
+    
+    qty, qty_places = _fixed_point([i.qty for i in lines])
+    unit_price, price_places = _fixed_point([i.unit_price for i in lines])
+    discount_value, discount_places = _fixed_point([i.discount_value for i in lines])
+    rate_value, rate_places = _fixed_point([i.vat_rate for i in lines])
+    rate = np.array([i.vat_rate for i in lines], dtype=np.float64)
+    percent = np.array([i.discount_type == "percent" for i in lines], dtype=bool)
+    fixed = np.array([i.discount_type == "fixed" for i in lines], dtype=bool)
+    
+    # Line amounts in cents, as fractions over 10^(qty + price + discount places)
+    scale = 10 ** (qty_places + price_places)
+    amount = _mul(_mul(qty, unit_price), 10 ** discount_places)
+    numerator = np.where(percent, _mul(_mul(qty, unit_price), _mul(100, 10 ** discount_places) - discount_value), _mul(amount, 100))
+    numerator = np.where(fixed, _mul(amount - _mul(discount_value, scale), 100), numerator)
+    line_subtotal = _half_up_divide(numerator, _mul(scale, 10 ** discount_places))
+    line_vat = _half_up_divide(_mul(line_subtotal, rate_value), _mul(100, 10 ** rate_places))
+    
+    # Bases per (cart, rate) group
+    groups, group_index = np.unique(
+        np.stack([line_cart.astype(np.float64), rate], axis=1).reshape(-1, 2), axis=0, return_inverse=True
+    )
+    group_index = group_index.reshape(-1)
+    group_cart = groups[:, 0].astype(np.int64)
+    group_rate = groups[:, 1]
+    group_rate_value = np.zeros(len(groups), dtype=np.int64)
+    group_rate_value[group_index] = rate_value
+    group_base = _sum_by(group_index, line_subtotal, len(groups))
+    cart_subtotal = _sum_by(line_cart, line_subtotal, n_carts)
+    
+    # Global discount per cart, allocated over its rates
+    discount_type = np.array([c.global_discount_type or "" for c in carts])
+    global_value, global_places = _fixed_point([c.global_discount_value for c in carts])
+    cart_discount = np.where(
+        discount_type == "percent", _half_up_divide(_mul(cart_subtotal, global_value), _mul(100, 10 ** global_places)),
+        np.where(discount_type == "fixed", _half_up_divide(_mul(global_value, 100), 10 ** global_places), 0)
+    )
+    # As in allocate_discount, a cart without a base takes no discount
+    cart_discount = np.where(cart_subtotal != 0, cart_discount, 0)
+    group_total = cart_subtotal[group_cart]
+    share = _half_up_divide(_mul(cart_discount[group_cart], group_base), np.where(group_total != 0, group_total, 1))
+    if len(groups):
+        # Remainder on the largest base of each cart, highest rate on a tie
+        order = np.lexsort((group_rate, group_base, group_cart))
+        last_of_cart = order[np.r_[group_cart[order][1:] != group_cart[order][:-1], True]]
+        remainder = cart_discount - _sum_by(group_cart, share, n_carts)
+        share[last_of_cart] += remainder[group_cart[last_of_cart]]
+    
+    base = group_base - share
+    vat = _half_up_divide(_mul(base, group_rate_value), _mul(100, 10 ** rate_places))
+    
+    # Groups (sorted by np.unique) and lines are both in cart order: slice them per cart
+    group_bounds = np.searchsorted(group_cart, np.arange(n_carts + 1)).tolist()
+    line_bounds = np.searchsorted(line_cart, np.arange(n_carts + 1)).tolist()
+    breakdowns = list(zip(group_rate.tolist(), base.tolist(), vat.tolist()))
+    line_amounts = list(zip(line_subtotal.tolist(), line_vat.tolist()))
+    return [
+        _preview_result(
+            cart, int(cart_discount[c]), breakdowns[group_bounds[c]:group_bounds[c + 1]],
+            line_amounts[line_bounds[c]:line_bounds[c + 1]] if include_lines else None
+        )
+        for c, cart in enumerate(carts)
+    ]
+
+def document_vat_breakdown(doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Per-rate totals of a stored document; rebuilt from its lines for documents
+    created before vat_breakdown was stored"""
+    if doc.get("vat_breakdown"):
+        return doc["vat_breakdown"]
+    rates: Dict[float, Dict[str, Any]] = {}
+    for item in doc.get("items", []):
+        rate = item.get("vat_rate", 21)
+        if rate not in rates:
+            rates[rate] = {"rate": rate, "base": 0, "vat": 0, "total": 0}
+        rates[rate]["base"] += item.get("line_subtotal", 0)
+        rates[rate]["vat"] += item.get("line_vat", 0)
+        rates[rate]["total"] += item.get("line_total", 0)
+    return list(rates.values())
+
+def _stock_delta(movement_type: StockMovementType, qty: float) -> int:
+    stock_change = qty if movement_type in [StockMovementType.RETURN, StockMovementType.PURCHASE, StockMovementType.ADJUSTMENT] else -qty
+    return int(stock_change)
+
+def _stock_guard(delta: int) -> Dict[str, Any]:
+    """Filter that only matches when a decrement keeps guarded products at or above zero"""
+    if delta >= 0:
+        return {}
+    return {"$or": [{"prevent_negative_stock": {"$ne": True}}, {"stock_qty": {"$gte": -delta}}]}
+
+async def _apply_stock_delta(product_id: str, delta: int) -> Optional[Dict[str, Any]]:
+    """$inc one product's stock atomically; returns the product as it was before the
+    change, or None when it does not exist or the negative-stock guard refused it"""
+    return await db.products.find_one_and_update(
+        {"id": product_id, **_stock_guard(delta)},
+        {"$inc": {"stock_qty": delta}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0, "id": 1, "stock_qty": 1, "category_id": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+
+async def _stock_changed(befores: Dict[str, Dict[str, Any]], deltas: Dict[str, int]):
+    """Keep the search index, scan cache and category in-stock counts in line with
+    stock changes, from the values the writes actually returned"""
+    category_deltas = {}
+    for product_id, before in befores.items():
+        delta = deltas[product_id]
+        product_search_index.adjust_stock(product_id, delta)
+        product_scan_cache.invalidate(product_id)
+        # Only crossing zero changes the category's in-stock count
+        add_category_delta(category_deltas, before, {**before, "stock_qty": (before.get("stock_qty") or 0) + delta})
+    await apply_category_counts(category_deltas)
+
+async def _revert_stock(deltas: Dict[str, int]):
+    undo = {product_id: -delta for product_id, delta in deltas.items() if delta}
+    results = await asyncio.gather(*(_apply_stock_delta(product_id, delta) for product_id, delta in undo.items()))
+    await _stock_changed({product_id: before for product_id, before in zip(undo, results) if before}, undo)
+
+async def revert_stock_movements(movement_ids: List[str]):
+    """Undo recorded movements (e.g. when the document they belong to failed to insert)"""
+    if not movement_ids:
+        return
+    movements = await db.stock_movements.find(
+        {"id": {"$in": movement_ids}}, {"_id": 0, "product_id": 1, "stock_before": 1, "stock_after": 1}
+    ).to_list(len(movement_ids))
+    deltas: Dict[str, int] = {}
+    for m in movements:
+        deltas[m["product_id"]] = deltas.get(m["product_id"], 0) + m["stock_after"] - m["stock_before"]
+    await _revert_stock(deltas)
+    await db.stock_movements.delete_many({"id": {"$in": movement_ids}})
 
 async def record_stock_movement(product_id: str, sku: str, movement_type: StockMovementType, qty: float, ref_type: str = None, ref_id: str = None, reason: str = None):
-    product = await db.products.find_one({"id": product_id})
+    """Apply one stock movement atomically.
+    
+    The quantity change is a single find_one_and_update($inc) returning the product
+    as it was before the change, so stock_before/stock_after reflect what the
+    server actually applied even with concurrent sales.
+    """
+    delta = _stock_delta(movement_type, qty)
+    product = await _apply_stock_delta(product_id, delta)
     if not product:
+        if delta < 0 and await db.products.count_documents({"id": product_id}, limit=1):
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {sku}")
         return
+    await _stock_changed({product_id: product}, {product_id: delta})
     
     stock_before = product.get("stock_qty", 0)
-    stock_change = qty if movement_type in [StockMovementType.RETURN, StockMovementType.PURCHASE, StockMovementType.ADJUSTMENT] else -qty
-    stock_after = stock_before + int(stock_change)
-    
     movement = StockMovement(
         product_id=product_id,
         sku=sku,
@@ -665,16 +1518,740 @@ async def record_stock_movement(product_id: str, sku: str, movement_type: StockM
         reference_id=ref_id,
         reason=reason,
         stock_before=stock_before,
-        stock_after=stock_after
+        stock_after=stock_before + delta
     )
     
     await db.stock_movements.insert_one(movement.model_dump())
-    await db.products.update_one({"id": product_id}, {"$set": {"stock_qty": stock_after}})
+    return movement
+
+STOCK_WRITE_ATTEMPTS = 5
+
+async def _apply_stock_deltas(deltas: Dict[str, int], skus: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+    """Apply many products' stock deltas with one $in read and one ordered bulk_write.
+    
+    Each update only matches while stock_qty still has the value just read, so the
+    read is exactly the pre-image the write changed. An update that no longer matches
+    falls through to an upsert that the unique products.id index refuses: the ordered
+    bulk stops there with everything before it applied, and the rest is read and
+    written again. Returns the pre-image of every product changed (missing products
+    are skipped). On a negative-stock refusal, or any error, the products already
+    changed are reverted before raising.
+    """
+    applied: Dict[str, Dict[str, Any]] = {}
+    pending = dict(deltas)
+    try:
+        for _ in range(STOCK_WRITE_ATTEMPTS):
+            befores = {p["id"]: p async for p in db.products.find(
+                {"id": {"$in": list(pending)}},
+                {"_id": 0, "id": 1, "stock_qty": 1, "category_id": 1, "prevent_negative_stock": 1}
+            )}
+            for product_id, before in befores.items():
+                if before.get("prevent_negative_stock") and (before.get("stock_qty") or 0) + pending[product_id] < 0:
+                    raise HTTPException(status_code=400, detail=f"Insufficient stock for {skus[product_id]}")
+            order = list(befores)
+            if not order:
+                return applied
+            now = datetime.now(timezone.utc).isoformat()
+            try:
+                await db.products.bulk_write([
+                    UpdateOne(
+                        {"id": product_id, "stock_qty": befores[product_id].get("stock_qty"), **_stock_guard(pending[product_id])},
+                        {"$inc": {"stock_qty": pending[product_id]}, "$set": {"updated_at": now}},
+                        upsert=True
+                    )
+                    for product_id in order
+                ], ordered=True)
+                done = len(order)
+            except BulkWriteError as e:
+                error = e.details["writeErrors"][0]
+                if error["code"] != 11000:
+                    raise
+                done = error["index"]  # Changed since the read: retry it and the ones after it
+            for product_id in order[:done]:
+                applied[product_id] = befores[product_id]
+            pending = {product_id: pending[product_id] for product_id in order[done:]}
+            if not pending:
+                return applied
+        raise HTTPException(status_code=409, detail="Stock changed while it was being updated, please retry")
+    except BaseException:
+        await _revert_stock({product_id: deltas[product_id] for product_id in applied})
+        raise
+
+async def record_stock_movements(items: List[Any], movement_type: StockMovementType, ref_type: str = None, ref_id: str = None) -> List[str]:
+    """Record stock movements for many document lines.
+    
+    Items need product_id, sku and qty (and optionally reason). The lines are summed
+    per product and applied with _apply_stock_deltas (one $in read, one bulk_write);
+    stock_before/stock_after come from the pre-images those writes were conditioned
+    on, so concurrent sales cannot skew them. The movements are then written with one
+    insert_many. Returns the created movement IDs.
+    
+    If the negative-stock guard refuses any product, the products already changed
+    are reverted and the error is raised before any movement is written.
+    """
+    deltas: Dict[str, int] = {}
+    for item in items:
+        deltas[item.product_id] = deltas.get(item.product_id, 0) + _stock_delta(movement_type, item.qty)
+    if not deltas:
+        return []
+    
+    applied = await _apply_stock_deltas(deltas, {item.product_id: item.sku for item in items})
+    try:
+        await _stock_changed(applied, deltas)
+        stock = {product_id: before.get("stock_qty", 0) for product_id, before in applied.items()}
+        movements = []
+        for item in items:
+            if item.product_id not in applied:
+                continue
+            stock_before = stock[item.product_id]
+            stock[item.product_id] = stock_before + _stock_delta(movement_type, item.qty)
+            movements.append(StockMovement(
+                product_id=item.product_id,
+                sku=item.sku,
+                type=movement_type,
+                qty=item.qty,
+                reference_type=ref_type,
+                reference_id=ref_id,
+                reason=getattr(item, "reason", None),
+                stock_before=stock_before,
+                stock_after=stock[item.product_id]
+            ).model_dump())
+        if movements:
+            await db.stock_movements.insert_many(movements)
+    except Exception:
+        await _revert_stock({product_id: deltas[product_id] for product_id in applied})
+        raise
+    return [m["id"] for m in movements]
+
+# --- Category counters ---
+def add_category_delta(deltas: Dict[str, Dict[str, int]], before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]) -> Dict[str, Dict[str, int]]:
+    """Accumulate the category count changes of one product going from `before` to `after`.
+    
+    Either side may be None (product created / deleted); only category_id and
+    stock_qty are looked at.
+    """
+    for sign, product in ((-1, before), (1, after)):
+        if not product or not product.get("category_id"):
+            continue
+        entry = deltas.setdefault(product["category_id"], {"product_count": 0, "in_stock_count": 0})
+        entry["product_count"] += sign
+        if (product.get("stock_qty") or 0) > 0:
+            entry["in_stock_count"] += sign
+    return deltas
+
+async def apply_category_counts(deltas: Dict[str, Dict[str, int]]):
+    updates = []
+    for category_id, counts in deltas.items():
+        inc = {field: n for field, n in counts.items() if n}
+        if inc:
+            updates.append(UpdateOne({"id": category_id}, {"$inc": inc}))
+    if updates:
+        await db.categories.bulk_write(updates, ordered=False)
+
+async def recount_category_counts() -> int:
+    """Rebuild product_count / in_stock_count of every category from the products"""
+    counts = await db.products.aggregate([
+        {"$group": {
+            "_id": "$category_id",
+            "product_count": {"$sum": 1},
+            "in_stock_count": {"$sum": {"$cond": [{"$gt": ["$stock_qty", 0]}, 1, 0]}}
+        }}
+    ]).to_list(None)
+    by_category = {c["_id"]: c for c in counts if c["_id"]}
+    categories = await db.categories.find({}, {"_id": 0, "id": 1}).to_list(None)
+    updates = [
+        UpdateOne({"id": cat["id"]}, {"$set": {
+            "product_count": by_category.get(cat["id"], {}).get("product_count", 0),
+            "in_stock_count": by_category.get(cat["id"], {}).get("in_stock_count", 0)
+        }})
+        for cat in categories
+    ]
+    if updates:
+        await db.categories.bulk_write(updates, ordered=False)
+    return len(updates)
+
+# --- Customer stats ---
+# Lifetime aggregates per customer in customer_stats, kept current with $inc deltas by the
+# document write paths. Deltas upsert and bump `version`. A stats document that was never
+# rebuilt from the documents (missing, or created by a delta so without `complete`) is
+# rebuilt on the next read by recompute_customer_stats(), which only replaces the version
+# it started from: a delta landing during its aggregation makes it run again.
+CUSTOMER_STATS_RECOMPUTE_ATTEMPTS = 5
+CUSTOMER_SPENT_STATUSES = ["paid", "partially_paid"]
+CUSTOMER_UNPAID_STATUSES = ["unpaid", "partially_paid"]
+CUSTOMER_SALE_TYPES = ["invoice", "receipt"]
+CUSTOMER_PRODUCT_TYPES = CUSTOMER_SALE_TYPES + ["credit_note"]  # Credit notes take their qty back
+
+def customer_stats_delta(changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) -> Dict[str, Any]:
+    """Update of a customer_stats document for documents going from `before` to `after`.
+    
+    Either side may be None (document created). Only doc_type, status, total,
+    paid_total, created_at and the items are looked at.
+    """
+    inc: Dict[str, float] = {}
+    names: Dict[str, str] = {}
+    last_purchase_at = None
+    for before, after in changes:
+        for sign, doc in ((-1, before), (1, after)):
+            if not doc:
+                continue
+            doc_type = DocumentType(doc["doc_type"]).value
+            status = DocumentStatus(doc.get("status", DocumentStatus.DRAFT)).value
+            
+            def add(field: str, value: float):
+                inc[field] = inc.get(field, 0) + sign * value
+            
+            add("documents_count", 1)
+            add(f"counts.{doc_type}", 1)
+            if status in CUSTOMER_SPENT_STATUSES:
+                add("spent", doc.get("total", 0))
+            if status in CUSTOMER_UNPAID_STATUSES:
+                add("unpaid", doc.get("total", 0) - doc.get("paid_total", 0))
+            if doc_type in CUSTOMER_SALE_TYPES and sign > 0:
+                last_purchase_at = max(last_purchase_at or "", doc.get("created_at") or "") or None
+            if doc_type in CUSTOMER_PRODUCT_TYPES:
+                for item in doc.get("items", []):
+                    if not item.get("product_id"):
+                        continue
+                    qty = item.get("qty", 0)
+                    add(f"products.{item['product_id']}.qty", -qty if doc_type == "credit_note" else qty)
+                    add(f"products.{item['product_id']}.total", qty * item.get("unit_price", 0))
+                    if doc_type in CUSTOMER_SALE_TYPES:
+                        names[item["product_id"]] = item.get("name")
+    
+    inc = {field: round(value, 4) for field, value in inc.items() if round(value, 4)}
+    update: Dict[str, Any] = {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    if inc:
+        update["$inc"] = inc
+        update["$set"].update({
+            f"products.{pid}.name": name for pid, name in names.items() if f"products.{pid}.qty" in inc or f"products.{pid}.total" in inc
+        })
+    if last_purchase_at:
+        update["$max"] = {"last_purchase_at": last_purchase_at}
+    return update
+
+async def apply_customer_stats(customer_id: Optional[str], *changes: Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]):
+    if not customer_id:
+        return
+    update = customer_stats_delta(list(changes))
+    if "$inc" in update or "$max" in update:
+        update.setdefault("$inc", {})["version"] = 1
+        await db.customer_stats.update_one({"customer_id": customer_id}, update, upsert=True)
+
+async def customer_stats_from_documents(customer_id: str) -> Dict[str, Any]:
+    """One customer's stats computed from all their documents (one $facet aggregation)"""
+    facets = await db.documents.aggregate([
+        {"$match": {"customer_id": customer_id}},
+        {"$sort": {"created_at": 1}},
+        {"$facet": {
+            "by_type": [{"$group": {
+                "_id": "$doc_type",
+                "count": {"$sum": 1},
+                "spent": {"$sum": {"$cond": [{"$in": ["$status", CUSTOMER_SPENT_STATUSES]}, "$total", 0]}},
+                "unpaid": {"$sum": {"$cond": [
+                    {"$in": ["$status", CUSTOMER_UNPAID_STATUSES]},
+                    {"$subtract": ["$total", {"$ifNull": ["$paid_total", 0]}]},
+                    0
+                ]}},
+                "last_created_at": {"$max": "$created_at"}
+            }}],
+            "products": [
+                {"$match": {"doc_type": {"$in": CUSTOMER_PRODUCT_TYPES}}},
+                {"$unwind": "$items"},
+                {"$match": {"items.product_id": {"$nin": [None, ""]}}},
+                {"$group": {
+                    "_id": "$items.product_id",
+                    "name": {"$last": {"$cond": [{"$eq": ["$doc_type", "credit_note"]}, "$$REMOVE", "$items.name"]}},
+                    "qty": {"$sum": {"$cond": [
+                        {"$eq": ["$doc_type", "credit_note"]}, {"$multiply": ["$items.qty", -1]}, "$items.qty"
+                    ]}},
+                    "total": {"$sum": {"$multiply": ["$items.qty", "$items.unit_price"]}}
+                }}
+            ]
+        }}
+    ]).to_list(1)
+    by_type = facets[0]["by_type"] if facets else []
+    products = facets[0]["products"] if facets else []
+    purchases = [t["last_created_at"] for t in by_type if t["_id"] in CUSTOMER_SALE_TYPES and t["last_created_at"]]
+    stats = {
+        "customer_id": customer_id,
+        "documents_count": sum(t["count"] for t in by_type),
+        "counts": {DocumentType(t["_id"]).value: t["count"] for t in by_type},
+        "spent": round(sum(t["spent"] for t in by_type), 4),
+        "unpaid": round(sum(t["unpaid"] for t in by_type), 4),
+        "last_purchase_at": max(purchases) if purchases else None,
+        "products": {
+            p["_id"]: {"name": p["name"], "qty": round(p["qty"], 4), "total": round(p["total"], 4)} for p in products
+        },
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    return stats
+
+async def recompute_customer_stats(customer_id: str) -> Dict[str, Any]:
+    """Rebuild one customer's stats, replacing only the version read before aggregating"""
+    for _ in range(CUSTOMER_STATS_RECOMPUTE_ATTEMPTS):
+        current = await db.customer_stats.find_one({"customer_id": customer_id}, {"_id": 0, "version": 1})
+        stats = await customer_stats_from_documents(customer_id)
+        stats.update(version=(current or {}).get("version", 0) + 1, complete=True)
+        if current is None:
+            try:
+                await db.customer_stats.insert_one(dict(stats))
+                return stats
+            except DuplicateKeyError:
+                continue  # A delta created the stats document meanwhile
+        result = await db.customer_stats.replace_one({"customer_id": customer_id, "version": current.get("version")}, stats)
+        if result.matched_count:
+            return stats
+    logger.warning(f"Customer {customer_id} stats kept changing during recompute, left for the next read")
+    return stats
+
+async def recompute_all_customer_stats() -> int:
+    customer_ids = await db.documents.distinct("customer_id", {"customer_id": {"$nin": [None, ""]}})
+    for customer_id in customer_ids:
+        await recompute_customer_stats(customer_id)
+    # Customers without documents just have no stats document
+    await db.customer_stats.delete_many({"customer_id": {"$nin": customer_ids}})
+    return len(customer_ids)
+
+# --- Accounts receivable ledger ---
+# Every change to what a customer owes is appended to ar_ledger (positive amount = owed
+# more) and mirrored into customers.balance (negative = owes money). Entries are keyed by
+# the document they settle: a credit note is booked against the invoice it references.
+# Once a document's entries sum to zero they are marked settled, so aging only ever
+# reads open items.
+AR_DOC_TYPES = ["invoice", "receipt", "credit_note"]
+AR_SETTLED_EPSILON = 0.005
+AR_AGING_BUCKETS = [("0_30", 0), ("31_60", 31), ("61_90", 61), ("90_plus", 91)]  # (name, minimum age in days)
+
+def _ar_key(doc: Dict[str, Any]) -> str:
+    if DocumentType(doc["doc_type"]) == DocumentType.CREDIT_NOTE and doc.get("reference_invoice_id"):
+        return doc["reference_invoice_id"]
+    return doc["id"]
+
+def ar_entry(doc: Dict[str, Any], entry_type: str, amount: float, created_at: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "id": str(uuid.uuid4()),
+        "customer_id": doc["customer_id"],
+        "document_id": _ar_key(doc),
+        "source_document_id": doc["id"],
+        "number": doc.get("number"),
+        "entry_type": entry_type,
+        "amount": round(amount, 2),
+        "created_at": created_at or doc.get("created_at") or datetime.now(timezone.utc).isoformat(),
+        "settled": False
+    }
+
+def ar_entries_for_document(doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Ledger entries of a document: its total, then every payment / refund on it"""
+    if not doc.get("customer_id") or DocumentType(doc["doc_type"]).value not in AR_DOC_TYPES:
+        return []
+    entries = [ar_entry(doc, "document", doc.get("total", 0))]
+    entries += [ar_entry(doc, "payment", -p["amount"], p.get("created_at")) for p in doc.get("payments", [])]
+    return entries
+
+async def settle_ar_documents(document_ids: List[str]):
+    """Mark the entries of documents whose open amount reached zero as settled"""
+    totals = await db.ar_ledger.aggregate([
+        {"$match": {"document_id": {"$in": document_ids}}},
+        {"$group": {"_id": "$document_id", "open": {"$sum": "$amount"}}}
+    ]).to_list(None)
+    closed = [t["_id"] for t in totals if abs(t["open"]) < AR_SETTLED_EPSILON]
+    if closed:
+        await db.ar_ledger.update_many({"document_id": {"$in": closed}, "settled": False}, {"$set": {"settled": True}})
+
+def balance_update(delta_cents: int) -> List[Dict[str, Any]]:
+    """Add whole cents to customers.balance. The stored balance is snapped back to its
+    cents before the delta is added, so repeated changes never drift (a float $inc
+    would leave e.g. -40.49999999999999)."""
+    cents = {"$floor": {"$add": [{"$multiply": [{"$ifNull": ["$balance", 0]}, 100]}, delta_cents, 0.5]}}
+    return [{"$set": {"balance": {"$divide": [cents, 100]}}}]
+
+async def post_ar_entries(entries: List[Dict[str, Any]]):
+    if not entries:
+        return
+    await db.ar_ledger.insert_many([dict(entry) for entry in entries])
+    balances: Dict[str, int] = {}
+    for entry in entries:
+        balances[entry["customer_id"]] = balances.get(entry["customer_id"], 0) - to_cents(entry["amount"])
+    updates = [
+        UpdateOne({"id": customer_id}, balance_update(delta))
+        for customer_id, delta in balances.items() if delta
+    ]
+    await asyncio.gather(
+        db.customers.bulk_write(updates, ordered=False) if updates else _resolved(),
+        settle_ar_documents(list({entry["document_id"] for entry in entries}))
+    )
+
+async def receivables_aging(customer_id: Optional[str] = None, as_of: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Open amount per customer split in aging buckets by document date, largest first"""
+    as_of = as_of or datetime.now(timezone.utc)
+    match: Dict[str, Any] = {"settled": False}
+    if customer_id:
+        match["customer_id"] = customer_id
+    buckets = {}
+    for i, (name, min_days) in enumerate(AR_AGING_BUCKETS):
+        newest = (as_of - timedelta(days=min_days)).isoformat()
+        conditions = [{"$lte": ["$opened_at", newest]}] if min_days else []
+        if i + 1 < len(AR_AGING_BUCKETS):
+            conditions.append({"$gt": ["$opened_at", (as_of - timedelta(days=AR_AGING_BUCKETS[i + 1][1])).isoformat()]})
+        buckets[name] = {"$sum": {"$cond": [{"$and": conditions} if conditions else True, "$open", 0]}}
+    return await db.ar_ledger.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"customer_id": "$customer_id", "document_id": "$document_id"},
+            "open": {"$sum": "$amount"},
+            "opened_at": {"$min": "$created_at"}
+        }},
+        {"$match": {"open": {"$gte": AR_SETTLED_EPSILON}}},
+        {"$group": {"_id": "$_id.customer_id", "open": {"$sum": "$open"}, "documents": {"$sum": 1}, **buckets}},
+        {"$sort": {"open": -1}}
+    ]).to_list(None)
+
+async def rebuild_ar_ledger() -> int:
+    """Replay every customer document into a fresh ledger and reset the customer balances"""
+    await db.ar_ledger.delete_many({})
+    batch: List[Dict[str, Any]] = []
+    posted = 0
+    async for doc in db.documents.find(
+        {"customer_id": {"$nin": [None, ""]}, "doc_type": {"$in": AR_DOC_TYPES}},
+        {"_id": 0, "id": 1, "number": 1, "doc_type": 1, "customer_id": 1, "reference_invoice_id": 1,
+         "total": 1, "payments.amount": 1, "payments.created_at": 1, "created_at": 1}
+    ).sort("created_at", 1):
+        batch.extend(ar_entries_for_document(doc))
+        if len(batch) >= 1000:
+            await db.ar_ledger.insert_many(batch)
+            posted, batch = posted + len(batch), []
+    if batch:
+        await db.ar_ledger.insert_many(batch)
+        posted += len(batch)
+    
+    totals = await db.ar_ledger.aggregate([
+        {"$group": {"_id": {"customer_id": "$customer_id", "document_id": "$document_id"}, "open": {"$sum": "$amount"}}}
+    ]).to_list(None)
+    balances: Dict[str, float] = {}
+    closed = []
+    for t in totals:
+        balances[t["_id"]["customer_id"]] = balances.get(t["_id"]["customer_id"], 0) - t["open"]
+        if abs(t["open"]) < AR_SETTLED_EPSILON:
+            closed.append(t["_id"]["document_id"])
+    if closed:
+        await db.ar_ledger.update_many({"document_id": {"$in": closed}}, {"$set": {"settled": True}})
+    await db.customers.update_many({}, {"$set": {"balance": 0.0}})
+    if balances:
+        await db.customers.bulk_write([
+            UpdateOne({"id": customer_id}, {"$set": {"balance": round(balance, 2)}}) for customer_id, balance in balances.items()
+        ], ordered=False)
+    return posted
+
+# --- Daily sales rollups ---
+# sales_daily holds one row per (date, register, doc_type) with the sums the reports need,
+# kept current with $inc by the document write paths. Rows are keyed on the document's
+# own date: a later payment or credit updates the row of the day the document was made.
+# Map keys (VAT rates, payment methods, products) go through rollup_key() since "." and
+# "$" are not allowed in field names. Customers are counted in sales_daily_customers, one
+# small document per (date, doc_type, customer), so a row never grows with the number of
+# distinct customers.
+SALES_ROLLUP_PAID_STATUSES = ["paid", "partially_paid"]
+
+def next_day(day: str) -> str:
+    try:
+        return (datetime.strptime(day[:10], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {day}")
+
+def report_date_query(date_from: Optional[str], date_to: Optional[str]) -> Dict[str, Any]:
+    """created_at filter for a report period (YYYY-MM-DD bounds, both inclusive)"""
+    date_query = {}
+    if date_from:
+        date_query["$gte"] = date_from
+    if date_to:
+        # Exclusive bound on the next day, so 23:59:59.5 still belongs to date_to
+        date_query["$lt"] = next_day(date_to)
+    return {"created_at": date_query} if date_query else {}
+
+def rollup_date_query(date_from: Optional[str], date_to: Optional[str]) -> Dict[str, Any]:
+    """date filter on rollup rows for a report period (both bounds inclusive)"""
+    date_query = {}
+    if date_from:
+        date_query["$gte"] = date_from
+    if date_to:
+        date_query["$lte"] = date_to
+    return {"date": date_query} if date_query else {}
+
+def rollup_key(value: Any) -> str:
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).replace(".", "_").replace("$", "_")
+
+def rollup_row_key(doc: Dict[str, Any], shift_registers: Optional[Dict[str, int]] = None) -> Tuple[str, int, str]:
+    register = doc.get("register_number")
+    if register is None:
+        register = (shift_registers or {}).get(doc.get("shift_id"), 0)
+    return (doc.get("created_at") or "")[:10], register, DocumentType(doc["doc_type"]).value
+
+def add_sales_rollup(inc: Dict[str, float], names: Dict[str, Any], doc: Dict[str, Any], sign: int = 1):
+    """Accumulate one document's contribution to its sales_daily row"""
+    def add(field: str, value: float):
+        inc[field] = inc.get(field, 0) + sign * value
+    
+    add("count", 1)
+    add("revenue", doc.get("total", 0))
+    if DocumentStatus(doc.get("status", DocumentStatus.DRAFT)).value in SALES_ROLLUP_PAID_STATUSES:
+        add("paid_revenue", doc.get("total", 0))
+        add("paid_count", 1)
+    for item in doc.get("items", []):
+        add("items_sold", item.get("qty", 0))
+        product = item.get("product_id") or item.get("sku")
+        if product:
+            key = rollup_key(product)
+            add(f"products.{key}.qty", item.get("qty", 0))
+            add(f"products.{key}.revenue", item.get("line_subtotal", item.get("qty", 0) * item.get("unit_price", 0)))
+            names[f"products.{key}.name"] = item.get("name")
+    for line in document_vat_breakdown(doc):
+        key = rollup_key(line["rate"])
+        for field in ("base", "vat", "total"):
+            add(f"vat.{key}.{field}", line.get(field, 0))
+        names[f"vat.{key}.rate"] = line["rate"]
+    for payment in doc.get("payments", []):
+        add(f"payments.{rollup_key(PaymentMethod(payment.get('method', 'cash')).value)}", payment.get("amount", 0))
+
+def add_rollup_customer(counts: Dict[Tuple[str, str, str], int], doc: Dict[str, Any], sign: int = 1):
+    """Count one document in its sales_daily_customers entry"""
+    if doc.get("customer_id"):
+        date, _, doc_type = rollup_row_key(doc)
+        key = (date, doc_type, doc["customer_id"])
+        counts[key] = counts.get(key, 0) + sign
+
+async def apply_sales_rollups(*changes: Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]):
+    """$inc the sales_daily rows of documents going from `before` to `after` (either may be None)"""
+    rows: Dict[Tuple[str, int, str], Tuple[Dict[str, float], Dict[str, Any]]] = {}
+    customers: Dict[Tuple[str, str, str], int] = {}
+    for before, after in changes:
+        for sign, doc in ((-1, before), (1, after)):
+            if doc:
+                inc, names = rows.setdefault(rollup_row_key(doc), ({}, {}))
+                add_sales_rollup(inc, names, doc, sign)
+                add_rollup_customer(customers, doc, sign)
+    updates = []
+    for (date, register, doc_type), (inc, names) in rows.items():
+        inc = {field: round(value, 4) for field, value in inc.items() if round(value, 4)}
+        if inc:
+            updates.append(UpdateOne(
+                {"date": date, "register": register, "doc_type": doc_type},
+                {"$inc": inc, "$set": {**names, "updated_at": datetime.now(timezone.utc).isoformat()}},
+                upsert=True
+            ))
+    customer_updates = [
+        UpdateOne({"date": date, "doc_type": doc_type, "customer_id": customer_id}, {"$inc": {"count": count}}, upsert=True)
+        for (date, doc_type, customer_id), count in customers.items() if count
+    ]
+    await asyncio.gather(
+        db.sales_daily.bulk_write(updates, ordered=False) if updates else _resolved(),
+        db.sales_daily_customers.bulk_write(customer_updates, ordered=False) if customer_updates else _resolved()
+    )
+
+async def rebuild_sales_rollups(date_from: Optional[str] = None, date_to: Optional[str] = None) -> int:
+    """Recompute the sales_daily rows of a date range (inclusive, YYYY-MM-DD) from the documents"""
+    shift_registers = {
+        s["id"]: s.get("register_number", 1) for s in await db.shifts.find({}, {"_id": 0, "id": 1, "register_number": 1}).to_list(None)
+    }
+    rows: Dict[Tuple[str, int, str], Tuple[Dict[str, float], Dict[str, Any]]] = {}
+    customers: Dict[Tuple[str, str, str], int] = {}
+    async for doc in db.documents.find(report_date_query(date_from, date_to), {"_id": 0}):
+        inc, names = rows.setdefault(rollup_row_key(doc, shift_registers), ({}, {}))
+        add_sales_rollup(inc, names, doc)
+        add_rollup_customer(customers, doc)
+    
+    date_range = rollup_date_query(date_from, date_to)
+    await asyncio.gather(db.sales_daily.delete_many(date_range), db.sales_daily_customers.delete_many(date_range))
+    
+    now = datetime.now(timezone.utc).isoformat()
+    documents = []
+    for (date, register, doc_type), (inc, names) in rows.items():
+        row = {"date": date, "register": register, "doc_type": doc_type, "updated_at": now}
+        # Dotted paths to nested documents
+        for path, value in [*((f, round(v, 4)) for f, v in inc.items()), *names.items()]:
+            target = row
+            *parents, leaf = path.split(".")
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[leaf] = value
+        documents.append(row)
+    for i in range(0, len(documents), 1000):
+        await db.sales_daily.insert_many(documents[i:i + 1000])
+    customer_rows = [
+        {"date": date, "doc_type": doc_type, "customer_id": customer_id, "count": count}
+        for (date, doc_type, customer_id), count in customers.items()
+    ]
+    for i in range(0, len(customer_rows), 1000):
+        await db.sales_daily_customers.insert_many(customer_rows[i:i + 1000])
+    return len(documents)
+
+async def read_sales_rollups(date_from: Optional[str], date_to: Optional[str], doc_types: List[str]) -> List[Dict[str, Any]]:
+    query = {"doc_type": {"$in": doc_types}, **rollup_date_query(date_from, date_to)}
+    return await db.sales_daily.find(query, {"_id": 0}).to_list(None)
+
+async def count_rollup_customers(date_from: Optional[str], date_to: Optional[str], doc_types: List[str]) -> int:
+    """Distinct customers with at least one document of `doc_types` in the period"""
+    result = await db.sales_daily_customers.aggregate([
+        {"$match": {"doc_type": {"$in": doc_types}, "count": {"$gt": 0}, **rollup_date_query(date_from, date_to)}},
+        {"$group": {"_id": "$customer_id"}},
+        {"$count": "customers"}
+    ]).to_list(1)
+    return result[0]["customers"] if result else 0
+
+def list_projection(view: Optional[str], fields: Optional[str], full_model: Type[BaseModel], summary_model: Type[BaseModel]) -> Optional[Dict[str, int]]:
+    """Mongo projection for the view=summary / fields=a,b,c parameters of list endpoints.
+    
+    Returns None when the full rows are wanted.
+    """
+    if fields:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = [name for name in names if name not in full_model.model_fields]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    elif view == "summary":
+        names = list(summary_model.model_fields)
+    elif view in (None, "full"):
+        return None
+    else:
+        raise HTTPException(status_code=400, detail="view must be 'summary' or 'full'")
+    projection = {"_id": 0, "id": 1, **{name: 1 for name in names}}
+    if "created_at" in full_model.model_fields:
+        projection["created_at"] = 1  # Needed for the pagination cursor
+    return projection
+
+# --- Fast JSON responses for rows read from our own collections ---
+FAST_JSON_COMPRESS_MIN_BYTES = 4096
+
+def _accepted_encodings(request: Request) -> Set[str]:
+    encodings = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            encodings.add(name.strip().lower())
+    return encodings
+
+@lru_cache(maxsize=None)
+def _model_defaults(model: Type[BaseModel]) -> Tuple[Dict[str, Any], Dict[str, Type[BaseModel]]]:
+    """Plain defaults of a model, and its List[SubModel] fields"""
+    defaults, nested = {}, {}
+    for name, field in model.model_fields.items():
+        if not field.is_required() and field.default_factory is None:
+            defaults[name] = field.default
+        args = get_args(field.annotation)
+        if len(args) == 1 and isinstance(args[0], type) and issubclass(args[0], BaseModel):
+            nested[name] = args[0]
+    return defaults, nested
+
+def with_model_defaults(content: Any, model: Type[BaseModel]) -> Any:
+    """Rows (or one row) with the fields they lack filled from the model's defaults.
+    
+    Seeded and legacy rows were written before some fields existed; response_model
+    used to add those, so fast_json_response must too. Rows are copied, never
+    changed in place: they may be the search index's or the scan cache's own dicts.
+    """
+    if isinstance(content, list):
+        return [with_model_defaults(row, model) for row in content]
+    defaults, nested = _model_defaults(model)
+    row = {**{name: value for name, value in defaults.items() if name not in content}, **content}
+    for name, submodel in nested.items():
+        if isinstance(row.get(name), list):
+            row[name] = with_model_defaults(row[name], submodel)
+    return row
+
+def fast_json_response(request: Optional[Request], content: Any, headers: Optional[Dict[str, str]] = None, model: Optional[Type[BaseModel]] = None) -> Response:
+    """JSON response that skips the endpoint's response_model.
+    
+    Only for data read from our own collections, which was validated when it was
+    written: rows are serialised as stored by orjson instead of being rebuilt as
+    Pydantic models and re-encoded by the stdlib json module. With `model`, fields
+    a row lacks get the model's defaults first, as response_model would give them.
+    Bodies of at least FAST_JSON_COMPRESS_MIN_BYTES are compressed with zstd (when
+    installed) or gzip if the client accepts it.
+    """
+    if model is not None:
+        content = with_model_defaults(content, model)
+    body = orjson.dumps(content, default=str)
+    headers = dict(headers or {})
+    if request is not None and len(body) >= FAST_JSON_COMPRESS_MIN_BYTES:
+        accepted = _accepted_encodings(request)
+        if zstandard is not None and "zstd" in accepted:
+            body = zstandard.ZstdCompressor(level=3).compress(body)
+            headers["Content-Encoding"] = "zstd"
+        elif "gzip" in accepted:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def projected_list_response(request: Request, rows: List[Dict[str, Any]], view: Optional[str], summary_model: Type[BaseModel], headers: Optional[Dict[str, str]] = None):
+    """Response for projected rows, bypassing the endpoint's full response_model"""
+    if view == "summary":
+        rows = [summary_model.model_validate(row).model_dump(mode="json") for row in rows]
+    return fast_json_response(request, rows, headers)
+
+# --- Keyset pagination on (created_at, id), newest first ---
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(row: Dict[str, Any], field: str = "created_at") -> str:
+    return base64.urlsafe_b64encode(json.dumps([row[field], row["id"]]).encode()).decode()
+
+def cursor_values(cursor: str):
+    """(sort value, id) stored in an opaque cursor"""
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, last_id
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Filter matching the rows that come after the cursor"""
+    created_at, last_id = cursor_values(cursor)
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "id": {"$lt": last_id}}
+    ]}
+
+async def keyset_page(collection, query: Dict[str, Any], projection: Dict[str, int], limit: int, cursor: Optional[str] = None):
+    """One page of `collection` sorted by (created_at, id) descending.
+    
+    Returns (rows, next_cursor); next_cursor is None on the last page. Each page is
+    an index range scan, so deep pages cost the same as the first one.
+    """
+    if cursor:
+        after = decode_cursor(cursor)
+        query = {"$and": [query, after]} if query else after
+    rows = await collection.find(query, projection).sort([("created_at", -1), ("id", -1)]).limit(limit).to_list(limit)
+    next_cursor = encode_cursor(rows[-1]) if rows and len(rows) == limit else None
+    return rows, next_cursor
+
+def cursor_headers(next_cursor: Optional[str]) -> Optional[Dict[str, str]]:
+    return {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
 
 async def get_current_shift():
     shift = await db.shifts.find_one({"status": ShiftStatus.OPEN}, {"_id": 0})
     return shift
 
+async def _resolved(value=None):
+    """Awaitable placeholder for lookups that are skipped inside asyncio.gather"""
+    return value
+
+# Per-request latency breakdown, filled by timed() and reported by the timing middleware
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+LATENCY_WINDOW = 1000  # Requests kept per route for percentiles
+_route_latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+async def timed(name: str, awaitable):
+    """Await and record the duration (ms) under `name` in the current request breakdown"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
 # ============= SEED DATA =============
 CATEGORIES = [
     {"id": "cat-pipes", "name_fr": "Tuyaux", "name_nl": "Buizen"},
@@ -749,6 +2326,156 @@ CUSTOMERS = [
     {"id": "c010", "type": "company", "name": "Plomberie Express", "vat_number": "BE0567890123", "phone": "+32 2 789 01 23", "email": "contact@plomberieexpress.be", "address": "Waterloosesteenweg 50", "city": "Uccle", "postal_code": "1180", "credit_limit": 8000.0, "balance": 0.0},
 ]
 
+# ============= INDEXES =============
+# Declarative index registry: each entry is built by ensure_indexes() at startup and
+# lists the query shapes it has to serve. `python manage.py verify-indexes` explains
+# every shape and fails if one of them falls back to a COLLSCAN.
+SHOPIFY_MAPPED = {"shopify_variant_id": {"$exists": True}}
+
+INDEX_REGISTRY: List[Dict[str, Any]] = [
+    # documents
+    {"collection": "documents", "keys": [("id", 1)], "unique": True,
+     "queries": [{"filter": {"id": "x"}}]},
+    {"collection": "documents", "keys": [("number", 1)],
+     "queries": [{"filter": {"number": {"$regex": "^FA260101-"}}}]},
+    {"collection": "documents", "keys": [("created_at", -1), ("id", -1)],
+     "queries": [{"filter": {}, "sort": [("created_at", -1), ("id", -1)]},
+                 {"filter": {"created_at": {"$gte": "2026-01-01", "$lte": "2026-12-31"}}, "sort": [("created_at", 1), ("id", 1)]}]},
+    {"collection": "documents", "keys": [("doc_type", 1), ("created_at", -1)],
+     "queries": [{"filter": {"doc_type": {"$in": ["invoice", "receipt"]}, "created_at": {"$gte": "2026-01-01"}}},
+                 {"filter": {"doc_type": {"$in": ["invoice", "receipt"]}}, "sort": [("created_at", -1)]}]},
+    {"collection": "documents", "keys": [("status", 1), ("created_at", -1)],
+     "queries": [{"filter": {"status": "unpaid"}, "sort": [("created_at", -1)]}]},
+    {"collection": "documents", "keys": [("customer_id", 1), ("created_at", -1)],
+     "queries": [{"filter": {"customer_id": "x"}, "sort": [("created_at", -1)]}]},
+    {"collection": "documents", "keys": [("shift_id", 1), ("created_at", 1)],
+     "queries": [{"filter": {"shift_id": "x"}}]},
+    # stock movements
+    {"collection": "stock_movements", "keys": [("created_at", -1), ("id", -1)],
+     "queries": [{"filter": {}, "sort": [("created_at", -1), ("id", -1)]}]},
+    {"collection": "stock_movements", "keys": [("product_id", 1), ("created_at", -1), ("id", -1)],
+     "queries": [{"filter": {"product_id": "x"}, "sort": [("created_at", -1), ("id", -1)]}]},
+    # audit logs
+    {"collection": "audit_logs", "keys": [("id", 1)], "unique": True,
+     "queries": [{"filter": {"id": "x"}}]},
+    {"collection": "audit_logs", "keys": [("created_at", -1), ("id", -1)],
+     "queries": [{"filter": {}, "sort": [("created_at", -1), ("id", -1)]}]},
+    {"collection": "audit_logs", "keys": [("entity_id", 1), ("created_at", -1), ("id", -1)],
+     "queries": [{"filter": {"entity_id": "x"}, "sort": [("created_at", 1)]},
+                 {"filter": {"entity_id": {"$in": ["x", "y"]}}, "sort": [("created_at", 1)]}]},
+    {"collection": "shopify_sync_logs", "keys": [("created_at", -1), ("id", -1)],
+     "queries": [{"filter": {}, "sort": [("created_at", -1), ("id", -1)]}]},
+    # shifts
+    {"collection": "shifts", "keys": [("id", 1)], "unique": True,
+     "queries": [{"filter": {"id": "x"}}]},
+    {"collection": "shifts", "keys": [("status", 1), ("register_number", 1)],
+     "queries": [{"filter": {"status": "open"}},
+                 {"filter": {"status": "open", "register_number": 1}}]},
+    {"collection": "shifts", "keys": [("opened_at", -1)],
+     "queries": [{"filter": {}, "sort": [("opened_at", -1)]}]},
+    {"collection": "shifts", "keys": [("cashier_name", 1), ("opened_at", -1)],
+     "queries": [{"filter": {"cashier_name": "x", "opened_at": {"$gte": "2026-01-01"}}}]},
+    # products
+    {"collection": "products", "keys": [("id", 1)], "unique": True,
+     "queries": [{"filter": {"id": "x"}}, {"filter": {"id": {"$in": ["x", "y"]}}}]},
+    {"collection": "products", "keys": [("sku", 1)],
+     "queries": [{"filter": {"sku": "x"}}]},
+    {"collection": "products", "keys": [("barcode", 1)],
+     "queries": [{"filter": {"barcode": "x"}}]},
+    {"collection": "products", "keys": [("gtin", 1)],
+     "queries": [{"filter": {"$or": [{"barcode": "x"}, {"gtin": "x"}, {"sku": "x"}]}}]},
+    {"collection": "products", "keys": [("name", 1)]},
+    {"collection": "products", "keys": [("updated_at", 1), ("id", 1)],
+     "queries": [{"filter": {"$or": [{"updated_at": {"$gt": "2026-01-01"}}, {"updated_at": "2026-01-01", "id": {"$gt": "x"}}]},
+                  "sort": [("updated_at", 1), ("id", 1)]}]},
+    {"collection": "product_tombstones", "keys": [("id", 1)], "unique": True},
+    {"collection": "product_tombstones", "keys": [("updated_at", 1), ("id", 1)],
+     "queries": [{"filter": {"updated_at": {"$gt": "2026-01-01"}}, "sort": [("updated_at", 1), ("id", 1)]}]},
+    {"collection": "products", "keys": [("category_id", 1)],
+     "queries": [{"filter": {"category_id": "x"}}]},
+    {"collection": "products", "keys": [("shopify_variant_id", 1)], "partialFilterExpression": SHOPIFY_MAPPED,
+     "queries": [{"filter": {"shopify_variant_id": "x"}},
+                 {"filter": {"$or": [{"shopify_variant_id": "x"}, {"sku": "x"}]}},
+                 {"filter": {"shopify_variant_id": {"$ne": None, "$exists": True}}}]},
+    # customers, categories, users
+    {"collection": "customers", "keys": [("id", 1)], "unique": True,
+     "queries": [{"filter": {"id": "x"}}]},
+    {"collection": "customers", "keys": [("search_keys", 1)],
+     "queries": [{"filter": {"search_keys": {"$regex": "^0475"}}, "sort": [("name_key", 1), ("id", 1)]},
+                 {"filter": {"$and": [{"search_keys": {"$regex": "^jean"}}, {"search_keys": {"$regex": "^dup"}}]},
+                  "sort": [("name_key", 1), ("id", 1)]}]},
+    {"collection": "customers", "keys": [("name", 1)]},
+    {"collection": "ar_ledger", "keys": [("settled", 1), ("customer_id", 1)],
+     "queries": [{"filter": {"settled": False}}, {"filter": {"settled": False, "customer_id": "x"}}]},
+    {"collection": "ar_ledger", "keys": [("document_id", 1)],
+     "queries": [{"filter": {"document_id": {"$in": ["x", "y"]}}}]},
+    {"collection": "sales_daily", "keys": [("date", 1), ("register", 1), ("doc_type", 1)], "unique": True,
+     "queries": [{"filter": {"date": {"$gte": "2026-01-01", "$lte": "2026-03-31"}, "doc_type": {"$in": ["invoice", "receipt"]}}}]},
+    {"collection": "sales_daily_customers", "keys": [("date", 1), ("doc_type", 1), ("customer_id", 1)], "unique": True,
+     "queries": [{"filter": {"date": {"$gte": "2026-01-01", "$lte": "2026-03-31"}, "doc_type": {"$in": ["invoice", "receipt"]}, "count": {"$gt": 0}}}]},
+    {"collection": "customer_stats", "keys": [("customer_id", 1)], "unique": True,
+     "queries": [{"filter": {"customer_id": "x"}}]},
+    {"collection": "customers", "keys": [("email", 1)]},
+    {"collection": "customers", "keys": [("vat_number", 1)]},
+    {"collection": "categories", "keys": [("id", 1)], "unique": True,
+     "queries": [{"filter": {"id": "x"}}]},
+    {"collection": "categories", "keys": [("shopify_collection_id", 1)],
+     "queries": [{"filter": {"shopify_collection_id": "x"}}]},
+    {"collection": "users", "keys": [("username", 1)], "unique": True,
+     "queries": [{"filter": {"username": "x", "is_active": True}}]},
+    {"collection": "users", "keys": [("pin_code", 1)], "partialFilterExpression": {"pin_code": {"$exists": True}},
+     "queries": [{"filter": {"pin_code": "1234", "is_active": True}}]},
+    {"collection": "users", "keys": [("email", 1)]},
+    {"collection": "users", "keys": [("role", 1)]},
+]
+
+def index_options(spec: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: spec[key] for key in ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds") if key in spec}
+
+async def ensure_indexes():
+    """Build every registered index; a conflict with an existing index is logged, not fatal"""
+    for spec in INDEX_REGISTRY:
+        try:
+            await db[spec["collection"]].create_index(spec["keys"], **index_options(spec))
+        except PyMongoError as e:
+            logger.warning(f"Index {spec['collection']} {spec['keys']} not created: {e}")
+
+def _plan_stages(plan: Any):
+    """Every stage name in an explain() plan tree"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+async def explain_query_shapes() -> List[Dict[str, Any]]:
+    """Explain every registered query shape and report its winning plan stages.
+    
+    Shapes whose plan is EOF (collection missing) are flagged unverified, not passed.
+    """
+    results = []
+    for spec in INDEX_REGISTRY:
+        for shape in spec.get("queries", []):
+            cursor = db[spec["collection"]].find(shape["filter"])
+            if shape.get("sort"):
+                cursor = cursor.sort(shape["sort"])
+            explain = await cursor.explain()
+            stages = sorted(set(_plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))))
+            results.append({
+                "collection": spec["collection"],
+                "index": spec["keys"],
+                "filter": shape["filter"],
+                "sort": shape.get("sort"),
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages,
+                # A missing collection explains to EOF: no plan was chosen, so nothing is proven
+                "unverified": "EOF" in stages or not stages
+            })
+    return results
+
 # ============= STARTUP =============
 @app.on_event("startup")
 async def seed_database():
@@ -772,26 +2499,44 @@ async def seed_database():
         await db.customers.insert_many(CUSTOMERS)
         logger.info("Seeded customers")
     
-    # Create indexes
-    await db.documents.create_index("number")
-    await db.documents.create_index("doc_type")
-    await db.documents.create_index("status")
-    await db.documents.create_index("customer_id")
-    await db.documents.create_index("created_at")
-    await db.stock_movements.create_index("product_id")
-    await db.stock_movements.create_index("created_at")
-    await db.shifts.create_index("status")
-    await db.shifts.create_index("cashier_name")
-    await db.products.create_index("barcode")
-    await db.products.create_index("name")
-    await db.products.create_index("sku")
-    await db.customers.create_index("name")
-    await db.customers.create_index("email")
-    await db.customers.create_index("vat_number")
-    await db.users.create_index("username", unique=True)
-    await db.users.create_index("email")
-    await db.users.create_index("role")
+    await ensure_indexes()
     logger.info("Database indexes created")
+    
+    # Catalog delta sync keys on updated_at: give legacy/seeded products one
+    backfilled = await db.products.update_many(
+        {"updated_at": None},
+        [{"$set": {"updated_at": {"$ifNull": ["$created_at", datetime.now(timezone.utc).isoformat()]}}}]
+    )
+    if backfilled.modified_count:
+        logger.info(f"Backfilled updated_at on {backfilled.modified_count} products")
+    
+    backfilled = await backfill_customer_search_keys()
+    if backfilled:
+        logger.info(f"Computed search keys for {backfilled} customers")
+    
+    # Categories from before the stored counters get them once
+    if await db.categories.count_documents({"in_stock_count": {"$exists": False}}, limit=1):
+        await recount_category_counts()
+        logger.info("Recounted category product counts")
+    
+    # Reports from before the daily rollups (or with customers still inside the rows): build them once
+    if await db.documents.count_documents({}, limit=1) and (
+        not await db.sales_daily.count_documents({}, limit=1)
+        or await db.sales_daily.count_documents({"customers": {"$exists": True}}, limit=1)
+    ):
+        logger.info(f"Built {await rebuild_sales_rollups()} daily sales rollup rows")
+    
+    # Receivables from before the ledger: replay the documents once
+    if not await db.ar_ledger.count_documents({}, limit=1) and await db.documents.count_documents(
+        {"customer_id": {"$nin": [None, ""]}, "doc_type": {"$in": AR_DOC_TYPES}}, limit=1
+    ):
+        logger.info(f"Rebuilt the receivables ledger ({await rebuild_ar_ledger()} entries)")
+    
+    await product_search_index.load()
+    product_search_index.start_watch()
+    
+    # Start the audit write-behind task (replays any spill file left by a previous run)
+    audit_buffer.start()
 
 # ============= API ROUTES =============
 
@@ -940,20 +2685,9 @@ async def get_user_stats(user_id: str, date_from: Optional[str] = None, date_to:
 # --- Categories ---
 @api_router.get("/categories")
 async def get_categories():
-    # Get all categories
+    # product_count / in_stock_count are stored on the categories (see add_category_delta)
     categories = await db.categories.find({}, {"_id": 0}).to_list(500)
     
-    # Calculate product count for each category using aggregation
-    pipeline = [
-        {"$group": {"_id": "$category_id", "count": {"$sum": 1}}}
-    ]
-    product_counts = await db.products.aggregate(pipeline).to_list(500)
-    count_map = {item["_id"]: item["count"] for item in product_counts if item["_id"]}
-    
-    # Add product_count to each category
-    for cat in categories:
-        cat["product_count"] = count_map.get(cat.get("id"), 0)
-    
     # Sort by name
     categories.sort(key=lambda x: x.get("name_fr", "").lower())
     
@@ -962,11 +2696,19 @@ async def get_categories():
 # --- Products ---
 @api_router.get("/products", response_model=List[Product])
 async def get_products(
+    request: Request,
     search: Optional[str] = Query(None),
     category_id: Optional[str] = Query(None),
     barcode: Optional[str] = Query(None),
     low_stock: Optional[bool] = Query(None)
 ):
+    if search and product_search_index.ready:
+        return fast_json_response(request, product_search_index.search(search, where=lambda p: (
+            (not category_id or p.get("category_id") == category_id)
+            and (not barcode or p.get("barcode") == barcode)
+            and (not low_stock or p.get("stock_qty", 0) <= p.get("min_stock", 0))
+        )), model=Product)
+    
     query = {}
     if category_id:
         query["category_id"] = category_id
@@ -982,7 +2724,408 @@ async def get_products(
     if low_stock:
         query["$expr"] = {"$lte": ["$stock_qty", "$min_stock"]}
     
-    return await db.products.find(query, {"_id": 0}).to_list(500)
+    return fast_json_response(request, await db.products.find(query, {"_id": 0}).to_list(500), model=Product)
+
+# --- Catalog delta sync ---
+# Tokens are opaque (updated_at, id) keysets. Once a terminal has caught up, its token
+# is moved back by CATALOG_SYNC_OVERLAP_SECONDS so writes whose updated_at was
+# stamped just before a concurrent read are re-sent rather than missed.
+CATALOG_SYNC_OVERLAP_SECONDS = 5
+
+def _catalog_after(value: str, last_id: str) -> Dict[str, Any]:
+    return {"$or": [{"updated_at": {"$gt": value}}, {"updated_at": value, "id": {"$gt": last_id}}]}
+
+@api_router.get("/products/changes")
+async def get_product_changes(
+    request: Request,
+    since: Optional[str] = Query(None, description="next_token of the previous call; omit for the full catalog"),
+    limit: int = Query(500, ge=1, le=2000)
+):
+    """Products created, updated or deleted since the token, oldest change first.
+    
+    Call again with next_token while has_more is true; apply `products` as upserts
+    and `deleted` as removals by id.
+    """
+    query = _catalog_after(*cursor_values(since)) if since else {}
+    sort = [("updated_at", 1), ("id", 1)]
+    products, tombstones = await asyncio.gather(
+        db.products.find(query, {"_id": 0}).sort(sort).limit(limit).to_list(limit),
+        db.product_tombstones.find(query, {"_id": 0}).sort(sort).limit(limit).to_list(limit)
+    )
+    changes = sorted(
+        [(p["updated_at"], p["id"], p) for p in products] + [(t["updated_at"], t["id"], None) for t in tombstones],
+        key=lambda change: (change[0], change[1])
+    )
+    has_more = len(changes) > limit or len(products) == limit or len(tombstones) == limit
+    changes = changes[:limit]
+    
+    latest = {}  # id -> last change in this page
+    for updated_at, product_id, product in changes:
+        latest.pop(product_id, None)
+        latest[product_id] = product
+    
+    if has_more:
+        updated_at, last_id, _ = changes[-1]
+        next_token = encode_cursor({"updated_at": updated_at, "id": last_id}, "updated_at")
+    else:
+        caught_up = (datetime.now(timezone.utc) - timedelta(seconds=CATALOG_SYNC_OVERLAP_SECONDS)).isoformat()
+        if changes:
+            caught_up = min(caught_up, changes[-1][0])
+        elif since:
+            caught_up = min(caught_up, cursor_values(since)[0])
+        next_token = encode_cursor({"updated_at": caught_up, "id": ""}, "updated_at")
+    
+    return fast_json_response(request, {
+        "products": with_model_defaults([p for p in latest.values() if p is not None], Product),
+        "deleted": [pid for pid, p in latest.items() if p is None],
+        "next_token": next_token,
+        "has_more": has_more
+    })
+
+@api_router.get("/products/scan-cache")
+async def get_product_scan_cache_stats():
+    """Hit-rate statistics of the scan cache"""
+    return product_scan_cache.stats()
+
+@api_router.get("/products/scan/{code}", response_model=Product)
+async def scan_product(code: str):
+    """Resolve a scanned barcode, GTIN/EAN or SKU to one product"""
+    product = product_scan_cache.get(code)
+    if product is None:
+        product = await db.products.find_one(
+            {"$or": [{"barcode": code}, {"gtin": code}, {"sku": code}]},
+            {"_id": 0}
+        )
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        product_scan_cache.put(code, product)
+    return fast_json_response(None, product, model=Product)
+
+# --- Product import / export ---
+# Same flat layout both ways: one column per Product field, list/dict fields as JSON.
+PRODUCT_FILE_FIELDS = list(Product.model_fields)
+PRODUCT_JSON_FIELDS = {"metafields", "collection_ids"}
+# Only set when a product is created: stock changes go through stock movements
+PRODUCT_INSERT_ONLY_FIELDS = {"id", "stock_qty", "created_at"}
+PRODUCT_IMPORT_CHUNK_SIZE = 1000
+PRODUCT_IMPORT_MAX_ERRORS = 1000
+EXPORT_FILE_CHUNK_BYTES = 64 * 1024
+
+def _product_file_row(product: Dict[str, Any]) -> Dict[str, Any]:
+    row = {}
+    for name in PRODUCT_FILE_FIELDS:
+        value = product.get(name)
+        if name in PRODUCT_JSON_FIELDS and value is not None:
+            value = json.dumps(value, ensure_ascii=False)
+        row[name] = value
+    return row
+
+def _parse_product_row(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """File cells (all strings) -> Product input; empty cells are left to the model defaults"""
+    data = {}
+    for name, value in raw.items():
+        if name not in Product.model_fields or value is None or (isinstance(value, str) and not value.strip()):
+            continue
+        value = value.strip() if isinstance(value, str) else value
+        if name in PRODUCT_JSON_FIELDS:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ValueError(f"{name}: invalid JSON")
+        data[name] = value
+    return data
+
+def _read_product_chunks(file: UploadFile, file_format: str):
+    """Rows of the uploaded file as lists of dicts, PRODUCT_IMPORT_CHUNK_SIZE at a time"""
+    import pandas as pd
+    
+    if file_format == "csv":
+        # dtype=str keeps barcodes and SKUs exactly as written (leading zeros)
+        for frame in pd.read_csv(file.file, dtype=str, keep_default_na=False, chunksize=PRODUCT_IMPORT_CHUNK_SIZE):
+            yield frame.to_dict("records")
+    else:
+        frame = pd.read_excel(file.file, dtype=str, keep_default_na=False)
+        for start in range(0, len(frame), PRODUCT_IMPORT_CHUNK_SIZE):
+            yield frame.iloc[start:start + PRODUCT_IMPORT_CHUNK_SIZE].to_dict("records")
+
+def _product_upsert(product: Product, columns: Set[str], now: str) -> UpdateOne:
+    """Upsert by SKU: columns present in the file are set, the rest only on insert.
+    
+    A pipeline update, so updated_at only moves when a value really changes: a row
+    re-imported as is leaves the product untouched (counted as unchanged, not
+    re-sent by /products/changes).
+    """
+    values = product.model_dump(mode="json")
+    to_set = {name: values[name] for name in columns if name not in PRODUCT_INSERT_ONLY_FIELDS | {"updated_at"}}
+    inserting = {"$eq": [{"$ifNull": ["$id", None]}, None]}  # Upserted: only the sku is there yet
+    changed = {"$or": [inserting] + [{"$ne": [f"${name}", {"$literal": value}]} for name, value in to_set.items()]}
+    fields = {name: {"$literal": value} for name, value in to_set.items()}
+    for name, value in values.items():
+        if name not in to_set and name != "updated_at":
+            fields[name] = {"$cond": [inserting, {"$literal": value}, f"${name}"]}
+    fields["updated_at"] = {"$cond": [changed, now, "$updated_at"]}
+    return UpdateOne({"sku": product.sku}, [{"$set": fields}], upsert=True)
+
+async def _apply_imported_products(skus: List[str], categories_before: Dict[str, Optional[str]], now: str):
+    """Category counters, search index and scan cache for the products an import chunk changed.
+    
+    The import only stamps updated_at on rows it really changed, so those are read
+    back by it. It never sets stock_qty on existing products: their in-stock side
+    only moves with the category, whatever a concurrent sale did to the stock.
+    """
+    changed = await db.products.find({"sku": {"$in": skus}, "updated_at": now}).to_list(None)
+    category_deltas: Dict[str, Dict[str, int]] = {}
+    for product in changed:
+        before = {**product, "category_id": categories_before[product["sku"]]} if product["sku"] in categories_before else None
+        add_category_delta(category_deltas, before, product)
+        product_search_index.upsert(product)
+        product_scan_cache.invalidate(product["id"])
+    await apply_category_counts(category_deltas)
+
+@api_router.post("/products/import")
+async def import_products(file: UploadFile = File(...)):
+    """Create or update products by SKU from a CSV or XLSX file (the /products/export layout).
+    
+    Rows are validated against Product in chunks and written with unordered
+    bulk_write upserts. Columns missing from the file keep their current value on
+    existing products. Returns counts and one entry per rejected row; if the file
+    turns unreadable part way, the chunks already written stay and the counts so
+    far come back with file_error set.
+    """
+    filename = (file.filename or "").lower()
+    file_format = "xlsx" if filename.endswith((".xlsx", ".xls")) else "csv"
+    now = datetime.now(timezone.utc).isoformat()
+    summary = {"rows": 0, "created": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    errors = []
+    
+    def reject(line: int, sku: Optional[str], messages: List[str]):
+        summary["failed"] += 1
+        if len(errors) < PRODUCT_IMPORT_MAX_ERRORS:
+            errors.append({"row": line, "sku": sku, "errors": messages})
+    
+    def validate(rows: List[Dict[str, Any]], line: int) -> Dict[str, tuple]:
+        """Upserts of a chunk by SKU (last row wins for a SKU repeated in the chunk)"""
+        by_sku: Dict[str, tuple] = {}
+        for raw in rows:
+            line += 1
+            summary["rows"] += 1
+            sku = str(raw.get("sku") or "").strip() or None
+            try:
+                data = _parse_product_row(raw)
+                product = Product(**data)
+            except ValueError as e:
+                messages = [f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()] if isinstance(e, ValidationError) else [str(e)]
+                reject(line, sku, messages)
+                continue
+            if product.sku in by_sku:
+                reject(by_sku[product.sku][0], product.sku, [f"Duplicate SKU, superseded by row {line}"])
+            by_sku[product.sku] = (line, _product_upsert(product, set(data), now))
+        return by_sku
+    
+    file_error = None
+    try:
+        # Parsing and validation are CPU bound: they run in the threadpool, off the event loop
+        chunks = _read_product_chunks(file, file_format)
+        line = 1  # Header line
+        while (rows := await run_in_threadpool(next, chunks, None)) is not None:
+            by_sku = await run_in_threadpool(validate, rows, line)
+            line += len(rows)
+            if not by_sku:
+                continue
+            lines = [entry[0] for entry in by_sku.values()]
+            existing = await db.products.find({"sku": {"$in": list(by_sku)}}, {"_id": 0, "sku": 1, "category_id": 1}).to_list(None)
+            try:
+                result = await db.products.bulk_write([entry[1] for entry in by_sku.values()], ordered=False)
+                details = result.bulk_api_result
+            except BulkWriteError as e:
+                details = e.details
+                for err in details.get("writeErrors", []):
+                    reject(lines[err["index"]], list(by_sku)[err["index"]], [err.get("errmsg", "Write failed")])
+            created = details.get("nUpserted", 0)
+            summary["created"] += created
+            summary["updated"] += details.get("nModified", 0)
+            summary["unchanged"] += details.get("nMatched", 0) - details.get("nModified", 0)
+            if created or details.get("nModified", 0):
+                await _apply_imported_products(list(by_sku), {p["sku"]: p.get("category_id") for p in existing}, now)
+    except (ValueError, ImportError) as e:
+        # Unreadable file (bad encoding, not a spreadsheet, missing XLSX engine)
+        file_error = f"Cannot read {file_format.upper()} file: {str(e)}"
+    finally:
+        # Chunks written before a failure are kept, and already reflected chunk by chunk
+        if summary["rows"]:
+            stopped = f", stopped early: {file_error}" if file_error else ""
+            await log_audit(
+                AuditLogAction.UPDATE,
+                "product",
+                "import",
+                f"Product import {file.filename}: {summary['created']} created, {summary['updated']} updated, {summary['failed']} rejected{stopped}",
+                metadata={**summary, "file_error": file_error}
+            )
+    
+    if file_error and not summary["rows"]:
+        raise HTTPException(status_code=400, detail=file_error)
+    errors.sort(key=lambda error: error["row"])
+    return {**summary, "errors": errors, "errors_truncated": summary["failed"] > len(errors), "file_error": file_error}
+
+@api_router.get("/products/export")
+async def export_products(
+    format: str = Query("csv", pattern="^(csv|xlsx)$"),
+    category_id: Optional[str] = Query(None)
+):
+    """Every product in the /products/import layout (CSV is streamed from the cursor)"""
+    query = {"category_id": category_id} if category_id else {}
+    cursor = db.products.find(query, {"_id": 0}).sort("sku", 1).batch_size(EXPORT_BATCH_SIZE)
+    if format == "csv":
+        async def rows():
+            async for product in cursor:
+                yield _product_file_row(product)
+        return _export_response(rows(), PRODUCT_FILE_FIELDS, "csv", "products")
+    
+    from openpyxl import Workbook
+    
+    # Write-only sheets spool their rows to a temporary file, and the workbook is
+    # saved to another one: neither the rows nor the .xlsx are held in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("products")
+    sheet.append(PRODUCT_FILE_FIELDS)
+    async for product in cursor:
+        row = _product_file_row(product)
+        sheet.append([row[name] for name in PRODUCT_FILE_FIELDS])
+    output = tempfile.TemporaryFile()
+    try:
+        await run_in_threadpool(workbook.save, output)
+    except BaseException:
+        output.close()
+        raise
+    output.seek(0)
+    
+    def chunks():
+        with output:
+            while data := output.read(EXPORT_FILE_CHUNK_BYTES):
+                yield data
+    
+    filename = f"products-{datetime.now(timezone.utc).strftime('%Y%m%d')}.xlsx"
+    return StreamingResponse(
+        chunks(),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# --- Bulk update by filter ---
+PRODUCT_PRICE_FIELDS = {"price_retail", "price_wholesale", "price_loyal", "compare_at_price", "cost_price"}
+# Identity, stock and bookkeeping fields have their own write paths
+PRODUCT_BULK_LOCKED_FIELDS = {"id", "sku", "barcode", "gtin", "stock_qty", "created_at", "updated_at", "shopify_variant_id", "shopify_product_id", "shopify_inventory_item_id"}
+PRODUCT_BULK_PREVIEW_SIZE = 10
+
+def _bulk_update_filter(data: ProductBulkUpdate) -> Dict[str, Any]:
+    query = {}
+    if data.category_id:
+        query["category_id"] = data.category_id
+    if data.vendor:
+        query["vendor"] = data.vendor
+    if data.origin:
+        query["origin"] = data.origin
+    if data.tag:
+        query["tags"] = {"$regex": f"(^|,)\\s*{re.escape(data.tag.strip())}\\s*(,|$)", "$options": "i"}
+    return query
+
+# Float cents are off by far less than this from the exact Decimal value; it keeps
+# exact half steps rounding up like the Decimal engine does
+HALF_UP_EPSILON = 1e-6
+
+def _price_expression(field: str, data: ProductBulkUpdate) -> Dict[str, Any]:
+    """Aggregation expression for the new value of a price field.
+    
+    Works in cents of the rounding step with a small epsilon, so 1.15 * 100 rounds
+    like 115. Non-numeric (null/missing) prices are left alone.
+    """
+    step = round(data.round_to * 100)
+    cents = {"$add": [{"$multiply": [f"${field}", 100 + data.percent]}, data.fixed * 100]}
+    steps = {"$divide": [cents, step]}
+    if data.rounding == "up":
+        rounded = {"$ceil": {"$subtract": [steps, HALF_UP_EPSILON]}}
+    elif data.rounding == "down":
+        rounded = {"$floor": {"$add": [steps, HALF_UP_EPSILON]}}
+    else:
+        rounded = {"$floor": {"$add": [steps, 0.5 + HALF_UP_EPSILON]}}
+    price = {"$max": [{"$divide": [{"$multiply": [rounded, step]}, 100]}, 0]}
+    return {"$cond": [{"$isNumber": f"${field}"}, price, f"${field}"]}
+
+@api_router.post("/products/bulk-update")
+async def bulk_update_products(data: ProductBulkUpdate):
+    """Adjust prices and set attributes on every product matching a filter.
+    
+    Runs as one update_many with an aggregation-pipeline update on the matching
+    products whose values would change, writes one audit summary and reloads the
+    product search index and scan cache once.
+    """
+    query = _bulk_update_filter(data)
+    if not query:
+        raise HTTPException(status_code=400, detail="At least one filter (category_id, vendor, tag, origin) is required")
+    unknown = [f for f in data.price_fields if f not in PRODUCT_PRICE_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Not price fields: {', '.join(unknown)}")
+    if data.rounding not in ("nearest", "up", "down"):
+        raise HTTPException(status_code=400, detail="rounding must be nearest, up or down")
+    if round(data.round_to * 100) < 1:
+        raise HTTPException(status_code=400, detail="round_to must be at least 0.01")
+    
+    attributes = {}
+    for name, value in data.set.items():
+        if name not in Product.model_fields or name in PRODUCT_BULK_LOCKED_FIELDS or name in data.price_fields:
+            raise HTTPException(status_code=400, detail=f"Field {name} cannot be bulk updated")
+        try:
+            attributes[name] = TypeAdapter(Product.model_fields[name].annotation).validate_python(value)
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=f"{name}: {e.errors()[0]['msg']}")
+    attributes = TypeAdapter(Dict[str, Any]).dump_python(attributes, mode="json")
+    
+    adjust_prices = bool(data.percent or data.fixed)
+    new_values = {field: _price_expression(field, data) for field in data.price_fields} if adjust_prices else {}
+    if not new_values and not attributes:
+        raise HTTPException(status_code=400, detail="Nothing to update: give percent, fixed or set")
+    
+    if data.dry_run:
+        matched, preview = await asyncio.gather(
+            db.products.count_documents(query),
+            db.products.aggregate([
+                {"$match": query},
+                {"$limit": PRODUCT_BULK_PREVIEW_SIZE},
+                {"$project": {
+                    "_id": 0, "id": 1, "sku": 1, "name_fr": 1,
+                    **{field: 1 for field in new_values},
+                    **{f"new_{field}": expression for field, expression in new_values.items()}
+                }}
+            ]).to_list(PRODUCT_BULK_PREVIEW_SIZE)
+        )
+        return {"matched": matched, "modified": 0, "dry_run": True, "preview": preview}
+    
+    # Only rows the update really changes are written, so updated_at (and the
+    # delta sync) leaves the others alone and modified counts real changes
+    changes = {**new_values, **{name: {"$literal": value} for name, value in attributes.items()}}
+    differs = {"$expr": {"$or": [{"$ne": [f"${name}", expression]} for name, expression in changes.items()]}}
+    now = datetime.now(timezone.utc).isoformat()
+    matched, result = await asyncio.gather(
+        db.products.count_documents(query),
+        db.products.update_many({**query, **differs}, [{"$set": {**changes, "updated_at": now}}])
+    )
+    
+    if result.modified_count:
+        if "category_id" in attributes:
+            await recount_category_counts()
+        await product_search_index.load()
+        product_scan_cache.clear()
+    summary = {"matched": matched, "modified": result.modified_count}
+    await log_audit(
+        AuditLogAction.UPDATE,
+        "product",
+        "bulk-update",
+        f"Bulk update of {result.modified_count} products",
+        new_values={"price_fields": data.price_fields if adjust_prices else [], "percent": data.percent, "fixed": data.fixed,
+                    "round_to": data.round_to, "rounding": data.rounding, "set": attributes},
+        metadata={"filter": data.model_dump(include={"category_id", "vendor", "tag", "origin"}, exclude_none=True, mode="json"), **summary}
+    )
+    return {**summary, "dry_run": False}
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
@@ -993,29 +3136,134 @@ async def get_product(product_id: str):
 
 @api_router.post("/products", response_model=Product)
 async def create_product(product: Product):
+    product.updated_at = product.updated_at or product.created_at
     product_dict = product.model_dump()
     await db.products.insert_one(product_dict)
+    await apply_category_counts(add_category_delta({}, None, product_dict))
+    product_search_index.upsert(product_dict)
     return product
 
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, data: Dict[str, Any] = Body(...)):
-    data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    await db.products.update_one({"id": product_id}, {"$set": data})
-    updated = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if not updated:
+    data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    previous = await db.products.find_one_and_update(
+        {"id": product_id},
+        {"$set": data},
+        projection={"_id": 0, "category_id": 1, "stock_qty": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not previous:
         raise HTTPException(status_code=404, detail="Product not found")
+    updated = await db.products.find_one({"id": product_id}, {"_id": 0})
+    if "category_id" in data or "stock_qty" in data:
+        await apply_category_counts(add_category_delta({}, previous, updated))
+    product_search_index.upsert(updated)
+    product_scan_cache.invalidate(product_id)
     return updated
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str):
-    result = await db.products.delete_one({"id": product_id})
-    if result.deleted_count == 0:
+    deleted = await db.products.find_one_and_delete({"id": product_id}, projection={"_id": 0, "category_id": 1, "stock_qty": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Product not found")
+    await apply_category_counts(add_category_delta({}, deleted, None))
+    # Terminals syncing with /products/changes learn about the delete from the tombstone
+    await db.product_tombstones.update_one(
+        {"id": product_id},
+        {"$set": {"id": product_id, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    product_search_index.remove(product_id)
+    product_scan_cache.invalidate(product_id)
     return {"message": "Product deleted"}
 
 # --- Customers ---
+# Normalised search keys (customers.search_keys, one multikey index) so autocomplete is
+# a handful of anchored prefix lookups: folded name tokens, lowercased email, phone
+# digits in international/national/subscriber form and the compact VAT/BCE number.
+# customers.name_key (folded name) lets Mongo sort the matches before the limit.
+COUNTRY_CALLING_CODES = ("32", "31", "33", "352", "49")  # BE first: the default for national numbers
+CUSTOMER_AUTOCOMPLETE_FIELDS = ["id", "name", "type", "phone", "email", "vat_number", "city", "postal_code", "credit_limit", "balance"]
+
+def phone_search_keys(phone: Optional[str]) -> Set[str]:
+    """"+32 475 12 34 56" -> 32475123456, 0475123456, 475123456"""
+    digits = re.sub(r"\D", "", phone or "")
+    international = phone.strip().startswith("+") if phone else False
+    if digits.startswith("00"):
+        digits, international = digits[2:], True
+    if len(digits) < 6:
+        return {digits} if digits else set()
+    if international:
+        code = next((c for c in COUNTRY_CALLING_CODES if digits.startswith(c)), None)
+        national = "0" + digits[len(code):] if code else None
+    elif digits.startswith("0"):
+        national, digits = digits, COUNTRY_CALLING_CODES[0] + digits[1:]
+    else:
+        national = None
+    keys = {digits}
+    if national:
+        keys.update({national, national[1:]})
+    return keys
+
+def vat_search_keys(vat: Optional[str]) -> Set[str]:
+    """"BE 0123.456.789" -> be0123456789, 0123456789"""
+    compact = re.sub(r"[^0-9a-z]", "", fold_text(vat))
+    if not compact:
+        return set()
+    return {compact, re.sub(r"^[a-z]{2}", "", compact)}
+
+def customer_search_keys(customer: Dict[str, Any]) -> List[str]:
+    keys = set(search_terms(customer.get("name"))) | set(search_terms(customer.get("contact_name")))
+    if customer.get("email"):
+        keys.add(customer["email"].strip().lower())
+    keys |= phone_search_keys(customer.get("phone"))
+    keys |= vat_search_keys(customer.get("vat_number")) | vat_search_keys(customer.get("company_id"))
+    return sorted(k for k in keys if k)
+
+def customer_search_fields(customer: Dict[str, Any]) -> Dict[str, Any]:
+    """Stored fields autocomplete filters and sorts on"""
+    return {"search_keys": customer_search_keys(customer), "name_key": fold_text(customer.get("name"))}
+
+def customer_autocomplete_query(text: str) -> Optional[Dict[str, Any]]:
+    """Anchored prefix filter on search_keys for what the cashier typed (None: too short)"""
+    text = text.strip()
+    if "@" in text:
+        return {"search_keys": {"$regex": "^" + re.escape(text.lower())}}
+    if not re.search(r"[^\W\d_]", text):  # No letters: phone or VAT digits
+        digits = re.sub(r"\D", "", text)
+        if digits.startswith("00"):
+            digits = digits[2:]
+        return {"search_keys": {"$regex": "^" + digits}} if len(digits) >= 2 else None
+    terms = search_terms(text)
+    if not terms or sum(len(t) for t in terms) < 2:
+        return None
+    clauses = [{"search_keys": {"$regex": "^" + re.escape(term)}} for term in terms]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+async def backfill_customer_search_keys() -> int:
+    customers = await db.customers.find(
+        {"$or": [{"search_keys": {"$exists": False}}, {"name_key": {"$exists": False}}]},
+        {"_id": 0, "id": 1, "name": 1, "contact_name": 1, "email": 1, "phone": 1, "vat_number": 1, "company_id": 1}
+    ).to_list(None)
+    if customers:
+        await db.customers.bulk_write([
+            UpdateOne({"id": c["id"]}, {"$set": customer_search_fields(c)}) for c in customers
+        ], ordered=False)
+    return len(customers)
+
+@api_router.get("/customers/autocomplete")
+async def autocomplete_customers(request: Request, q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=50)):
+    """First customers by name whose name, email, phone or VAT number starts with what was typed"""
+    query = customer_autocomplete_query(q)
+    if query is None:
+        return fast_json_response(request, [])
+    customers = await db.customers.find(
+        query, {"_id": 0, **{name: 1 for name in CUSTOMER_AUTOCOMPLETE_FIELDS}}
+    ).sort([("name_key", 1), ("id", 1)]).limit(limit).to_list(limit)
+    return fast_json_response(request, customers)
+
 @api_router.get("/customers", response_model=List[Customer])
-async def get_customers(search: Optional[str] = Query(None)):
+async def get_customers(request: Request, search: Optional[str] = Query(None)):
     query = {}
     if search:
         query["$or"] = [
@@ -1024,7 +3272,7 @@ async def get_customers(search: Optional[str] = Query(None)):
             {"vat_number": {"$regex": search, "$options": "i"}},
             {"email": {"$regex": search, "$options": "i"}}
         ]
-    return await db.customers.find(query, {"_id": 0}).to_list(500)
+    return fast_json_response(request, await db.customers.find(query, {"_id": 0, "search_keys": 0, "name_key": 0}).to_list(500), model=Customer)
 
 @api_router.get("/customers/{customer_id}", response_model=Customer)
 async def get_customer(customer_id: str):
@@ -1036,16 +3284,26 @@ async def get_customer(customer_id: str):
 @api_router.post("/customers", response_model=Customer)
 async def create_customer(customer: Customer):
     customer_dict = customer.model_dump()
+    customer_dict.update(customer_search_fields(customer_dict))
     await db.customers.insert_one(customer_dict)
     return customer
 
 @api_router.put("/customers/{customer_id}", response_model=Customer)
 async def update_customer(customer_id: str, data: Dict[str, Any] = Body(...)):
     data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    await db.customers.update_one({"id": customer_id}, {"$set": data})
-    updated = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+    data.pop("search_keys", None)
+    data.pop("name_key", None)
+    updated = await db.customers.find_one_and_update(
+        {"id": customer_id},
+        {"$set": data},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     if not updated:
         raise HTTPException(status_code=404, detail="Customer not found")
+    search_fields = customer_search_fields(updated)
+    if any(updated.get(name) != value for name, value in search_fields.items()):
+        await db.customers.update_one({"id": customer_id}, {"$set": search_fields})
     return updated
 
 @api_router.delete("/customers/{customer_id}")
@@ -1056,61 +3314,60 @@ async def delete_customer(customer_id: str):
     return {"message": "Customer deleted"}
 
 @api_router.get("/customers/{customer_id}/history")
-async def get_customer_history(customer_id: str, limit: int = 50):
-    """Get purchase history and documents for a customer"""
-    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+async def get_customer_history(customer_id: str, limit: int = Query(20, le=100), view: Optional[str] = Query(None)):
+    """Lifetime stats, most purchased products and recent documents for a customer"""
+    projection = list_projection(view, None, Document, DocumentSummary)
+    customer, stats, documents = await asyncio.gather(
+        db.customers.find_one({"id": customer_id}, {"_id": 0, "search_keys": 0, "name_key": 0}),
+        db.customer_stats.find_one({"customer_id": customer_id}, {"_id": 0}),
+        db.documents.find({"customer_id": customer_id}, projection or {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    )
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    
-    # Get all documents for this customer
-    documents = await db.documents.find(
-        {"customer_id": customer_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(limit)
-    
-    # Calculate stats
-    total_spent = sum(d.get("total", 0) for d in documents if d.get("status") in ["paid", "partially_paid"])
-    total_documents = len(documents)
-    invoices_count = len([d for d in documents if d.get("doc_type") == "invoice"])
-    quotes_count = len([d for d in documents if d.get("doc_type") == "quote"])
-    receipts_count = len([d for d in documents if d.get("doc_type") == "receipt"])
-    unpaid_amount = sum(d.get("total", 0) - d.get("paid_total", 0) for d in documents if d.get("status") in ["unpaid", "partially_paid"])
-    
-    # Get most purchased products
-    product_counts = {}
-    for doc in documents:
-        for item in doc.get("items", []):
-            pid = item.get("product_id")
-            if pid:
-                if pid not in product_counts:
-                    product_counts[pid] = {"name": item.get("name"), "qty": 0, "total": 0}
-                product_counts[pid]["qty"] += item.get("qty", 0)
-                product_counts[pid]["total"] += item.get("qty", 0) * item.get("unit_price", 0)
-    
-    top_products = sorted(product_counts.values(), key=lambda x: x["total"], reverse=True)[:10]
+    if not stats or not stats.get("complete"):
+        stats = await recompute_customer_stats(customer_id)
+    
+    counts = stats.get("counts", {})
+    total_spent = stats.get("spent", 0)
+    total_documents = stats.get("documents_count", 0)
+    top_products = sorted(
+        ({"product_id": pid, "name": p.get("name"), "qty": round(p.get("qty", 0), 3), "total": round(p.get("total", 0), 2)}
+         for pid, p in stats.get("products", {}).items()),
+        key=lambda x: x["total"], reverse=True
+    )[:10]
     
     return {
         "customer": customer,
         "stats": {
             "total_spent": round(total_spent, 2),
             "total_documents": total_documents,
-            "invoices_count": invoices_count,
-            "quotes_count": quotes_count,
-            "receipts_count": receipts_count,
-            "unpaid_amount": round(unpaid_amount, 2),
-            "average_ticket": round(total_spent / total_documents, 2) if total_documents > 0 else 0
+            "invoices_count": counts.get("invoice", 0),
+            "quotes_count": counts.get("quote", 0),
+            "receipts_count": counts.get("receipt", 0),
+            "credit_notes_count": counts.get("credit_note", 0),
+            "unpaid_amount": round(stats.get("unpaid", 0), 2),
+            "average_ticket": round(total_spent / total_documents, 2) if total_documents > 0 else 0,
+            "last_purchase_at": stats.get("last_purchase_at")
         },
         "top_products": top_products,
-        "recent_documents": documents[:20]
+        "recent_documents": [
+            DocumentSummary.model_validate(d).model_dump(mode="json") for d in documents
+        ] if projection else documents
     }
 
 # --- Documents (unified) ---
 @api_router.post("/documents", response_model=Document)
 async def create_document(doc_data: DocumentCreate):
-    doc_number = await generate_document_number(doc_data.doc_type)
+    # Customer and shift are independent lookups: run them concurrently. The number is
+    # only reserved once every check and the stock movements have succeeded, so a
+    # refused sale does not use one up.
+    customer, shift = await asyncio.gather(
+        timed("customer", db.customers.find_one({"id": doc_data.customer_id}, {"_id": 0}) if doc_data.customer_id else _resolved()),
+        timed("shift", get_current_shift())
+    )
     
     # Calculate totals
-    items, subtotal, vat_total, total = calculate_document_totals(
+    items, subtotal, vat_total, total, vat_breakdown = calculate_document_totals(
         doc_data.items, 
         doc_data.global_discount_type, 
         doc_data.global_discount_value
@@ -1121,27 +3378,25 @@ async def create_document(doc_data: DocumentCreate):
     customer_vat = None
     customer_address = None
     peppol_recipient_id = None
-    if doc_data.customer_id:
-        customer = await db.customers.find_one({"id": doc_data.customer_id}, {"_id": 0})
-        if customer:
-            customer_name = customer.get("name")
-            customer_vat = customer.get("vat_number")
-            # Build structured address
-            address_parts = []
-            if customer.get("street_name"):
-                addr = customer.get("street_name")
-                if customer.get("building_number"):
-                    addr += f" {customer.get('building_number')}"
-                address_parts.append(addr)
-            elif customer.get("address"):
-                address_parts.append(customer.get("address"))
-            if customer.get("postal_code") or customer.get("city"):
-                address_parts.append(f"{customer.get('postal_code', '')} {customer.get('city', '')}".strip())
-            customer_address = ", ".join(address_parts) if address_parts else None
-            
-            # Set Peppol recipient if customer has Peppol enabled
-            if customer.get("receive_invoices_by_peppol") and customer.get("peppol_id"):
-                peppol_recipient_id = customer.get("peppol_id")
+    if customer:
+        customer_name = customer.get("name")
+        customer_vat = customer.get("vat_number")
+        # Build structured address
+        address_parts = []
+        if customer.get("street_name"):
+            addr = customer.get("street_name")
+            if customer.get("building_number"):
+                addr += f" {customer.get('building_number')}"
+            address_parts.append(addr)
+        elif customer.get("address"):
+            address_parts.append(customer.get("address"))
+        if customer.get("postal_code") or customer.get("city"):
+            address_parts.append(f"{customer.get('postal_code', '')} {customer.get('city', '')}".strip())
+        customer_address = ", ".join(address_parts) if address_parts else None
+        
+        # Set Peppol recipient if customer has Peppol enabled
+        if customer.get("receive_invoices_by_peppol") and customer.get("peppol_id"):
+            peppol_recipient_id = customer.get("peppol_id")
     
     # Process payments
     payments = []
@@ -1151,6 +3406,15 @@ async def create_document(doc_data: DocumentCreate):
         payments.append(payment)
         paid_total += p.amount
     
+    # Credit limit: what the customer already owes plus what this sale leaves unpaid
+    if customer and doc_data.doc_type in [DocumentType.INVOICE, DocumentType.RECEIPT] and (customer.get("credit_limit") or 0) > 0:
+        exposure = round(-(customer.get("balance") or 0) + total - paid_total, 2)
+        if total - paid_total > AR_SETTLED_EPSILON and exposure > customer["credit_limit"]:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Credit limit exceeded: {exposure:.2f} EUR outstanding, limit {customer['credit_limit']:.2f} EUR"
+            )
+    
     # Determine status
     if doc_data.doc_type == DocumentType.QUOTE:
         status = DocumentStatus.DRAFT
@@ -1161,11 +3425,28 @@ async def create_document(doc_data: DocumentCreate):
     else:
         status = DocumentStatus.UNPAID
     
-    # Get current shift
-    shift = await get_current_shift()
     shift_id = shift.get("id") if shift else None
     
+    # Update stock for invoices/receipts and delivery notes (not quotes)
+    doc_id = str(uuid.uuid4())
+    stock_movement_ids = []
+    if doc_data.doc_type in [DocumentType.INVOICE, DocumentType.RECEIPT]:
+        stock_movement_ids = await timed("stock", record_stock_movements(
+            doc_data.items, StockMovementType.SALE, "document", doc_id
+        ))
+    elif doc_data.doc_type == DocumentType.DELIVERY_NOTE:
+        stock_movement_ids = await timed("stock", record_stock_movements(
+            doc_data.items, StockMovementType.DELIVERY, "delivery_note", doc_id
+        ))
+    
+    try:
+        doc_number = await timed("number", generate_document_number(doc_data.doc_type))
+    except Exception:
+        await revert_stock_movements(stock_movement_ids)
+        raise
+    
     doc = Document(
+        id=doc_id,
         number=doc_number,
         doc_type=doc_data.doc_type,
         status=status,
@@ -1178,6 +3459,7 @@ async def create_document(doc_data: DocumentCreate):
         subtotal=subtotal,
         vat_total=vat_total,
         total=total,
+        vat_breakdown=vat_breakdown,
         paid_total=round(paid_total, 2),
         global_discount_type=doc_data.global_discount_type,
         global_discount_value=doc_data.global_discount_value,
@@ -1186,6 +3468,7 @@ async def create_document(doc_data: DocumentCreate):
         payment_terms=doc_data.payment_terms,
         source_document_id=doc_data.source_document_id,
         shift_id=shift_id,
+        register_number=shift.get("register_number") if shift else None,
         peppol_recipient_id=peppol_recipient_id,
         # Credit note fields if provided
         reference_invoice_id=doc_data.reference_invoice_id,
@@ -1193,45 +3476,20 @@ async def create_document(doc_data: DocumentCreate):
         # Delivery note fields if provided
         delivery_address=doc_data.delivery_address,
         delivery_contact=doc_data.delivery_contact,
-        delivery_notes=doc_data.delivery_notes
+        delivery_notes=doc_data.delivery_notes,
+        stock_movement_created=bool(stock_movement_ids),
+        stock_movement_ids=stock_movement_ids
     )
     
     doc_dict = doc.model_dump()
-    await db.documents.insert_one(doc_dict)
-    
-    # Update stock for invoices/receipts (not quotes)
-    stock_movement_ids = []
-    if doc_data.doc_type in [DocumentType.INVOICE, DocumentType.RECEIPT]:
-        for item in doc_data.items:
-            stock_move = await record_stock_movement(
-                item.product_id, item.sku, StockMovementType.SALE, 
-                item.qty, "document", doc.id
-            )
-            if stock_move and hasattr(stock_move, 'id'):
-                stock_movement_ids.append(stock_move.id)
-        
-        # Update document with stock movement IDs
-        if stock_movement_ids:
-            await db.documents.update_one(
-                {"id": doc.id},
-                {"$set": {"stock_movement_created": True, "stock_movement_ids": stock_movement_ids}}
-            )
+    try:
+        await timed("insert", db.documents.insert_one(doc_dict))
+    except Exception:
+        await revert_stock_movements(stock_movement_ids)
+        raise
     
-    # Handle delivery note stock movements
-    if doc_data.doc_type == DocumentType.DELIVERY_NOTE:
-        for item in doc_data.items:
-            stock_move = await record_stock_movement(
-                item.product_id, item.sku, StockMovementType.DELIVERY,
-                item.qty, "delivery_note", doc.id
-            )
-            if stock_move and hasattr(stock_move, 'id'):
-                stock_movement_ids.append(stock_move.id)
-        
-        if stock_movement_ids:
-            await db.documents.update_one(
-                {"id": doc.id},
-                {"$set": {"stock_movement_created": True, "stock_movement_ids": stock_movement_ids}}
-            )
+    # Follow-up writes are independent of each other
+    writes = []
     
     # Update shift totals if there's an active shift
     if shift_id and doc_data.doc_type in [DocumentType.INVOICE, DocumentType.RECEIPT]:
@@ -1249,17 +3507,16 @@ async def create_document(doc_data: DocumentCreate):
                 update_data["$inc"]["card_total"] = update_data["$inc"].get("card_total", 0) + p.amount
             else:
                 update_data["$inc"]["transfer_total"] = update_data["$inc"].get("transfer_total", 0) + p.amount
-        await db.shifts.update_one({"id": shift_id}, update_data)
+        writes.append(db.shifts.update_one({"id": shift_id}, update_data))
     
     # Update source document if converting
     if doc_data.source_document_id:
-        old_status = (await db.documents.find_one({"id": doc_data.source_document_id}, {"status": 1})).get("status")
-        await db.documents.update_one(
+        writes.append(db.documents.update_one(
             {"id": doc_data.source_document_id},
             {"$push": {"related_documents": doc.id}, "$set": {"status": DocumentStatus.ACCEPTED}}
-        )
+        ))
         # Log conversion audit
-        await log_audit(
+        writes.append(log_audit(
             action=AuditLogAction.CONVERT,
             entity_type="document",
             entity_id=doc_data.source_document_id,
@@ -1270,10 +3527,14 @@ async def create_document(doc_data: DocumentCreate):
                 "target_document_number": doc.number,
                 "target_type": doc_data.doc_type.value
             }
-        )
+        ))
+    
+    writes.append(apply_customer_stats(doc_data.customer_id, (None, doc_dict)))
+    writes.append(post_ar_entries(ar_entries_for_document(doc_dict)))
+    writes.append(apply_sales_rollups((None, doc_dict)))
     
     # Audit log for document creation
-    await log_audit(
+    writes.append(log_audit(
         action=AuditLogAction.CREATE,
         entity_type="document",
         entity_id=doc.id,
@@ -1286,21 +3547,27 @@ async def create_document(doc_data: DocumentCreate):
             "total": total,
             "items_count": len(doc_data.items)
         }
-    )
+    ))
+    
+    await timed("followup_writes", asyncio.gather(*writes))
     
     return doc
 
-@api_router.get("/documents", response_model=List[Document])
-async def get_documents(
-    doc_type: Optional[DocumentType] = Query(None),
-    status: Optional[DocumentStatus] = Query(None),
-    customer_id: Optional[str] = Query(None),
-    search: Optional[str] = Query(None),
-    date_from: Optional[str] = Query(None),
-    date_to: Optional[str] = Query(None),
-    shift_id: Optional[str] = Query(None),
-    limit: int = Query(100, le=500)
-):
+@api_router.post("/documents/preview-totals")
+async def preview_document_totals(data: PreviewTotalsRequest):
+    """Totals for many carts or pricing scenarios at once, without writing anything"""
+    return {"results": preview_cart_totals(data.carts, data.include_lines)}
+
+def build_document_query(
+    doc_type: Optional[DocumentType] = None,
+    status: Optional[DocumentStatus] = None,
+    customer_id: Optional[str] = None,
+    search: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    shift_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """Mongo filter for the document list filters (shared by the list and the exports)"""
     query = {}
     if doc_type:
         query["doc_type"] = doc_type
@@ -1319,8 +3586,30 @@ async def get_documents(
         query["created_at"] = {"$gte": date_from}
     if date_to:
         query.setdefault("created_at", {})["$lte"] = date_to
+    return query
+
+@api_router.get("/documents", response_model=List[Document])
+async def get_documents(
+    doc_type: Optional[DocumentType] = Query(None),
+    status: Optional[DocumentStatus] = Query(None),
+    customer_id: Optional[str] = Query(None),
+    search: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    shift_id: Optional[str] = Query(None),
+    limit: int = Query(100, le=500),
+    view: Optional[str] = Query(None, description="summary for the slim DocumentSummary rows"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    request: Request = None
+):
+    projection = list_projection(view, fields, Document, DocumentSummary)
+    query = build_document_query(doc_type, status, customer_id, search, date_from, date_to, shift_id)
     
-    return await db.documents.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
+    docs, next_cursor = await keyset_page(db.documents, query, projection or {"_id": 0}, limit, cursor)
+    if projection:
+        return projected_list_response(request, docs, view, DocumentSummary, cursor_headers(next_cursor))
+    return fast_json_response(request, docs, cursor_headers(next_cursor), model=Document)
 
 @api_router.get("/documents/{doc_id}", response_model=Document)
 async def get_document(doc_id: str):
@@ -1331,7 +3620,10 @@ async def get_document(doc_id: str):
 
 @api_router.post("/documents/{doc_id}/pay")
 async def add_payment(doc_id: str, payment: PaymentCreate):
-    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0})
+    doc, shift = await asyncio.gather(
+        timed("document", db.documents.find_one({"id": doc_id}, {"_id": 0})),
+        timed("shift", get_current_shift())
+    )
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
@@ -1339,8 +3631,6 @@ async def add_payment(doc_id: str, payment: PaymentCreate):
     if payment.amount <= 0:
         raise HTTPException(status_code=400, detail="Payment amount must be positive")
     
-    shift = await get_current_shift()
-    
     new_payment = Payment(
         **payment.model_dump(),
         document_id=doc_id,
@@ -1351,20 +3641,28 @@ async def add_payment(doc_id: str, payment: PaymentCreate):
     # Use small epsilon for floating-point comparison
     new_status = DocumentStatus.PAID if new_paid_total >= (doc["total"] - 0.01) else DocumentStatus.PARTIALLY_PAID
     
-    await db.documents.update_one(
+    writes = [db.documents.find_one_and_update(
         {"id": doc_id},
         {
             "$push": {"payments": new_payment.model_dump()},
             "$set": {"paid_total": round(new_paid_total, 2), "status": new_status, "updated_at": datetime.now(timezone.utc).isoformat()}
-        }
-    )
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )]
     
     # Update shift
     if shift:
         inc_field = "cash_total" if payment.method == PaymentMethod.CASH else ("card_total" if payment.method == PaymentMethod.CARD else "transfer_total")
-        await db.shifts.update_one({"id": shift["id"]}, {"$inc": {inc_field: payment.amount}})
+        writes.append(db.shifts.update_one({"id": shift["id"]}, {"$inc": {inc_field: payment.amount}}))
     
-    return await db.documents.find_one({"id": doc_id}, {"_id": 0})
+    updated_doc, *_ = await timed("writes", asyncio.gather(*writes))
+    await asyncio.gather(
+        apply_customer_stats(doc.get("customer_id"), (doc, updated_doc)),
+        apply_sales_rollups((doc, updated_doc)),
+        post_ar_entries([ar_entry(doc, "payment", -payment.amount, new_payment.created_at)] if doc.get("customer_id") and doc["doc_type"] in AR_DOC_TYPES else [])
+    )
+    return updated_doc
 
 @api_router.post("/documents/{doc_id}/convert")
 async def convert_document(doc_id: str, target_type: DocumentType = Query(...)):
@@ -1413,7 +3711,11 @@ async def duplicate_document(doc_id: str):
 @api_router.post("/returns")
 async def create_return(return_data: ReturnCreate):
     """Process a return and create a Peppol-compliant credit note"""
-    original_doc = await db.documents.find_one({"id": return_data.original_document_id}, {"_id": 0})
+    # The original document and the shift are independent lookups: run them concurrently
+    original_doc, shift = await asyncio.gather(
+        timed("original", db.documents.find_one({"id": return_data.original_document_id}, {"_id": 0})),
+        timed("shift", get_current_shift())
+    )
     if not original_doc:
         raise HTTPException(status_code=404, detail="Original document not found")
     
@@ -1433,15 +3735,8 @@ async def create_return(return_data: ReturnCreate):
     
     # Create credit note items
     credit_items = []
-    total_refund = 0.0
-    stock_movement_ids = []
     
     for item in return_data.items:
-        line_subtotal = item.qty * item.unit_price
-        line_vat = line_subtotal * (item.vat_rate / 100)
-        line_total = line_subtotal + line_vat
-        total_refund += line_total
-        
         credit_items.append(DocumentItemCreate(
             product_id=item.product_id,
             sku=item.sku,
@@ -1450,23 +3745,20 @@ async def create_return(return_data: ReturnCreate):
             unit_price=-item.unit_price,  # Negative for credit
             vat_rate=item.vat_rate
         ))
-        
-        # Restore stock
-        stock_move = await record_stock_movement(
-            item.product_id, item.sku, StockMovementType.RETURN,
-            item.qty, "return", return_data.original_document_id, item.reason
-        )
-        if stock_move and hasattr(stock_move, 'id'):
-            stock_movement_ids.append(stock_move.id)
     
-    # Generate credit note number
-    credit_note_number = await generate_document_number(DocumentType.CREDIT_NOTE)
+    # Restore stock, then reserve the credit note number once nothing else can refuse it
+    stock_movement_ids = await timed("stock", record_stock_movements(
+        return_data.items, StockMovementType.RETURN, "return", return_data.original_document_id
+    ))
+    try:
+        credit_note_number = await timed("number", generate_document_number(DocumentType.CREDIT_NOTE))
+    except Exception:
+        await revert_stock_movements(stock_movement_ids)
+        raise
     
     # Calculate totals for credit note
-    items, subtotal, vat_total, total = calculate_document_totals(credit_items, None, 0)
-    
-    # Get current shift
-    shift = await get_current_shift()
+    items, subtotal, vat_total, total, vat_breakdown = calculate_document_totals(credit_items, None, 0)
+    total_refund = -total
     shift_id = shift.get("id") if shift else None
     
     # Create Peppol-compliant credit note with proper references
@@ -1483,6 +3775,7 @@ async def create_return(return_data: ReturnCreate):
         subtotal=subtotal,
         vat_total=vat_total,
         total=total,  # Will be negative
+        vat_breakdown=vat_breakdown,
         paid_total=0,
         notes=return_data.notes,
         source_document_id=return_data.original_document_id,
@@ -1494,13 +3787,11 @@ async def create_return(return_data: ReturnCreate):
         stock_movement_created=len(stock_movement_ids) > 0,
         stock_movement_ids=stock_movement_ids,
         shift_id=shift_id,
+        register_number=shift.get("register_number") if shift else None,
         peppol_recipient_id=original_doc.get("peppol_recipient_id")
     )
     
-    credit_note_dict = credit_note.model_dump()
-    await db.documents.insert_one(credit_note_dict)
-    
-    # Process refund payment if specified
+    # Process refund payment if specified (stored with the credit note itself)
     if return_data.refund_method:
         refund_payment = Payment(
             method=return_data.refund_method,
@@ -1508,26 +3799,26 @@ async def create_return(return_data: ReturnCreate):
             document_id=credit_note.id,
             shift_id=shift_id
         )
-        await db.documents.update_one(
-            {"id": credit_note.id},
-            {
-                "$push": {"payments": refund_payment.model_dump()},
-                "$set": {
-                    "paid_total": round(-total_refund, 2),
-                    "status": DocumentStatus.PAID,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
-        )
+        credit_note.payments = [refund_payment]
+        credit_note.paid_total = round(-total_refund, 2)
+        credit_note.status = DocumentStatus.PAID
+        credit_note.updated_at = datetime.now(timezone.utc).isoformat()
+    
+    credit_note_dict = credit_note.model_dump()
+    try:
+        await timed("insert", db.documents.insert_one(credit_note_dict))
+    except Exception:
+        await revert_stock_movements(stock_movement_ids)
+        raise
     
     # Update original document
-    await db.documents.update_one(
+    writes = [db.documents.update_one(
         {"id": return_data.original_document_id},
         {
             "$set": {"status": DocumentStatus.CREDITED, "updated_at": datetime.now(timezone.utc).isoformat()}, 
             "$push": {"related_documents": credit_note.id}
         }
-    )
+    )]
     
     # Update shift refunds
     if shift:
@@ -1536,10 +3827,21 @@ async def create_return(return_data: ReturnCreate):
             refund_inc["cash_total"] = -total_refund
         elif return_data.refund_method == PaymentMethod.CARD:
             refund_inc["card_total"] = -total_refund
-        await db.shifts.update_one({"id": shift["id"]}, {"$inc": refund_inc})
+        writes.append(db.shifts.update_one({"id": shift["id"]}, {"$inc": refund_inc}))
+    
+    writes.append(apply_customer_stats(
+        original_doc.get("customer_id"),
+        (original_doc, {**original_doc, "status": DocumentStatus.CREDITED}),
+        (None, credit_note_dict)
+    ))
+    writes.append(post_ar_entries(ar_entries_for_document(credit_note_dict)))
+    writes.append(apply_sales_rollups(
+        (original_doc, {**original_doc, "status": DocumentStatus.CREDITED}),
+        (None, credit_note_dict)
+    ))
     
     # Audit log for Peppol compliance
-    await log_audit(
+    writes.append(log_audit(
         action=AuditLogAction.CREATE,
         entity_type="credit_note",
         entity_id=credit_note.id,
@@ -1553,9 +3855,12 @@ async def create_return(return_data: ReturnCreate):
             "items_count": len(credit_items),
             "refund_method": return_data.refund_method.value if return_data.refund_method else None
         }
-    )
+    ))
     
-    return await db.documents.find_one({"id": credit_note.id}, {"_id": 0})
+    await timed("followup_writes", asyncio.gather(*writes))
+    
+    credit_note_dict.pop("_id", None)
+    return credit_note_dict
 
 @api_router.post("/documents/{doc_id}/credit-note")
 async def create_credit_note_from_invoice(doc_id: str, credit_data: CreditNoteCreate):
@@ -1656,8 +3961,12 @@ async def get_current_shift_api():
     return shift
 
 @api_router.get("/shifts", response_model=List[Shift])
-async def get_shifts(limit: int = Query(30)):
-    return await db.shifts.find({}, {"_id": 0}).sort("opened_at", -1).to_list(limit)
+async def get_shifts(request: Request, limit: int = Query(30), view: Optional[str] = Query(None), fields: Optional[str] = Query(None)):
+    projection = list_projection(view, fields, Shift, ShiftSummary)
+    shifts = await db.shifts.find({}, projection or {"_id": 0}).sort("opened_at", -1).to_list(limit)
+    if projection:
+        return projected_list_response(request, shifts, view, ShiftSummary)
+    return fast_json_response(request, shifts, model=Shift)
 
 @api_router.get("/shifts/{shift_id}")
 async def get_shift(shift_id: str):
@@ -1694,12 +4003,12 @@ async def get_z_report(shift_id: str):
     # Calculate VAT breakdown
     vat_breakdown = {}
     for doc in docs:
-        for item in doc.get("items", []):
-            rate = str(item.get("vat_rate", 21))
+        for line in document_vat_breakdown(doc):
+            rate = str(line["rate"])
             if rate not in vat_breakdown:
                 vat_breakdown[rate] = {"base": 0, "vat": 0}
-            vat_breakdown[rate]["base"] += item.get("line_subtotal", 0)
-            vat_breakdown[rate]["vat"] += item.get("line_vat", 0)
+            vat_breakdown[rate]["base"] += line["base"]
+            vat_breakdown[rate]["vat"] += line["vat"]
     
     # Count by document type
     doc_counts = {}
@@ -1733,7 +4042,9 @@ async def get_z_report(shift_id: str):
 async def get_stock_movements(
     product_id: Optional[str] = Query(None),
     movement_type: Optional[StockMovementType] = Query(None),
-    limit: int = Query(100)
+    limit: int = Query(100, le=500),
+    cursor: Optional[str] = Query(None),
+    request: Request = None
 ):
     query = {}
     if product_id:
@@ -1741,7 +4052,8 @@ async def get_stock_movements(
     if movement_type:
         query["type"] = movement_type
     
-    return await db.stock_movements.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
+    movements, next_cursor = await keyset_page(db.stock_movements, query, {"_id": 0}, limit, cursor)
+    return fast_json_response(request, movements, cursor_headers(next_cursor))
 
 @api_router.post("/stock-adjustments")
 async def create_stock_adjustment(
@@ -1815,13 +4127,16 @@ async def create_sale_legacy(sale_data: Dict[str, Any] = Body(...)):
     }
 
 @api_router.get("/sales")
-async def get_sales_legacy(limit: int = Query(50)):
+async def get_sales_legacy(request: Request, limit: int = Query(50), view: Optional[str] = Query(None), fields: Optional[str] = Query(None)):
     """Legacy endpoint - returns invoices/receipts"""
+    projection = list_projection(view, fields, Document, DocumentSummary)
     docs = await db.documents.find(
         {"doc_type": {"$in": [DocumentType.INVOICE, DocumentType.RECEIPT]}},
-        {"_id": 0}
+        projection or {"_id": 0}
     ).sort("created_at", -1).to_list(limit)
-    return docs
+    if projection:
+        return projected_list_response(request, docs, view, DocumentSummary)
+    return fast_json_response(request, docs, model=Document)
 
 # --- PDF Generation ---
 @api_router.get("/documents/{doc_id}/pdf")
@@ -2067,8 +4382,12 @@ async def send_document_to_peppol(document_id: str):
     """Send invoice to Peppol network via Peppyrus"""
     import requests
     
-    # Get document
-    doc = await db.documents.find_one({"id": document_id}, {"_id": 0})
+    # Get document, Peppyrus settings and company settings concurrently
+    doc, peppyrus, company = await asyncio.gather(
+        timed("document", db.documents.find_one({"id": document_id}, {"_id": 0})),
+        timed("peppyrus_settings", db.peppyrus_settings.find_one({}, {"_id": 0})),
+        timed("company_settings", db.company_settings.find_one({}, {"_id": 0}))
+    )
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
@@ -2078,20 +4397,16 @@ async def send_document_to_peppol(document_id: str):
     if doc.get("peppol_sent"):
         raise HTTPException(status_code=400, detail="Document already sent via Peppol")
     
-    # Get Peppyrus settings
-    peppyrus = await db.peppyrus_settings.find_one({}, {"_id": 0})
     if not peppyrus or not peppyrus.get("enabled"):
         raise HTTPException(status_code=400, detail="Peppyrus not configured or disabled")
     
-    # Get company settings
-    company = await db.company_settings.find_one({}, {"_id": 0})
     if not company:
         raise HTTPException(status_code=400, detail="Company settings not configured")
     
     # Get customer
     customer = None
     if doc.get("customer_id"):
-        customer = await db.customers.find_one({"id": doc["customer_id"]}, {"_id": 0})
+        customer = await timed("customer", db.customers.find_one({"id": doc["customer_id"]}, {"_id": 0}))
     
     if not customer:
         raise HTTPException(status_code=400, detail="Customer not found")
@@ -2311,13 +4626,7 @@ def generate_ubl_invoice(doc: dict, company: dict, customer: dict) -> str:
     tax_amount.text = f"{doc.get('vat_total', 0):.2f}"
     
     # Group items by VAT rate
-    vat_groups = {}
-    for item in doc.get("items", []):
-        rate = item.get("vat_rate", 21)
-        if rate not in vat_groups:
-            vat_groups[rate] = {"base": 0, "vat": 0}
-        vat_groups[rate]["base"] += item.get("line_subtotal", 0)
-        vat_groups[rate]["vat"] += item.get("line_vat", 0)
+    vat_groups = {line["rate"]: line for line in document_vat_breakdown(doc)}
     
     for rate, amounts in vat_groups.items():
         subtotal = SubElement(tax_total, "{%s}TaxSubtotal" % ns["cac"])
@@ -2398,9 +4707,15 @@ async def get_audit_logs(
     action: Optional[str] = Query(None),
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
-    limit: int = Query(100, le=500)
+    limit: int = Query(100, le=500),
+    view: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    request: Request = None
 ):
     """Get audit logs for Peppol compliance and traceability"""
+    await audit_buffer.flush()
+    projection = list_projection(view, fields, AuditLog, AuditLogSummary)
     query = {}
     
     if entity_type:
@@ -2414,12 +4729,15 @@ async def get_audit_logs(
     if date_to:
         query.setdefault("created_at", {})["$lte"] = date_to
     
-    logs = await db.audit_logs.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
-    return logs
+    logs, next_cursor = await keyset_page(db.audit_logs, query, projection or {"_id": 0}, limit, cursor)
+    if projection:
+        return projected_list_response(request, logs, view, AuditLogSummary, cursor_headers(next_cursor))
+    return fast_json_response(request, logs, cursor_headers(next_cursor))
 
 @api_router.get("/audit-logs/document/{doc_id}")
 async def get_document_audit_trail(doc_id: str):
     """Get complete audit trail for a document (Peppol requirement)"""
+    await audit_buffer.flush()
     # Get the document
     doc = await db.documents.find_one({"id": doc_id}, {"_id": 0})
     if not doc:
@@ -2458,6 +4776,7 @@ async def get_audit_summary(
     date_to: Optional[str] = Query(None)
 ):
     """Get audit log summary statistics"""
+    await audit_buffer.flush()
     query = {}
     if date_from:
         query["created_at"] = {"$gte": date_from}
@@ -2554,6 +4873,7 @@ async def sync_shopify_products():
         else:
             raise HTTPException(status_code=400, detail="No valid authentication credentials")
         
+        category_deltas = {}  # Category counters, applied once after the loop
         items_processed = 0
         items_succeeded = 0
         items_failed = 0
@@ -2859,6 +5179,7 @@ async def sync_shopify_products():
                             {"id": existing["id"]},
                             {"$set": product_data}
                         )
+                        add_category_delta(category_deltas, existing, {**existing, **product_data})
                         items_succeeded += 1
                     else:
                         # Create new product
@@ -2868,8 +5189,13 @@ async def sync_shopify_products():
                             created_at=datetime.now(timezone.utc).isoformat()
                         )
                         await db.products.insert_one(new_product.model_dump())
+                        add_category_delta(category_deltas, None, product_data)
                         items_succeeded += 1
         
+        await apply_category_counts(category_deltas)
+        await product_search_index.load()
+        product_scan_cache.clear()
+        
         # Log success
         log = ShopifySyncLog(
             sync_type="product_import",
@@ -2895,6 +5221,10 @@ async def sync_shopify_products():
         
     except Exception as e:
         logger.error(f"Shopify sync error: {str(e)}")
+        # Products written before the failure must still be counted and searchable
+        await recount_category_counts()
+        await product_search_index.load()
+        product_scan_cache.clear()
         
         # Log failure
         log = ShopifySyncLog(
@@ -3039,133 +5369,656 @@ async def sync_shopify_orders():
     
     return {"status": "success", "message": "Order sync placeholder executed"}
 
-# ============= REPORTS API =============
-@api_router.get("/reports/dashboard")
-async def get_reports_dashboard(date_from: Optional[str] = None, date_to: Optional[str] = None):
-    """Get dashboard statistics for reports"""
-    # Build date query
-    date_query = {}
-    if date_from:
-        date_query["$gte"] = date_from
-    if date_to:
-        date_query["$lte"] = date_to + "T23:59:59"
-    
-    query = {}
-    if date_query:
-        query["created_at"] = date_query
-    
-    # Get documents for period
-    docs = await db.documents.find(
-        {**query, "doc_type": {"$in": ["invoice", "receipt"]}},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    # Calculate totals
-    total_sales = sum(d.get("total", 0) for d in docs if d.get("status") in ["paid", "partially_paid"])
-    transactions_count = len(docs)
-    products_sold = sum(sum(item.get("qty", 0) for item in d.get("items", [])) for d in docs)
-    
-    # Get unique customers
-    customer_ids = set(d.get("customer_id") for d in docs if d.get("customer_id"))
-    active_customers = len(customer_ids)
-    
-    # Calculate previous period for comparison
-    # (simplified - just show zeros for now if no comparison data)
+# ============= PRODUCT THUMBNAILS =============
+THUMBNAIL_CACHE_DIR = Path(os.environ.get("THUMBNAIL_CACHE_DIR", str(ROOT_DIR / "thumbnail_cache")))
+THUMBNAIL_CACHE_MAX_MB = int(os.environ.get("THUMBNAIL_CACHE_MAX_MB", "512"))
+THUMBNAIL_SIZES = (64, 128, 256, 512)
+THUMBNAIL_MAX_SOURCE_BYTES = 15 * 1024 * 1024
+THUMBNAIL_MAX_REDIRECTS = 3
+THUMBNAIL_CACHE_SECONDS = 7 * 24 * 3600
+# Image hosts fetched even though they resolve to a private address (e.g. a LAN image server)
+THUMBNAIL_ALLOWED_HOSTS = {h.strip().lower() for h in os.environ.get("THUMBNAIL_ALLOWED_HOSTS", "").split(",") if h.strip()}
+
+def check_image_url(url: str) -> str:
+    """Refuse image URLs that would make the server fetch from itself or the internal network.
+    
+    Returns the checked address: the download connects to it rather than resolving
+    the name again, which a rebinding DNS server could answer with an internal one.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("Image URL must be http(s) with a host")
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    addresses = [address[0].split("%")[0] for *_, address in socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)]
+    if parts.hostname.lower() not in THUMBNAIL_ALLOWED_HOSTS:
+        for address in addresses:
+            if not ipaddress.ip_address(address).is_global:
+                raise ValueError(f"Image host {parts.hostname} is not a public address")
+    return addresses[0]
+
+def pinned_get(session, url: str, address: str):
+    """GET `url` from `address` without resolving its host again or following redirects.
+    
+    The request goes to the IP with the original Host header; for https the
+    certificate is still checked against (and SNI sent for) the host name.
+    """
+    parts = urlsplit(url)
+    host = f"[{address}]" if ":" in address else address
+    pinned = parts._replace(netloc=host + (f":{parts.port}" if parts.port else "")).geturl()
+    session.trust_env = False  # A proxy would resolve the name itself
+    if parts.scheme == "https":
+        session.get_adapter(pinned).poolmanager.connection_pool_kw.update(
+            server_hostname=parts.hostname, assert_hostname=parts.hostname
+        )
+    return session.get(pinned, headers={"Host": parts.netloc.rpartition("@")[2]}, timeout=10, stream=True, allow_redirects=False)
+
+def thumbnail_etag(digest: str, size: int) -> str:
+    return f'"{digest[:32]}-{size}"'
+
+class ThumbnailCache:
+    """Content-addressed disk cache of product image thumbnails.
+    
+    Sources are downloaded once and stored under the SHA-256 of their bytes
+    (sources/), thumbnails under that digest and the size (thumbs/); refs/ maps a
+    source URL to its digest, so products sharing an image share the files.
+    Downloads and Pillow resizes run in a small thread pool. When the cache grows
+    past THUMBNAIL_CACHE_MAX_MB, least recently used files are removed down to 90%
+    of the budget. Recency is kept in an in-memory index (filled once from the
+    files' mtimes, which every hit touches so the order survives a restart).
+    """
+    
+    def __init__(self, root: Path, max_bytes: int, workers: int = 2):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+        self._locks: Dict[str, List] = {}  # key -> [lock, holders and waiters], dropped when unused
+        self._files: Optional[OrderedDict] = None  # path -> size, least recently used first
+        self._size = 0
+        self.format = "WEBP" if pil_features.check("webp") else "JPEG"
+    
+    def _path(self, kind: str, name: str) -> Path:
+        return self.root / kind / name[:2] / name
+    
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    
+    @asynccontextmanager
+    async def _lock(self, key: str):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+    
+    @staticmethod
+    def _download(url: str) -> bytes:
+        import requests
+        
+        # Redirects are followed by hand so every hop goes through check_image_url
+        for _ in range(THUMBNAIL_MAX_REDIRECTS + 1):
+            with requests.Session() as session:
+                response = pinned_get(session, url, check_image_url(url))
+                if response.is_redirect:
+                    response.close()
+                    url = urljoin(url, response.headers["location"])
+                    continue
+                with response:
+                    response.raise_for_status()
+                    if int(response.headers.get("content-length") or 0) > THUMBNAIL_MAX_SOURCE_BYTES:
+                        raise ValueError("Image too large")
+                    data = bytearray()
+                    for chunk in response.iter_content(64 * 1024):
+                        data += chunk
+                        if len(data) > THUMBNAIL_MAX_SOURCE_BYTES:
+                            raise ValueError("Image too large")
+                return bytes(data)
+        raise ValueError("Too many redirects")
+    
+    def _resize(self, source: bytes, size: int) -> bytes:
+        with Image.open(BytesIO(source)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            if self.format == "JPEG" or image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGB" if self.format == "JPEG" else "RGBA")
+            out = BytesIO()
+            image.save(out, self.format, quality=82)
+        return out.getvalue()
+    
+    def _write(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    
+    def _read(self, path: Path) -> Optional[bytes]:
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # Recently used: evicted last, also after a restart
+        return data
+    
+    def _scan(self) -> List[Tuple[float, int, Path]]:
+        files = []
+        for path in self.root.rglob("*"):
+            if path.is_file() and not path.name.endswith(".tmp"):
+                stat = path.stat()
+                files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(files)
+    
+    async def _index(self) -> OrderedDict:
+        if self._files is None:
+            files = await self._run(self._scan)
+            if self._files is None:
+                self._files = OrderedDict((path, size) for _, size, path in files)
+                self._size = sum(self._files.values())
+        return self._files
+    
+    async def _load(self, path: Path) -> Optional[bytes]:
+        data = await self._run(self._read, path)
+        files = await self._index()
+        if data is None:
+            self._size -= files.pop(path, 0)
+        elif path in files:
+            files.move_to_end(path)
+        return data
+    
+    async def _store(self, path: Path, data: bytes):
+        await self._run(self._write, path, data)
+        files = await self._index()
+        self._size += len(data) - files.pop(path, 0)
+        files[path] = len(data)
+        if self._size > self.max_bytes:
+            target = int(self.max_bytes * 0.9)
+            evicted = []
+            while self._size > target and len(files) > 1:
+                old, size = files.popitem(last=False)
+                evicted.append(old)
+                self._size -= size
+            await self._run(lambda: [old.unlink(missing_ok=True) for old in evicted])
+    
+    async def _source_digest(self, url: str) -> str:
+        url_key = hashlib.sha256(url.encode()).hexdigest()
+        ref_path = self._path("refs", url_key)
+        async with self._lock("url:" + url_key):
+            ref = await self._load(ref_path)
+            if ref and (self._path("sources", ref.decode()).exists()):
+                return ref.decode()
+            source = await self._run(self._download, url)
+            digest = hashlib.sha256(source).hexdigest()
+            await self._store(self._path("sources", digest), source)
+            await self._store(ref_path, digest.encode())
+            return digest
+    
+    async def known_digest(self, url: str) -> Optional[str]:
+        """Digest of the source at `url` if it is cached, without downloading anything"""
+        ref = await self._load(self._path("refs", hashlib.sha256(url.encode()).hexdigest()))
+        return ref.decode() if ref else None
+    
+    async def get(self, url: str, size: int):
+        """(thumbnail bytes, digest) for the image at `url`, downloading/resizing on a miss"""
+        digest = await self._source_digest(url)
+        name = f"{digest}-{size}.{self.format.lower()}"
+        path = self._path("thumbs", name)
+        async with self._lock("thumb:" + name):
+            data = await self._load(path)
+            if data is None:
+                source = await self._load(self._path("sources", digest))
+                if source is None:  # Evicted between the two steps
+                    source = await self._run(self._download, url)
+                data = await self._run(self._resize, source, size)
+                await self._store(path, data)
+        return data, digest
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_MB * 1024 * 1024)
+
+@api_router.get("/products/{product_id}/thumbnail")
+async def get_product_thumbnail(product_id: str, size: int = Query(256), if_none_match: Optional[str] = Header(None)):
+    """Resized product image (square bounding box of `size` px) from the local cache"""
+    if size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of {', '.join(map(str, THUMBNAIL_SIZES))}")
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "image_url": 1})
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    url = product.get("image_url")
+    if not url or not url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=404, detail="Product has no image")
     
-    # Top products
-    product_counts = {}
-    for doc in docs:
-        for item in doc.get("items", []):
-            pid = item.get("product_id", item.get("sku"))
-            if pid:
-                if pid not in product_counts:
-                    product_counts[pid] = {"name": item.get("name"), "qty": 0, "revenue": 0}
-                product_counts[pid]["qty"] += item.get("qty", 0)
-                product_counts[pid]["revenue"] += item.get("line_subtotal", item.get("qty", 0) * item.get("unit_price", 0))
+    # A revalidation is answered from the source digest alone: no read, resize or download
+    cache_headers = {"Cache-Control": f"public, max-age={THUMBNAIL_CACHE_SECONDS}"}
+    digest = await thumbnail_cache.known_digest(url) if if_none_match else None
+    if digest and if_none_match == thumbnail_etag(digest, size):
+        return Response(status_code=304, headers={"ETag": if_none_match, **cache_headers})
     
-    top_products = sorted(product_counts.values(), key=lambda x: x["revenue"], reverse=True)[:10]
+    try:
+        data, digest = await thumbnail_cache.get(url, size)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # requests errors are OSErrors; Pillow raises UnidentifiedImageError (OSError) on non-images
+        logger.warning(f"Thumbnail for product {product_id} failed: {str(e)}")
+        raise HTTPException(status_code=502, detail="Product image could not be loaded")
+    
+    etag = thumbnail_etag(digest, size)
+    headers = {"ETag": etag, **cache_headers}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=f"image/{thumbnail_cache.format.lower()}", headers=headers)
+
+# ============= EXPORTS =============
+# Full exports stream straight from the Motor cursor: rows are serialised batch by
+# batch, so memory stays flat whatever the date range.
+EXPORT_BATCH_SIZE = 500
+
+DOCUMENT_EXPORT_FIELDS = [
+    "id", "number", "doc_type", "status", "created_at", "customer_id", "customer_name",
+    "customer_vat", "subtotal", "vat_total", "total", "paid_total", "shift_id",
+    "source_document_id", "reference_invoice_number"
+]
+DOCUMENT_LINE_EXPORT_FIELDS = [
+    "document_id", "number", "doc_type", "status", "created_at", "customer_id", "customer_name",
+    "line_id", "product_id", "sku", "name", "qty", "unit", "unit_price", "discount_type",
+    "discount_value", "vat_rate", "line_subtotal", "line_vat", "line_total"
+]
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def _document_lines(doc: Dict[str, Any]):
+    header = {
+        "document_id": doc.get("id"),
+        **{key: doc.get(key) for key in ("number", "doc_type", "status", "created_at", "customer_id", "customer_name")}
+    }
+    for item in doc.get("items", []):
+        row = {**header, **{key: item.get(key) for key in DOCUMENT_LINE_EXPORT_FIELDS[7:]}}
+        row["line_id"] = item.get("id")
+        yield row
+
+async def _export_rows(query: Dict[str, Any], lines: bool):
+    fields = ["items"] + DOCUMENT_LINE_EXPORT_FIELDS[:7] if lines else DOCUMENT_EXPORT_FIELDS
+    projection = {"_id": 0, "id": 1, **{name: 1 for name in fields if name != "document_id"}}
+    cursor = db.documents.find(query, projection).sort([("created_at", 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        if lines:
+            for row in _document_lines(doc):
+                yield row
+        else:
+            yield {key: doc.get(key) for key in DOCUMENT_EXPORT_FIELDS}
+
+async def _serialise_rows(rows, fields: List[str], export_format: str):
+    """Encode rows as NDJSON or CSV, one chunk per EXPORT_BATCH_SIZE rows"""
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore") if export_format == "csv" else None
+    if writer:
+        writer.writeheader()
+    count = 0
+    async for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, default=str, ensure_ascii=False))
+            buffer.write("\n")
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def _export_response(rows, fields: List[str], export_format: str, name: str) -> StreamingResponse:
+    filename = f"{name}-{datetime.now(timezone.utc).strftime('%Y%m%d')}.{export_format}"
+    return StreamingResponse(
+        _serialise_rows(rows, fields, export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.get("/exports/documents")
+async def export_documents(
+    doc_type: Optional[DocumentType] = Query(None),
+    status: Optional[DocumentStatus] = Query(None),
+    customer_id: Optional[str] = Query(None),
+    search: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    shift_id: Optional[str] = Query(None),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$")
+):
+    """Stream every matching document, one row per document (oldest first)"""
+    query = build_document_query(doc_type, status, customer_id, search, date_from, date_to, shift_id)
+    return _export_response(_export_rows(query, lines=False), DOCUMENT_EXPORT_FIELDS, format, "documents")
+
+@api_router.get("/exports/document-lines")
+async def export_document_lines(
+    doc_type: Optional[DocumentType] = Query(None),
+    status: Optional[DocumentStatus] = Query(None),
+    customer_id: Optional[str] = Query(None),
+    search: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    shift_id: Optional[str] = Query(None),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$")
+):
+    """Stream the line items of every matching document, one row per item"""
+    query = build_document_query(doc_type, status, customer_id, search, date_from, date_to, shift_id)
+    return _export_response(_export_rows(query, lines=True), DOCUMENT_LINE_EXPORT_FIELDS, format, "document-lines")
+
+# ============= REPORTS API =============
+@api_router.get("/reports/receivables")
+async def get_receivables_report(customer_id: Optional[str] = Query(None), limit: int = Query(50, ge=1, le=500)):
+    """Outstanding balances with 0-30 / 31-60 / 61-90 / 90+ day aging, from the open ledger items only"""
+    aging = await receivables_aging(customer_id)
+    customers = {
+        c["id"]: c for c in await db.customers.find(
+            {"id": {"$in": [a["_id"] for a in aging[:limit]]}},
+            {"_id": 0, "id": 1, "name": 1, "type": 1, "credit_limit": 1, "balance": 1}
+        ).to_list(limit)
+    }
+    bucket_names = [name for name, _ in AR_AGING_BUCKETS]
+    return {
+        "as_of": datetime.now(timezone.utc).isoformat(),
+        "total_outstanding": round(sum(a["open"] for a in aging), 2),
+        "customers_count": len(aging),
+        "aging": {name: round(sum(a[name] for a in aging), 2) for name in bucket_names},
+        "customers": [
+            {
+                "customer_id": a["_id"],
+                "name": customers.get(a["_id"], {}).get("name"),
+                "balance": customers.get(a["_id"], {}).get("balance", 0),
+                "credit_limit": customers.get(a["_id"], {}).get("credit_limit", 0),
+                "open_amount": round(a["open"], 2),
+                "open_documents": a["documents"],
+                "aging": {name: round(a[name], 2) for name in bucket_names}
+            }
+            for a in aging[:limit]
+        ]
+    }
+
+# Per-rate lines of a document: the stored vat_breakdown, or rebuilt from the items for
+# documents created before it was stored (same fallback as document_vat_breakdown: one
+# line per distinct rate, summing the items at that rate)
+VAT_ITEM_RATE = {"$ifNull": ["$$item.vat_rate", 21]}
+
+VAT_LINES_EXPRESSION = {"$cond": [
+    {"$gt": [{"$size": {"$ifNull": ["$vat_breakdown", []]}}, 0]},
+    "$vat_breakdown",
+    {"$let": {"vars": {"items": {"$ifNull": ["$items", []]}}, "in": {"$map": {
+        "input": {"$setUnion": [{"$map": {"input": "$$items", "as": "item", "in": VAT_ITEM_RATE}}]},
+        "as": "rate",
+        "in": {"$let": {
+            "vars": {"rate_items": {"$filter": {"input": "$$items", "as": "item", "cond": {"$eq": [VAT_ITEM_RATE, "$$rate"]}}}},
+            "in": {
+                "rate": "$$rate",
+                "base": {"$sum": "$$rate_items.line_subtotal"},
+                "vat": {"$sum": "$$rate_items.line_vat"},
+                "total": {"$sum": "$$rate_items.line_total"}
+            }
+        }}
+    }}}}
+]}
+
+def dashboard_pipeline(date_from: Optional[str], date_to: Optional[str]) -> List[Dict[str, Any]]:
+    """One $match on (doc_type, created_at) and a $facet per dashboard block"""
+    return [
+        {"$match": {"doc_type": {"$in": ["invoice", "receipt"]}, **report_date_query(date_from, date_to)}},
+        {"$facet": {
+            "summary": [{"$group": {
+                "_id": None,
+                "total_sales": {"$sum": {"$cond": [{"$in": ["$status", ["paid", "partially_paid"]]}, "$total", 0]}},
+                "transactions_count": {"$sum": 1},
+                "products_sold": {"$sum": {"$sum": "$items.qty"}}
+            }}],
+            "customers": [
+                {"$match": {"customer_id": {"$nin": [None, ""]}}},
+                {"$group": {"_id": "$customer_id"}},
+                {"$count": "active_customers"}
+            ],
+            "top_products": [
+                {"$unwind": "$items"},
+                {"$group": {
+                    "_id": {"$ifNull": ["$items.product_id", "$items.sku"]},
+                    "name": {"$first": "$items.name"},
+                    "qty": {"$sum": "$items.qty"},
+                    "revenue": {"$sum": {"$ifNull": ["$items.line_subtotal", {"$multiply": ["$items.qty", "$items.unit_price"]}]}}
+                }},
+                {"$match": {"_id": {"$ne": None}}},
+                {"$sort": {"revenue": -1}},
+                {"$limit": 10}
+            ],
+            "payment_methods": [
+                {"$unwind": "$payments"},
+                {"$group": {"_id": {"$ifNull": ["$payments.method", "cash"]}, "amount": {"$sum": "$payments.amount"}}}
+            ],
+            "daily_trend": [
+                {"$group": {"_id": {"$substr": ["$created_at", 0, 10]}, "total": {"$sum": "$total"}, "count": {"$sum": 1}}},
+                {"$sort": {"_id": 1}}
+            ],
+            "vat_breakdown": [
+                {"$project": {"lines": VAT_LINES_EXPRESSION}},
+                {"$unwind": "$lines"},
+                {"$group": {"_id": "$lines.rate", "base": {"$sum": "$lines.base"}, "vat": {"$sum": "$lines.vat"}}}
+            ]
+        }}
+    ]
+
+def dashboard_from_facets(facets: Dict[str, Any]) -> Dict[str, Any]:
+    summary = facets["summary"][0] if facets["summary"] else {}
+    total_sales = summary.get("total_sales", 0)
+    transactions_count = summary.get("transactions_count", 0)
     
-    # Sales by payment method
     payment_methods = {"cash": 0, "card": 0, "bank_transfer": 0}
-    for doc in docs:
-        for payment in doc.get("payments", []):
-            method = payment.get("method", "cash")
-            payment_methods[method] = payment_methods.get(method, 0) + payment.get("amount", 0)
+    for row in facets["payment_methods"]:
+        payment_methods[row["_id"]] = row["amount"]
     
-    # Daily sales trend
-    daily_sales = {}
-    for doc in docs:
-        date = doc.get("created_at", "")[:10]
-        if date:
-            if date not in daily_sales:
-                daily_sales[date] = {"date": date, "total": 0, "count": 0}
-            daily_sales[date]["total"] += doc.get("total", 0)
-            daily_sales[date]["count"] += 1
-    
-    daily_trend = sorted(daily_sales.values(), key=lambda x: x["date"])
-    
-    # VAT breakdown
+    # Rates are reported as whole-number strings; 6 and 6.0 land in the same row
     vat_breakdown = {}
-    for doc in docs:
-        for item in doc.get("items", []):
-            rate = str(int(item.get("vat_rate", 21)))
-            if rate not in vat_breakdown:
-                vat_breakdown[rate] = {"rate": rate, "base": 0, "vat": 0}
-            vat_breakdown[rate]["base"] += item.get("line_subtotal", 0)
-            vat_breakdown[rate]["vat"] += item.get("line_vat", 0)
+    for row in facets["vat_breakdown"]:
+        rate = str(int(row["_id"]))
+        entry = vat_breakdown.setdefault(rate, {"rate": rate, "base": 0, "vat": 0})
+        entry["base"] += row["base"]
+        entry["vat"] += row["vat"]
     
     return {
         "summary": {
             "total_sales": round(total_sales, 2),
             "transactions_count": transactions_count,
-            "products_sold": int(products_sold),
-            "active_customers": active_customers,
+            "products_sold": int(summary.get("products_sold", 0)),
+            "active_customers": facets["customers"][0]["active_customers"] if facets["customers"] else 0,
             "average_ticket": round(total_sales / transactions_count, 2) if transactions_count > 0 else 0
         },
-        "top_products": top_products,
+        "top_products": [{"name": p["name"], "qty": p["qty"], "revenue": p["revenue"]} for p in facets["top_products"]],
         "payment_methods": payment_methods,
-        "daily_trend": daily_trend,
+        "daily_trend": [{"date": d["_id"], "total": d["total"], "count": d["count"]} for d in facets["daily_trend"]],
         "vat_breakdown": list(vat_breakdown.values())
     }
 
-@api_router.get("/reports/vat")
-async def get_vat_report(date_from: Optional[str] = None, date_to: Optional[str] = None):
-    """Get VAT report for accounting"""
-    date_query = {}
-    if date_from:
-        date_query["$gte"] = date_from
-    if date_to:
-        date_query["$lte"] = date_to + "T23:59:59"
+def dashboard_from_rollups(rows: List[Dict[str, Any]], active_customers: int) -> Dict[str, Any]:
+    """Same output as dashboard_from_facets, summed from sales_daily rows"""
+    total_sales = sum(r.get("paid_revenue", 0) for r in rows)
+    transactions_count = sum(r.get("count", 0) for r in rows)
     
-    query = {"doc_type": {"$in": ["invoice", "receipt"]}}
-    if date_query:
-        query["created_at"] = date_query
-    
-    docs = await db.documents.find(query, {"_id": 0}).to_list(10000)
+    products: Dict[str, Dict[str, Any]] = {}
+    payment_methods = {"cash": 0, "card": 0, "bank_transfer": 0}
+    daily: Dict[str, Dict[str, Any]] = {}
+    vat_breakdown: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        for key, p in row.get("products", {}).items():
+            entry = products.setdefault(key, {"name": p.get("name"), "qty": 0, "revenue": 0})
+            entry["qty"] += p.get("qty", 0)
+            entry["revenue"] += p.get("revenue", 0)
+        for method, amount in row.get("payments", {}).items():
+            payment_methods[method] = payment_methods.get(method, 0) + amount
+        day = daily.setdefault(row["date"], {"date": row["date"], "total": 0, "count": 0})
+        day["total"] += row.get("revenue", 0)
+        day["count"] += row.get("count", 0)
+        for line in row.get("vat", {}).values():
+            rate = str(int(line["rate"]))
+            entry = vat_breakdown.setdefault(rate, {"rate": rate, "base": 0, "vat": 0})
+            entry["base"] += line.get("base", 0)
+            entry["vat"] += line.get("vat", 0)
     
-    vat_breakdown = {}
-    for doc in docs:
-        for item in doc.get("items", []):
-            rate = str(int(item.get("vat_rate", 21)))
-            if rate not in vat_breakdown:
-                vat_breakdown[rate] = {"rate": int(rate), "base": 0, "vat": 0, "total": 0}
-            vat_breakdown[rate]["base"] += item.get("line_subtotal", 0)
-            vat_breakdown[rate]["vat"] += item.get("line_vat", 0)
-            vat_breakdown[rate]["total"] += item.get("line_total", 0)
-    
-    totals = {
-        "base": sum(v["base"] for v in vat_breakdown.values()),
-        "vat": sum(v["vat"] for v in vat_breakdown.values()),
-        "total": sum(v["total"] for v in vat_breakdown.values())
+    return {
+        "summary": {
+            "total_sales": round(total_sales, 2),
+            "transactions_count": transactions_count,
+            "products_sold": int(sum(r.get("items_sold", 0) for r in rows)),
+            "active_customers": active_customers,
+            "average_ticket": round(total_sales / transactions_count, 2) if transactions_count > 0 else 0
+        },
+        "top_products": sorted(products.values(), key=lambda x: x["revenue"], reverse=True)[:10],
+        "payment_methods": payment_methods,
+        "daily_trend": sorted(daily.values(), key=lambda x: x["date"]),
+        "vat_breakdown": list(vat_breakdown.values())
     }
+
+@api_router.get("/reports/dashboard")
+async def get_reports_dashboard(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    source: str = Query("rollups", pattern="^(documents|rollups)$")
+):
+    """Get dashboard statistics for reports, from the sales_daily rows (source=documents
+    aggregates the documents themselves)"""
+    if source == "rollups":
+        rows, active_customers = await asyncio.gather(
+            read_sales_rollups(date_from, date_to, ["invoice", "receipt"]),
+            count_rollup_customers(date_from, date_to, ["invoice", "receipt"])
+        )
+        return dashboard_from_rollups(rows, active_customers)
+    facets = await db.documents.aggregate(dashboard_pipeline(date_from, date_to)).to_list(1)
+    return dashboard_from_facets(facets[0])
+
+# Belgian periodic VAT return: sales bases per rate (grids 00-03), VAT due on them (54),
+# credit notes issued (49) and the VAT they give back (64)
+VAT_REPORT_DOC_TYPES = ["invoice", "receipt", "credit_note"]
+BELGIAN_VAT_BASE_GRIDS = {0: "00", 6: "01", 12: "02", 21: "03"}
+BELGIAN_VAT_GRIDS = ["00", "01", "02", "03", "54", "49", "64"]
+VAT_LINE_EXPORT_FIELDS = [
+    "document_id", "number", "doc_type", "status", "created_at", "customer_id", "customer_name",
+    "customer_vat", "rate", "base", "vat", "total"
+]
+
+def vat_rate_value(rate: float):
+    return int(rate) if float(rate).is_integer() else float(rate)
+
+def vat_report_pipeline(date_from: Optional[str], date_to: Optional[str]) -> List[Dict[str, Any]]:
+    """Per-(rate, doc_type) sums over the per-rate lines of every document in the period"""
+    return [
+        {"$match": {"doc_type": {"$in": VAT_REPORT_DOC_TYPES}, **report_date_query(date_from, date_to)}},
+        {"$facet": {
+            "lines": [
+                {"$project": {"doc_type": 1, "lines": VAT_LINES_EXPRESSION}},
+                {"$unwind": "$lines"},
+                {"$group": {
+                    "_id": {"rate": "$lines.rate", "doc_type": "$doc_type"},
+                    "base": {"$sum": "$lines.base"},
+                    "vat": {"$sum": "$lines.vat"},
+                    "total": {"$sum": "$lines.total"}
+                }}
+            ],
+            "documents": [{"$group": {"_id": "$doc_type", "count": {"$sum": 1}}}]
+        }}
+    ]
+
+def vat_report_from_groups(groups: List[Dict[str, Any]], counts: Dict[str, int], date_from: Optional[str], date_to: Optional[str]) -> Dict[str, Any]:
+    """Net credit notes against sales per rate and fill the return grids.
+    
+    `groups` are {rate, doc_type, base, vat, total} sums; credit note amounts are
+    negative, so adding them nets them.
+    """
+    rates: Dict[Any, Dict[str, Any]] = {}
+    by_doc_type: Dict[str, Dict[str, Any]] = {}
+    grids = {grid: 0.0 for grid in BELGIAN_VAT_GRIDS}
+    unmapped = set()
+    for group in groups:
+        rate = vat_rate_value(group["rate"])
+        doc_type = DocumentType(group["doc_type"]).value
+        side = "credit_notes" if doc_type == "credit_note" else "sales"
+        entry = rates.setdefault(rate, {
+            "rate": rate, "base": 0, "vat": 0, "total": 0,
+            "sales": {"base": 0, "vat": 0}, "credit_notes": {"base": 0, "vat": 0}
+        })
+        per_type = by_doc_type.setdefault(doc_type, {"documents": counts.get(doc_type, 0), "base": 0, "vat": 0, "total": 0})
+        for field in ("base", "vat", "total"):
+            entry[field] += group[field]
+            per_type[field] += group[field]
+        entry[side]["base"] += group["base"]
+        entry[side]["vat"] += group["vat"]
+        if side == "credit_notes":
+            grids["49"] -= group["base"]
+            grids["64"] -= group["vat"]
+        elif rate in BELGIAN_VAT_BASE_GRIDS:
+            grids[BELGIAN_VAT_BASE_GRIDS[rate]] += group["base"]
+            grids["54"] += group["vat"]
+        else:
+            unmapped.add(rate)
+    
+    def rounded(values: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: rounded(v) if isinstance(v, dict) else (round(v, 2) if isinstance(v, float) else v) for k, v in values.items()}
     
+    breakdown = [rounded(rates[rate]) for rate in sorted(rates)]
     return {
         "period": {"from": date_from, "to": date_to},
-        "breakdown": list(vat_breakdown.values()),
-        "totals": {k: round(v, 2) for k, v in totals.items()},
-        "documents_count": len(docs)
+        "breakdown": breakdown,
+        "by_doc_type": {doc_type: rounded(values) for doc_type, values in by_doc_type.items()},
+        "totals": {field: round(sum(rates[r][field] for r in rates), 2) for field in ("base", "vat", "total")},
+        "grids": {grid: round(value, 2) for grid, value in grids.items()},
+        "unmapped_rates": sorted(unmapped),
+        "documents_count": sum(counts.values())
     }
 
+@api_router.get("/reports/vat")
+async def get_vat_report(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    source: str = Query("documents", pattern="^(documents|rollups)$")
+):
+    """VAT per rate for invoices, receipts and credit notes (netted), with the VAT return grids"""
+    if source == "rollups":
+        rows = await read_sales_rollups(date_from, date_to, VAT_REPORT_DOC_TYPES)
+        sums: Dict[Tuple[Any, str], Dict[str, float]] = {}
+        counts: Dict[str, int] = {}
+        for row in rows:
+            counts[row["doc_type"]] = counts.get(row["doc_type"], 0) + row.get("count", 0)
+            for line in row.get("vat", {}).values():
+                entry = sums.setdefault((line["rate"], row["doc_type"]), {"base": 0, "vat": 0, "total": 0})
+                for field in entry:
+                    entry[field] += line.get(field, 0)
+        groups = [{"rate": rate, "doc_type": doc_type, **values} for (rate, doc_type), values in sums.items()]
+    else:
+        facets = (await db.documents.aggregate(vat_report_pipeline(date_from, date_to)).to_list(1))[0]
+        groups = [{**g["_id"], "base": g["base"], "vat": g["vat"], "total": g["total"]} for g in facets["lines"]]
+        counts = {DocumentType(c["_id"]).value: c["count"] for c in facets["documents"]}
+    return vat_report_from_groups(groups, counts, date_from, date_to)
+
+def vat_line_pipeline(date_from: Optional[str], date_to: Optional[str]) -> List[Dict[str, Any]]:
+    """Documents of the period in (created_at, id) order, unwound to one row per VAT rate"""
+    return [
+        {"$match": {"doc_type": {"$in": VAT_REPORT_DOC_TYPES}, **report_date_query(date_from, date_to)}},
+        {"$sort": {"created_at": 1, "id": 1}},
+        {"$project": {
+            "_id": 0, "document_id": "$id", "number": 1, "doc_type": 1, "status": 1, "created_at": 1,
+            "customer_id": 1, "customer_name": 1, "customer_vat": 1, "lines": VAT_LINES_EXPRESSION
+        }},
+        {"$unwind": "$lines"}
+    ]
+
+async def vat_line_rows(documents, date_from: Optional[str], date_to: Optional[str]):
+    """One row per document and VAT rate, oldest first, streamed from an aggregation cursor"""
+    async for doc in documents.aggregate(vat_line_pipeline(date_from, date_to), batchSize=EXPORT_BATCH_SIZE):
+        line = doc.pop("lines")
+        yield {**doc, "rate": line.get("rate"), "base": line.get("base"), "vat": line.get("vat"), "total": line.get("total")}
+
+@api_router.get("/reports/vat/lines")
+async def export_vat_lines(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    format: str = Query("csv", pattern="^(ndjson|csv)$")
+):
+    """Stream the per-rate lines behind the VAT report"""
+    return _export_response(vat_line_rows(db.documents, date_from, date_to), VAT_LINE_EXPORT_FIELDS, format, "vat-lines")
+
 @api_router.get("/reports/inventory")
 async def get_inventory_report():
     """Get current inventory status"""
@@ -3190,12 +6043,10 @@ async def get_inventory_report():
     }
 
 @api_router.get("/shopify/sync-logs")
-async def get_shopify_sync_logs(limit: int = Query(50)):
+async def get_shopify_sync_logs(request: Request, limit: int = Query(50, le=500), cursor: Optional[str] = Query(None)):
     """Get Shopify sync logs"""
-    logs = await db.shopify_sync_logs.find(
-        {}, {"_id": 0}
-    ).sort("created_at", -1).to_list(limit)
-    return logs
+    logs, next_cursor = await keyset_page(db.shopify_sync_logs, {}, {"_id": 0}, limit, cursor)
+    return fast_json_response(request, logs, cursor_headers(next_cursor))
 
 @api_router.get("/shopify/unmapped-products")
 async def get_unmapped_products():
@@ -3220,15 +6071,68 @@ async def map_unmapped_product(unmapped_id: str, pos_product_id: str):
         {"$set": {
             "shopify_variant_id": unmapped["shopify_variant_id"],
             "shopify_product_id": unmapped["shopify_product_id"],
-            "origin": ProductOrigin.SHOPIFY
+            "origin": ProductOrigin.SHOPIFY,
+            "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    await product_search_index.refresh([pos_product_id])
+    product_scan_cache.invalidate(pos_product_id)
     
     # Remove from unmapped queue
     await db.unmapped_products.delete_one({"id": unmapped_id})
     
     return {"status": "success", "message": "Product mapped successfully"}
 
+# ============= METRICS =============
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+@api_router.get("/metrics/latency")
+async def get_latency_metrics():
+    """p50/p99 latency per route, with the per-step breakdown recorded by timed()"""
+    routes = {}
+    for route, samples in list(_route_latencies.items()):
+        totals = [sample["total"] for sample in samples]
+        steps = defaultdict(list)
+        for sample in samples:
+            for name, duration in sample["steps"].items():
+                steps[name].append(duration)
+        routes[route] = {
+            "count": len(totals),
+            "p50_ms": _percentile(totals, 50),
+            "p99_ms": _percentile(totals, 99),
+            "steps": {
+                name: {"p50_ms": _percentile(values, 50), "p99_ms": _percentile(values, 99)}
+                for name, values in steps.items()
+            }
+        }
+    return {"window": LATENCY_WINDOW, "routes": routes}
+
+@app.middleware("http")
+async def record_request_timings(request, call_next):
+    """Expose the latency breakdown as a Server-Timing header and keep it for /metrics/latency"""
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _request_timings.reset(token)
+    total = (time.perf_counter() - start) * 1000
+    
+    route = request.scope.get("route")
+    if route is not None:
+        _route_latencies[f"{request.method} {route.path}"].append({"total": total, "steps": dict(timings)})
+    
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{name};dur={duration:.1f}" for name, duration in timings.items()] + [f"total;dur={total:.1f}"]
+    )
+    return response
+
 # ============= SETUP =============
 app.include_router(api_router)
 
@@ -3238,6 +6142,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 logging.basicConfig(
@@ -3267,4 +6172,6 @@ async def health_check():
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await product_search_index.stop_watch()
+    await audit_buffer.stop()
     client.close()
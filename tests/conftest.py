@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "pos_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory database swapped in for server.db, with the registered (unique) indexes"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient()["pos_test"]
+    monkeypatch.setattr(server, "db", database)
+    asyncio.run(server.ensure_indexes())  # The mock runs synchronously: no loop is kept
+    return database
+
+
+@pytest.fixture
+def search_index(monkeypatch):
+    """Empty, ready search index and scan cache swapped in for the server's"""
+    index = server.ProductSearchIndex()
+    index.ready = True
+    monkeypatch.setattr(server, "product_search_index", index)
+    monkeypatch.setattr(server, "product_scan_cache", server.ProductScanCache(100))
+    return index
+
+
+@pytest.fixture
+def audits(monkeypatch):
+    """log_audit calls, recorded as (args, kwargs) instead of written"""
+    entries = []
+
+    async def record(*args, **kwargs):
+        entries.append((args, kwargs))
+
+    monkeypatch.setattr(server, "log_audit", record)
+    return entries
+
+
+@pytest.fixture(autouse=True)
+def audit_buffer(tmp_path, monkeypatch):
+    """Journal audit entries under the test's tmp_path, not next to server.py"""
+    buffer = server.AuditLogBuffer(server.AUDIT_FLUSH_INTERVAL_MS, server.AUDIT_FLUSH_BATCH_SIZE, tmp_path / "audit_spill.jsonl")
+    monkeypatch.setattr(server, "audit_buffer", buffer)
+    return buffer
+
+
+class FakeChangeStream:
+    """Stands in for collection.watch(): yields the given events, then closes"""
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self._events()
+
+    async def _events(self):
+        for change in self.changes:
+            yield change
+        raise RuntimeError("stream closed")
+
+
+@pytest.fixture
+def change_stream(db, monkeypatch):
+    """change_stream(events): the next watch() on any collection replays `events`"""
+    def replay(changes):
+        monkeypatch.setattr(type(db.products), "watch", lambda self, **kwargs: FakeChangeStream(changes), raising=False)
+    return replay
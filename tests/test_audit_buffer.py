@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from server import AuditLogBuffer
+
+pytestmark = pytest.mark.anyio
+
+
+def write_lines(path, lines):
+    path.write_text("".join(lines), encoding="utf-8")
+
+
+def entry(n):
+    return json.dumps({"id": f"a{n}", "action": "test"}) + "\n"
+
+
+async def logged_ids(db):
+    return sorted(e["id"] for e in await db.audit_logs.find({}, {"_id": 0, "id": 1}).to_list(None))
+
+
+async def test_replay_resumes_after_crash_without_losing_new_spill(db, tmp_path, monkeypatch):
+    buffer = AuditLogBuffer(1000, 2, tmp_path / "audit_spill.jsonl")
+    write_lines(buffer.spill_path, [entry(n) for n in range(5)])
+
+    # The process dies while the second batch of the replay is being written
+    insert = buffer._insert
+    calls = []
+
+    async def dying_insert(batch):
+        calls.append(batch)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return await insert(batch)
+
+    monkeypatch.setattr(buffer, "_insert", dying_insert)
+    with pytest.raises(KeyboardInterrupt):
+        await buffer.flush()
+    assert buffer.spill_path.with_suffix(".replay").exists()
+
+    # After the restart more entries were spilled before Mongo came back
+    restarted = AuditLogBuffer(1000, 2, buffer.spill_path)
+    restarted._spill([{"id": "a5", "action": "test"}])
+    await restarted.flush()
+    assert await logged_ids(db) == ["a0", "a1", "a2", "a3", "a4"]
+    await restarted.flush()
+
+    assert await logged_ids(db) == ["a0", "a1", "a2", "a3", "a4", "a5"]
+    assert not buffer.spill_path.exists()
+    assert not buffer.spill_path.with_suffix(".replay").exists()
+
+
+async def test_truncated_line_is_quarantined(db, tmp_path):
+    buffer = AuditLogBuffer(1000, 10, tmp_path / "audit_spill.jsonl")
+    torn = entry(2)[:12]
+    write_lines(buffer.spill_path, [entry(0), entry(1), torn])
+    # Spilling after a torn write starts on a fresh line
+    buffer._spill([{"id": "a3", "action": "test"}])
+
+    await buffer.flush()
+
+    assert await logged_ids(db) == ["a0", "a1", "a3"]
+    assert buffer.spill_path.with_suffix(".quarantine").read_text(encoding="utf-8") == torn + "\n"
+    assert not buffer.spill_path.with_suffix(".replay").exists()
+
+
+async def test_added_entries_survive_a_crash_before_the_flush(db, tmp_path):
+    buffer = AuditLogBuffer(1000, 10, tmp_path / "audit_spill.jsonl")
+    for n in range(3):
+        buffer.add({"id": f"a{n}", "action": "test"})
+    # SIGKILL: the buffer object is gone without a flush, only the file is left
+
+    restarted = AuditLogBuffer(1000, 10, buffer.spill_path)
+    restarted.add({"id": "a3", "action": "test"})
+    await restarted.flush()
+
+    assert await logged_ids(db) == ["a0", "a1", "a2", "a3"]
+    assert not buffer.spill_path.exists() and restarted.waiting == 0
+
+
+async def test_entries_added_during_a_flush_go_to_the_next_one(db, tmp_path, monkeypatch):
+    buffer = AuditLogBuffer(1000, 10, tmp_path / "audit_spill.jsonl")
+    buffer.add({"id": "a0", "action": "test"})
+    insert = buffer._insert
+
+    async def busy_insert(batch):
+        buffer.add({"id": "a1", "action": "test"})
+        return await insert(batch)
+
+    monkeypatch.setattr(buffer, "_insert", busy_insert)
+    await buffer.flush()
+    assert await logged_ids(db) == ["a0"]
+    assert buffer.spill_path.read_text(encoding="utf-8") == entry(1)
+
+    monkeypatch.setattr(buffer, "_insert", insert)
+    await buffer.flush()
+    assert await logged_ids(db) == ["a0", "a1"]
@@ -0,0 +1,55 @@
+import pytest
+
+import server
+from server import ProductBulkUpdate
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def catalog(db, audits):
+    await db.products.insert_many([
+        {"id": f"p{n}", "sku": f"S{n}", "category_id": "cat", "price_retail": price, "vendor": vendor, "updated_at": "2000-01-01"}
+        for n, (price, vendor) in enumerate([(1.15, "Acme"), (10.0, "Acme"), (2.0, "Other"), (None, "Acme")])
+    ])
+    await db.products.insert_one({"id": "x", "sku": "X", "category_id": "other", "price_retail": 1.0, "updated_at": "2000-01-01"})
+    return db
+
+
+async def new_prices(db, **update):
+    data = ProductBulkUpdate(category_id="cat", **update)
+    rows = await db.products.aggregate([
+        {"$match": {"category_id": "cat"}}, {"$sort": {"id": 1}},
+        {"$project": {"_id": 0, "price": server._price_expression("price_retail", data)}},
+    ]).to_list(None)
+    return [row["price"] for row in rows]
+
+
+@pytest.mark.parametrize("update, expected", [
+    ({"percent": 0.0001}, [1.15, 10.0, 2.0, None]),  # 1.15 * 100 is 114.999...: still 1.15
+    ({"percent": 10, "round_to": 0.05}, [1.25, 11.0, 2.2, None]),  # 1.265 -> 1.25, nearest 0.05
+    ({"percent": 10, "round_to": 0.05, "rounding": "up"}, [1.30, 11.0, 2.2, None]),
+    ({"percent": 10, "round_to": 1, "rounding": "down"}, [1.0, 11.0, 2.0, None]),
+    ({"fixed": -5}, [0, 5.0, 0, None]),  # Never below zero
+])
+async def test_price_expression_rounds_in_steps(catalog, update, expected):
+    assert await new_prices(catalog, **update) == pytest.approx(expected)
+
+
+async def test_only_changed_rows_are_written(catalog):
+    result = await server.bulk_update_products(ProductBulkUpdate(category_id="cat", set={"vendor": "Acme"}))
+
+    assert (result["matched"], result["modified"]) == (4, 1)
+    stamped = {p["id"] async for p in catalog.products.find({"updated_at": {"$ne": "2000-01-01"}})}
+    assert stamped == {"p2"}
+
+    again = await server.bulk_update_products(ProductBulkUpdate(category_id="cat", set={"vendor": "Acme"}))
+    assert (again["matched"], again["modified"]) == (4, 0)
+
+
+async def test_price_change_skips_rows_already_at_the_new_price(catalog):
+    # Rounding to whole euros leaves 10.0 and 2.0 (and the product without a price) as they are
+    result = await server.bulk_update_products(ProductBulkUpdate(category_id="cat", percent=0.01, round_to=1))
+
+    assert (result["matched"], result["modified"]) == (4, 1)
+    assert (await catalog.products.find_one({"id": "p0"}))["price_retail"] == 1.0
@@ -0,0 +1,60 @@
+import pytest
+
+import server
+from server import Product, recount_category_counts
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def categories(db, search_index):
+    await db.categories.insert_many([
+        {"id": "pipes", "name_fr": "Tuyaux", "name_nl": "Buizen", "product_count": 0, "in_stock_count": 0},
+        {"id": "fixings", "name_fr": "Fixations", "name_nl": "Bevestiging", "product_count": 0, "in_stock_count": 0},
+    ])
+    return db
+
+
+def product(product_id, category_id, stock_qty):
+    return Product(id=product_id, sku=product_id.upper(), name_fr=product_id, name_nl=product_id, category_id=category_id,
+                   unit="piece", price_retail=1.0, stock_qty=stock_qty)
+
+
+async def counts(db):
+    return {c["id"]: (c["product_count"], c["in_stock_count"]) async for c in db.categories.find()}
+
+
+async def test_write_paths_keep_the_counts(categories):
+    await server.create_product(product("p1", "pipes", 5))
+    await server.create_product(product("p2", "pipes", 0))
+    assert await counts(categories) == {"pipes": (2, 1), "fixings": (0, 0)}
+
+    await server.update_product("p1", {"category_id": "fixings"})
+    await server.update_product("p2", {"stock_qty": 3})
+    assert await counts(categories) == {"pipes": (1, 1), "fixings": (1, 1)}
+
+    await server.delete_product("p2")
+    assert await counts(categories) == {"pipes": (0, 0), "fixings": (1, 1)}
+    await server.update_product("p1", {"name_fr": "Vis"})  # Neither category nor stock: nothing to count
+    assert await counts(categories) == {"pipes": (0, 0), "fixings": (1, 1)}
+
+
+async def test_categories_are_one_read(categories, monkeypatch):
+    await server.create_product(product("p1", "pipes", 5))
+
+    def no_aggregate(self, *args, **kwargs):
+        raise AssertionError("get_categories must not aggregate the products")
+
+    monkeypatch.setattr(type(categories.products), "aggregate", no_aggregate)
+    rows = await server.get_categories()
+
+    assert [(c["id"], c["product_count"], c["in_stock_count"]) for c in rows] == [("fixings", 0, 0), ("pipes", 1, 1)]
+
+
+async def test_recount_repairs_drifted_counts(categories):
+    await server.create_product(product("p1", "pipes", 5))
+    await server.create_product(product("p2", "pipes", 0))
+    await categories.categories.update_many({}, {"$set": {"product_count": 7, "in_stock_count": -1}})
+
+    assert await recount_category_counts() == 2
+    assert await counts(categories) == {"pipes": (2, 1), "fixings": (0, 0)}
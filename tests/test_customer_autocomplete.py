@@ -0,0 +1,63 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("phone, keys", [
+    ("+32 475 12 34 56", {"32475123456", "0475123456", "475123456"}),
+    ("0032 475/12.34.56", {"32475123456", "0475123456", "475123456"}),
+    ("0475 12 34 56", {"32475123456", "0475123456", "475123456"}),
+    ("+31 20 123 4567", {"31201234567", "0201234567", "201234567"}),
+    ("112", {"112"}),
+    (None, set()),
+])
+def test_phone_keys_cover_international_and_national_forms(phone, keys):
+    assert server.phone_search_keys(phone) == keys
+
+
+def test_customer_keys_and_the_queries_that_match_them():
+    keys = server.customer_search_keys({
+        "name": "Renov'Expert BVBA", "contact_name": "Zoë Peeters", "email": " Info@RenovExpert.be ",
+        "phone": "+32 2 567 89 01", "vat_number": "BE 0345.678.901",
+    })
+
+    assert {"renov", "expert", "bvba", "zoe", "peeters", "info@renovexpert.be", "3225678901", "025678901",
+            "be0345678901", "0345678901"} <= set(keys)
+    assert keys == sorted(keys)
+    for typed, pattern in (("ZOË", "zoe"), ("Info@Renov", "info@renov"), ("+32 2 56", "32256"), ("BE0345", "be0345")):
+        query = server.customer_autocomplete_query(typed)
+        assert query["search_keys"]["$regex"] == "^" + pattern
+        assert any(key.startswith(pattern) for key in keys)
+    assert server.customer_autocomplete_query("renov pee") == {
+        "$and": [{"search_keys": {"$regex": "^renov"}}, {"search_keys": {"$regex": "^pee"}}]
+    }
+    assert server.customer_autocomplete_query("r") is None and server.customer_autocomplete_query("4") is None
+
+
+def names(response):
+    return [c["name"] for c in server.orjson.loads(response.body)]
+
+
+async def test_autocomplete_returns_the_first_matches_by_name(db):
+    # Inserted in reverse order: a limit before sorting would return the wrong ones
+    for name in ["Martin Zoé", "Martin Yves", "Martin Xavier", "Martin Émile", "martin Alain"]:
+        await server.create_customer(server.Customer(type="individual", name=name))
+
+    response = await server.autocomplete_customers(None, q="mart", limit=3)
+
+    assert names(response) == ["martin Alain", "Martin Émile", "Martin Xavier"]
+
+
+async def test_backfill_and_rename_keep_the_sort_key(db):
+    await db.customers.insert_one({"id": "c1", "name": "Zeta"})
+    await db.customers.insert_one({"id": "c2", "name": "Alpha", "search_keys": ["alpha"]})
+    assert await server.backfill_customer_search_keys() == 2
+
+    await server.update_customer("c1", {"name": "Ab"})
+
+    response = await server.autocomplete_customers(None, q="ab", limit=10)
+    assert names(response) == ["Ab"]
+    stored = {c["id"]: c["name_key"] for c in await db.customers.find({}, {"_id": 0}).to_list(None)}
+    assert stored == {"c1": "ab", "c2": "alpha"}
@@ -0,0 +1,82 @@
+import pytest
+
+import server
+from server import apply_customer_stats, recompute_customer_stats
+
+pytestmark = pytest.mark.anyio
+
+COMPARED = ("documents_count", "counts", "spent", "unpaid", "last_purchase_at", "products")
+
+
+def document(number, doc_type="invoice", status="paid", total=12.5, paid_total=None, items=(("p1", 2, 6.25),), day=1):
+    return {
+        "id": number, "customer_id": "c1", "doc_type": doc_type, "status": status, "total": total,
+        "paid_total": total if paid_total is None else paid_total, "created_at": f"2024-05-{day:02d}T10:00:00+00:00",
+        "items": [{"product_id": pid, "name": pid.upper(), "qty": qty, "unit_price": price} for pid, qty, price in items],
+    }
+
+
+async def write(db, before, after):
+    """A document write path: store the document, then apply its delta"""
+    if after is None:
+        await db.documents.delete_one({"id": before["id"]})
+    else:
+        await db.documents.replace_one({"id": after["id"]}, after, upsert=True)
+    await apply_customer_stats("c1", (before, after))
+
+
+async def stored(db):
+    stats = await db.customer_stats.find_one({"customer_id": "c1"})
+    return {field: stats.get(field) for field in COMPARED}
+
+
+async def test_deltas_match_a_recompute(db):
+    await db.documents.insert_one(document("i0", total=5, items=(("p1", 1, 5),)))
+    await recompute_customer_stats("c1")
+    invoice = document("i1", status="unpaid", paid_total=0)
+    await write(db, None, invoice)
+    await write(db, None, document("q1", doc_type="quote", status="draft", total=30.25, items=(("p2", 1, 30.25),)))
+    await write(db, None, document("r1", doc_type="receipt", total=8, items=(("p2", 4, 2),), day=3))
+    paid = {**invoice, "status": "paid", "paid_total": 12.5}
+    await write(db, invoice, paid)
+    await write(db, None, document("cn1", doc_type="credit_note", total=6.25, items=(("p1", 1, 6.25),), day=4))
+
+    from_deltas = await stored(db)
+    await recompute_customer_stats("c1")
+
+    assert from_deltas == await stored(db)
+    assert from_deltas["spent"] == 31.75 and from_deltas["unpaid"] == 0
+    assert from_deltas["products"]["p1"]["qty"] == 2 and from_deltas["last_purchase_at"] == "2024-05-03T10:00:00+00:00"
+
+
+async def test_delta_without_stats_is_kept_and_rebuilt_on_read(db):
+    await db.documents.insert_one(document("old", day=1))
+    await write(db, None, document("new", day=2))
+
+    partial = await db.customer_stats.find_one({"customer_id": "c1"})
+    assert partial["documents_count"] == 1 and not partial.get("complete")
+
+    await db.customers.insert_one({"id": "c1", "name": "Client", "type": "individual"})
+    history = await server.get_customer_history("c1", limit=20, view=None)
+    assert history["stats"]["total_documents"] == 2
+    assert (await db.customer_stats.find_one({"customer_id": "c1"}))["complete"]
+
+
+async def test_recompute_retries_when_a_delta_lands_during_the_aggregation(db, monkeypatch):
+    await write(db, None, document("i1"))
+    aggregate = server.customer_stats_from_documents
+    runs = []
+
+    async def racing_aggregate(customer_id):
+        stats = await aggregate(customer_id)
+        runs.append(stats["documents_count"])
+        if len(runs) == 1:
+            # A sale is written after the documents were read but before the replace
+            await write(db, None, document("i2", day=2))
+        return stats
+
+    monkeypatch.setattr(server, "customer_stats_from_documents", racing_aggregate)
+    await recompute_customer_stats("c1")
+
+    assert runs == [1, 2]
+    assert (await stored(db))["documents_count"] == 2
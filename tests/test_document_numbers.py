@@ -0,0 +1,75 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import DocumentCreate, DocumentItemCreate, DocumentType, ReturnCreate, ReturnItemCreate, generate_document_number
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def sequential(monkeypatch):
+    monkeypatch.setattr(server, "DOCUMENT_NUMBER_BLOCK_SIZE", 1)
+
+
+async def test_numbers_are_sequential(db):
+    first = await generate_document_number(DocumentType.INVOICE)
+    second = await generate_document_number(DocumentType.INVOICE)
+    assert first.startswith("FA") and first.endswith("-001")
+    assert second.endswith("-002")
+    assert (await generate_document_number(DocumentType.RECEIPT)).endswith("-001")
+
+
+async def test_new_counter_starts_after_highest_existing_number(db):
+    key = (await generate_document_number(DocumentType.QUOTE)).split("-")[0].replace("DV", "FA")
+    # Gaps left by block reservation, and a number past 999 that sorts before "999" as text
+    await db.documents.insert_many([{"id": n, "number": f"{key}-{n}"} for n in ("001", "007", "999", "1002")])
+    assert await generate_document_number(DocumentType.INVOICE) == f"{key}-1003"
+
+
+async def test_existing_counter_is_not_reseeded(db):
+    key = (await generate_document_number(DocumentType.INVOICE)).split("-")[0]
+    await db.documents.insert_one({"id": "500", "number": f"{key}-500"})
+    assert await generate_document_number(DocumentType.INVOICE) == f"{key}-002"
+
+
+async def test_refused_sales_leave_no_gap(db):
+    await db.products.insert_one({"id": "p1", "sku": "S1", "stock_qty": 2, "prevent_negative_stock": True})
+    await db.customers.insert_one({"id": "c1", "name": "Client", "type": "company", "credit_limit": 50.0, "balance": 0.0})
+
+    def invoice(qty, customer_id=None):
+        item = DocumentItemCreate(product_id="p1", sku="S1", name="Vis", qty=qty, unit_price=100, vat_rate=21)
+        return DocumentCreate(doc_type=DocumentType.INVOICE, customer_id=customer_id, items=[item])
+
+    first = await server.create_document(invoice(1))
+    for refused, reason in ((invoice(5), "Insufficient stock"), (invoice(1, "c1"), "Credit limit exceeded")):
+        with pytest.raises(HTTPException) as e:
+            await server.create_document(refused)
+        assert e.value.status_code == 400 and reason in e.value.detail
+    second = await server.create_document(invoice(1))
+
+    assert first.number.endswith("-001") and second.number.endswith("-002")
+    assert await db.documents.count_documents({}) == 2
+
+
+async def test_failed_return_leaves_no_credit_note_gap(db, monkeypatch):
+    await db.products.insert_one({"id": "p1", "sku": "S1", "stock_qty": 0})
+    sale = await server.create_document(DocumentCreate(doc_type=DocumentType.RECEIPT, items=[
+        DocumentItemCreate(product_id="p1", sku="S1", name="Vis", qty=1, unit_price=10, vat_rate=21)
+    ]))
+    returned = ReturnCreate(original_document_id=sale.id, items=[
+        ReturnItemCreate(original_item_id="i1", product_id="p1", sku="S1", name="Vis", qty=1, unit_price=10)
+    ])
+    record_stock_movements = server.record_stock_movements
+
+    async def failing_stock(*args, **kwargs):
+        raise RuntimeError("stock write failed")
+
+    monkeypatch.setattr(server, "record_stock_movements", failing_stock)
+    with pytest.raises(RuntimeError):
+        await server.create_return(returned)
+    monkeypatch.setattr(server, "record_stock_movements", record_stock_movements)
+
+    credit_note = await server.create_return(returned)
+    assert credit_note["number"].startswith("CN") and credit_note["number"].endswith("-001")
+    assert (await db.products.find_one({"id": "p1"}))["stock_qty"] == 0
@@ -0,0 +1,75 @@
+import csv
+import io
+import json
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+FILTERS = dict.fromkeys(["doc_type", "status", "customer_id", "search", "shift_id"])
+
+
+def document(number, day, doc_type="invoice", items=2):
+    return {
+        "id": f"id-{number}", "number": number, "doc_type": doc_type, "status": "paid", "customer_id": "c1",
+        "customer_name": "Client", "created_at": f"2024-05-{day:02d}T10:00:00+00:00", "total": 12.1 * items,
+        "items": [
+            {"id": f"{number}-{n}", "product_id": f"p{n}", "sku": f"S{n}", "name": f"Vis {n}", "qty": n + 1, "unit_price": 10,
+             "vat_rate": 21.0, "line_subtotal": 10.0 * (n + 1), "line_vat": 2.1 * (n + 1), "line_total": 12.1 * (n + 1)}
+            for n in range(items)
+        ],
+    }
+
+
+async def body(response):
+    chunks = [chunk async for chunk in response.body_iterator]
+    return chunks, "".join(chunks)
+
+
+@pytest.fixture
+async def documents(db):
+    await db.documents.insert_many([
+        document("FA-3", 3), document("FA-1", 1), document("DV-2", 2, doc_type="quote"), document("FA-9", 9),
+    ])
+    return db
+
+
+async def test_documents_ndjson_oldest_first_with_filters(documents):
+    filters = {**FILTERS, "doc_type": server.DocumentType.INVOICE}
+    response = await server.export_documents(**filters, date_from="2024-05-01", date_to="2024-05-05", format="ndjson")
+
+    _, text = await body(response)
+    rows = [json.loads(line) for line in text.splitlines()]
+
+    assert response.media_type == "application/x-ndjson"
+    assert 'filename="documents-' in response.headers["content-disposition"]
+    assert [row["number"] for row in rows] == ["FA-1", "FA-3"]
+    assert all(list(row) == server.DOCUMENT_EXPORT_FIELDS for row in rows)
+    assert rows[0]["total"] == 24.2 and rows[0]["paid_total"] is None
+
+
+async def test_document_lines_csv_one_row_per_item(documents):
+    response = await server.export_document_lines(**FILTERS, date_from=None, date_to=None, format="csv")
+
+    _, text = await body(response)
+    rows = list(csv.DictReader(io.StringIO(text)))
+
+    assert response.media_type == "text/csv"
+    assert text.splitlines()[0] == ",".join(server.DOCUMENT_LINE_EXPORT_FIELDS)
+    assert [(row["number"], row["line_id"]) for row in rows] == [
+        (number, f"{number}-{n}") for number in ("FA-1", "DV-2", "FA-3", "FA-9") for n in range(2)
+    ]
+    assert rows[1]["document_id"] == "id-FA-1" and rows[1]["qty"] == "2" and rows[1]["line_total"] == "24.2"
+
+
+async def test_rows_are_sent_in_batches(documents, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_BATCH_SIZE", 3)
+
+    response = await server.export_document_lines(**FILTERS, date_from=None, date_to=None, format="csv")
+    chunks, text = await body(response)
+
+    # Header + 3 rows, 3 rows, then the last 2: each chunk ends on a whole row
+    assert [chunk.count("\n") for chunk in chunks] == [4, 3, 2]
+    assert len(list(csv.DictReader(io.StringIO(text)))) == 8
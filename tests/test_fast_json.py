@@ -0,0 +1,49 @@
+import orjson
+import pytest
+
+import server
+from server import ProductSearchIndex
+
+pytestmark = pytest.mark.anyio
+
+
+def body(response):
+    return orjson.loads(response.body)
+
+
+async def test_seeded_rows_get_the_model_defaults(db):
+    await db.products.insert_one(dict(server.PRODUCTS[0]))
+    await db.customers.insert_one(dict(server.CUSTOMERS[0]))
+
+    [product] = body(await server.get_products(None, search=None, category_id=None, barcode=None, low_stock=None))
+    [customer] = body(await server.get_customers(None, search=None))
+
+    assert product["origin"] == "local" and product["prevent_negative_stock"] is False and product["metafields"] is None
+    assert product["price_retail"] == server.PRODUCTS[0]["price_retail"]
+    assert customer["country"] == "BE" and customer["payment_terms_days"] == 30 and customer["language"] == "fr"
+    assert body(await server.scan_product(server.PRODUCTS[0]["barcode"]))["origin"] == "local"
+
+
+async def test_legacy_documents_get_nested_defaults(db):
+    await db.documents.insert_one({
+        "id": "old", "number": "FA-1", "doc_type": "invoice", "status": "paid", "created_at": "2024-05-02T10:00:00+00:00",
+        "items": [{"product_id": "p1", "sku": "S1", "name": "Vis", "qty": 1, "unit_price": 10, "line_total": 12.1}],
+    })
+
+    [doc] = body(await server.get_documents(limit=100, request=None, **dict.fromkeys(
+        ["doc_type", "status", "customer_id", "search", "date_from", "date_to", "shift_id", "view", "fields", "cursor"])))
+
+    assert doc["vat_breakdown"] == [] and doc["payments"] == [] and doc["stock_movement_created"] is False
+    assert doc["items"][0]["unit"] == "piece" and doc["items"][0]["vat_rate"] == 21.0 and doc["items"][0]["line_total"] == 12.1
+
+
+async def test_index_rows_are_not_changed(db, monkeypatch):
+    index = ProductSearchIndex()
+    index.ready = True
+    monkeypatch.setattr(server, "product_search_index", index)
+    index.upsert(dict(server.PRODUCTS[0]))
+
+    [product] = body(await server.get_products(None, search="pvc", category_id=None, barcode=None, low_stock=None))
+
+    assert product["origin"] == "local" and product["weight_unit"] == "kg"
+    assert "origin" not in index.get_by_code(server.PRODUCTS[0]["barcode"])
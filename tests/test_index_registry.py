@@ -0,0 +1,46 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class ExplainedCursor:
+    def __init__(self, plan):
+        self.plan = plan
+
+    def sort(self, keys):
+        return self
+
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": self.plan}}
+
+
+class ExplainedDatabase:
+    """Stand-in database whose collections explain to a fixed plan"""
+
+    def __init__(self, plans):
+        self.plans = plans
+
+    def __getitem__(self, name):
+        plan = self.plans[name]
+        return type("Collection", (), {"find": lambda _, query: ExplainedCursor(plan)})()
+
+
+async def test_eof_plan_is_unverified_not_a_pass(monkeypatch):
+    monkeypatch.setattr(server, "INDEX_REGISTRY", [
+        {"collection": "indexed", "keys": [("a", 1)], "queries": [{"filter": {"a": 1}}]},
+        {"collection": "scanned", "keys": [("a", 1)], "queries": [{"filter": {"a": 1}}]},
+        {"collection": "missing", "keys": [("a", 1)], "queries": [{"filter": {"a": 1}, "sort": [("a", 1)]}]},
+    ])
+    monkeypatch.setattr(server, "db", ExplainedDatabase({
+        "indexed": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}},
+        "scanned": {"stage": "COLLSCAN"},
+        "missing": {"stage": "EOF"},
+    }))
+
+    results = {r["collection"]: r for r in await server.explain_query_shapes()}
+
+    assert (results["indexed"]["collscan"], results["indexed"]["unverified"]) == (False, False)
+    assert (results["scanned"]["collscan"], results["scanned"]["unverified"]) == (True, False)
+    assert (results["missing"]["collscan"], results["missing"]["unverified"]) == (False, True)
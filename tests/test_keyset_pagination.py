@@ -0,0 +1,50 @@
+import pytest
+from fastapi import HTTPException
+
+from server import cursor_values, decode_cursor, encode_cursor, keyset_page
+
+pytestmark = pytest.mark.anyio
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor({"created_at": "2024-05-01T10:00:00+00:00", "id": "b", "total": 5})
+    assert cursor_values(cursor) == ("2024-05-01T10:00:00+00:00", "b")
+    assert decode_cursor(cursor) == {"$or": [
+        {"created_at": {"$lt": "2024-05-01T10:00:00+00:00"}},
+        {"created_at": "2024-05-01T10:00:00+00:00", "id": {"$lt": "b"}},
+    ]}
+
+
+def test_cursor_on_another_sort_field():
+    assert cursor_values(encode_cursor({"updated_at": "2024-05-02", "id": "x"}, field="updated_at")) == ("2024-05-02", "x")
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "bm90IGpzb24=", encode_cursor({"created_at": "x", "id": "y"})[:-4] + "!!!!"])
+def test_invalid_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as e:
+        decode_cursor(cursor)
+    assert e.value.status_code == 400
+
+
+async def test_pages_walk_every_row_once_across_equal_timestamps(db):
+    # Several rows share a timestamp: the id breaks the tie
+    rows = [{"id": f"d{i}", "created_at": f"2024-05-0{1 + i // 3}", "status": "paid" if i % 4 else "draft"} for i in range(8)]
+    await db.documents.insert_many([dict(row) for row in rows])
+    expected = sorted((r for r in rows if r["status"] == "paid"), key=lambda r: (r["created_at"], r["id"]), reverse=True)
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        page, cursor = await keyset_page(db.documents, {"status": "paid"}, {"_id": 0, "id": 1, "created_at": 1}, 2, cursor)
+        pages += 1
+        seen.extend(row["id"] for row in page)
+        if cursor is None:
+            break
+
+    assert seen == [r["id"] for r in expected]
+    assert pages == 4  # Three full pages, then an empty one ends the walk
+
+
+async def test_short_page_has_no_next_cursor(db):
+    await db.documents.insert_many([{"id": "a", "created_at": "2024-05-01"}])
+    page, cursor = await keyset_page(db.documents, {}, {"_id": 0}, 5)
+    assert [row["id"] for row in page] == ["a"] and cursor is None
@@ -0,0 +1,81 @@
+import orjson
+import pytest
+
+import server
+from server import AuditLogSummary, Document, DocumentSummary, ShiftSummary, list_projection
+
+pytestmark = pytest.mark.anyio
+
+
+def document(number, day, **fields):
+    return {
+        "id": number, "number": number, "doc_type": "invoice", "status": "paid", "customer_id": "c1", "customer_name": "Client",
+        "created_at": f"2024-05-{day:02d}T10:00:00+00:00", "total": 12.1, "paid_total": 12.1,
+        "items": [{"product_id": "p1", "sku": "S1", "name": "Vis", "qty": 1, "unit_price": 10}],
+        "payments": [{"method": "cash", "amount": 12.1}], **fields,
+    }
+
+
+async def documents(**params):
+    query = dict.fromkeys(["doc_type", "status", "customer_id", "search", "date_from", "date_to", "shift_id", "view", "fields", "cursor"])
+    response = await server.get_documents(limit=params.pop("limit", 100), request=None, **{**query, **params})
+    return orjson.loads(response.body), response.headers.get(server.NEXT_CURSOR_HEADER)
+
+
+def test_projection_of_each_mode():
+    assert list_projection(None, None, Document, DocumentSummary) is None
+    assert list_projection("full", None, Document, DocumentSummary) is None
+    assert list_projection("summary", None, Document, DocumentSummary) == {
+        "_id": 0, **{name: 1 for name in DocumentSummary.model_fields}
+    }
+    # The cursor needs id and created_at, whatever was asked for
+    assert list_projection(None, "number, total", Document, DocumentSummary) == {"_id": 0, "id": 1, "number": 1, "total": 1, "created_at": 1}
+    for view, fields in (("slim", None), (None, "number,password")):
+        with pytest.raises(server.HTTPException) as e:
+            list_projection(view, fields, Document, DocumentSummary)
+        assert e.value.status_code == 400
+
+
+async def test_summary_rows_leave_out_items_and_payments(db):
+    legacy = document("FA-2", 2)
+    del legacy["paid_total"]
+    await db.documents.insert_many([document("FA-1", 1), legacy])
+
+    rows, _ = await documents(view="summary")
+
+    assert [row["number"] for row in rows] == ["FA-2", "FA-1"]
+    assert all(set(row) == set(DocumentSummary.model_fields) for row in rows)
+    assert rows[0]["paid_total"] == 0.0  # Missing from the row: the summary model's default
+
+
+async def test_fields_are_pushed_down_and_pages_still_chain(db):
+    await db.documents.insert_many([document(f"FA-{day}", day) for day in range(1, 4)])
+
+    first, cursor = await documents(fields="number", limit=2)
+    rest, last = await documents(fields="number", limit=2, cursor=cursor)
+
+    assert first == [{"id": "FA-3", "number": "FA-3", "created_at": "2024-05-03T10:00:00+00:00"},
+                     {"id": "FA-2", "number": "FA-2", "created_at": "2024-05-02T10:00:00+00:00"}]
+    assert [row["number"] for row in rest] == ["FA-1"] and last is None
+
+
+async def test_other_list_endpoints_take_the_summary_view(db):
+    await db.documents.insert_one(document("FA-1", 1))
+    await db.customers.insert_one({"id": "c1", "name": "Client", "type": "company"})
+    await db.shifts.insert_one({"id": "s1", "status": "closed", "register_number": 2, "opened_at": "2024-05-01T08:00:00+00:00",
+                                "cash_movements": [{"type": "in", "amount": 50}], "sales_total": 12.1})
+    await db.audit_logs.insert_one({"id": "a1", "action": "create", "entity_type": "document", "entity_id": "FA-1",
+                                    "description": "Created", "old_values": None, "new_values": {"total": 12.1},
+                                    "created_at": "2024-05-01T10:00:00+00:00"})
+
+    shifts = orjson.loads((await server.get_shifts(None, limit=30, view="summary", fields=None)).body)
+    sales = orjson.loads((await server.get_sales_legacy(None, limit=50, view="summary", fields=None)).body)
+    history = await server.get_customer_history("c1", limit=20, view="summary")
+    logs = orjson.loads((await server.get_audit_logs(
+        None, None, None, None, None, limit=100, view="summary", fields=None, cursor=None, request=None
+    )).body)
+
+    assert set(shifts[0]) == set(ShiftSummary.model_fields) and shifts[0]["register_number"] == 2
+    assert set(sales[0]) == set(DocumentSummary.model_fields)
+    assert [set(row) for row in history["recent_documents"]] == [set(DocumentSummary.model_fields)]
+    assert set(logs[0]) == set(AuditLogSummary.model_fields) and logs[0]["entity_number"] is None
@@ -0,0 +1,60 @@
+import pytest
+
+from server import DocumentItemCreate, allocate_discount, calculate_document_totals, line_subtotal_cents, to_cents, vat_cents
+
+
+def line(unit_price, qty=1, vat_rate=21.0, **discount):
+    return DocumentItemCreate(product_id="p", sku="X", name="X", qty=qty, unit_price=unit_price, vat_rate=vat_rate, **discount)
+
+
+@pytest.mark.parametrize("value, cents", [(1.005, 101), (2.675, 268), (0.1 + 0.2, 30), (-1.005, -101), (0.0049, 0)])
+def test_to_cents_rounds_half_up_on_the_decimal_value(value, cents):
+    assert to_cents(value) == cents
+
+
+def test_line_subtotal_applies_line_discounts():
+    assert line_subtotal_cents(3, 0.1, None, 0) == 30
+    assert line_subtotal_cents(1, 1.15, "percent", 50) == 58
+    assert line_subtotal_cents(2, 5, "fixed", 2.5) == 750
+
+
+def test_vat_is_rounded_once_per_amount():
+    assert vat_cents(250, 21) == 53
+    assert vat_cents(50, 5.5) == 3
+
+
+def test_allocate_discount_shares_add_up_to_the_discount():
+    shares = allocate_discount(100, {6.0: 333, 12.0: 333, 21.0: 334})
+    assert sum(shares.values()) == 100
+    # The rounding remainder goes to the largest base
+    assert shares == {6.0: 33, 12.0: 33, 21.0: 34}
+
+
+def test_allocate_discount_tie_goes_to_the_highest_rate():
+    assert allocate_discount(1, {6.0: 100, 12.0: 100, 21.0: 100}) == {6.0: 0, 12.0: 0, 21.0: 1}
+    # Both half-cent shares round up; the extra cent comes back off the highest rate
+    assert allocate_discount(1, {6.0: 100, 21.0: 100}) == {6.0: 1, 21.0: 0}
+
+
+@pytest.mark.parametrize("discount, bases", [(0, {21.0: 100}), (500, {21.0: 0, 6.0: 0}), (500, {})])
+def test_allocate_discount_without_discount_or_base(discount, bases):
+    assert allocate_discount(discount, bases) == {rate: 0 for rate in bases}
+
+
+def test_document_totals_match_the_vat_breakdown():
+    items = [line(0.1, qty=3), line(1.005, vat_rate=6.0), line(19.99, qty=2, vat_rate=6.0, discount_type="percent", discount_value=10)]
+    calculated, subtotal, vat_total, total, breakdown = calculate_document_totals(items, "percent", 5)
+
+    assert [i.line_subtotal for i in calculated] == [0.3, 1.01, 35.98]
+    assert [i.line_vat for i in calculated] == [0.06, 0.06, 2.16]
+    assert [(b.rate, b.base, b.vat) for b in breakdown] == [(6.0, 35.14, 2.11), (21.0, 0.29, 0.06)]
+    assert (subtotal, vat_total, total) == (35.43, 2.17, 37.6)
+    assert round(sum(b.total for b in breakdown), 2) == total
+
+
+def test_fixed_global_discount_is_split_across_rates():
+    items = [line(10, vat_rate=21.0), line(10, vat_rate=6.0)]
+    _, subtotal, vat_total, total, breakdown = calculate_document_totals(items, "fixed", 0.01)
+
+    assert [(b.rate, b.base) for b in breakdown] == [(6.0, 9.99), (21.0, 10.0)]
+    assert (subtotal, vat_total, total) == (19.99, 2.70, 22.69)
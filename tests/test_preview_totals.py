@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+import server
+from server import DocumentItemCreate, PreviewCart, PreviewItem, calculate_document_totals, preview_cart_totals
+
+
+def engine_totals(cart):
+    items = [
+        DocumentItemCreate(product_id="p", sku="X", name="X", **item.model_dump())
+        for item in cart.items
+    ]
+    _, subtotal, vat_total, total, breakdown = calculate_document_totals(
+        items, cart.global_discount_type, cart.global_discount_value
+    )
+    return {
+        "subtotal": subtotal,
+        "vat_total": vat_total,
+        "total": total,
+        "vat_breakdown": [b.model_dump() for b in breakdown],
+    }
+
+
+def preview_totals(result):
+    return {key: result[key] for key in ("subtotal", "vat_total", "total", "vat_breakdown")}
+
+
+def random_cart(rng):
+    items = [
+        PreviewItem(
+            qty=rng.choice([1, 2, 3, 0.5, 1.25, 7, -1]),
+            unit_price=rng.choice([0, 0.01, 0.05, 0.1, 0.15, 1.005, 2.675, 9.99, 12.345, 1234.5678]),
+            discount_type=rng.choice([None, "percent", "fixed"]),
+            discount_value=rng.choice([0, 2.5, 10, 0.005, 33.333]),
+            vat_rate=rng.choice([0, 6, 6.0, 12, 21, 5.5]),
+        )
+        for _ in range(rng.randint(0, 6))
+    ]
+    return PreviewCart(
+        items=items,
+        global_discount_type=rng.choice([None, "percent", "fixed"]),
+        global_discount_value=rng.choice([0, 0.005, 0.01, 1, 5.55, 12.5]),
+    )
+
+
+@pytest.mark.parametrize("cart", [
+    PreviewCart(items=[]),
+    PreviewCart(items=[], global_discount_type="fixed", global_discount_value=5),
+    # Zero base with a fixed discount: nothing to allocate it over
+    PreviewCart(items=[PreviewItem(qty=1, unit_price=0, vat_rate=21), PreviewItem(qty=2, unit_price=0, vat_rate=6)],
+                global_discount_type="fixed", global_discount_value=3),
+    # Exact half cents: 0.005 ties must round up like the Decimal engine
+    PreviewCart(items=[PreviewItem(qty=1, unit_price=1.005, vat_rate=21), PreviewItem(qty=3, unit_price=0.335, vat_rate=6)],
+                global_discount_type="percent", global_discount_value=0.5),
+    PreviewCart(items=[PreviewItem(qty=1, unit_price=0.05, vat_rate=10)], global_discount_type="fixed", global_discount_value=0.005),
+    PreviewCart(items=[PreviewItem(qty=1, unit_price=1.15, discount_type="percent", discount_value=50, vat_rate=21)]),
+    # Too many decimals or too large for int64 fixed point: computed by the Decimal fallback
+    PreviewCart(items=[PreviewItem(qty=3, unit_price=0.1 + 0.2, vat_rate=21), PreviewItem(qty=1, unit_price=2.675, vat_rate=6)],
+                global_discount_type="percent", global_discount_value=12.5),
+    PreviewCart(items=[PreviewItem(qty=1e9, unit_price=123456789.123, discount_type="percent", discount_value=33.333, vat_rate=21)]),
+])
+def test_preview_matches_engine_on_edge_cases(cart):
+    [result] = preview_cart_totals([cart])
+    assert preview_totals(result) == engine_totals(cart)
+
+
+def test_preview_matches_engine_on_random_carts():
+    rng = random.Random(20240611)
+    for _ in range(50):
+        carts = [random_cart(rng) for _ in range(rng.randint(1, 8))]
+        results = preview_cart_totals(carts)
+        assert [preview_totals(r) for r in results] == [engine_totals(c) for c in carts]
+
+
+def test_preview_uses_int64_arrays(monkeypatch):
+    monkeypatch.setattr(server, "_preview_cart_exact", None)  # The fast path must not fall back
+    rng = random.Random(7)
+    carts = [random_cart(rng) for _ in range(20)]
+    assert [preview_totals(r) for r in preview_cart_totals(carts)] == [engine_totals(c) for c in carts]
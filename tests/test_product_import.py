@@ -0,0 +1,103 @@
+import io
+
+import pytest
+from fastapi import UploadFile
+from openpyxl import load_workbook
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+HEADER = "sku,name_fr,name_nl,category_id,unit,price_retail\n"
+
+
+def upload(text, filename="products.csv"):
+    return UploadFile(io.BytesIO(text.encode("utf-8")), filename=filename)
+
+
+@pytest.fixture
+def index(search_index):
+    return search_index
+
+
+async def test_reimporting_the_same_rows_leaves_products_untouched(db, audits):
+    rows = HEADER + "A-1,Chaise,Stoel,cat,piece,10\nA-2,Table,Tafel,cat,piece,50\n"
+    first = await server.import_products(upload(rows))
+    assert (first["created"], first["updated"], first["unchanged"]) == (2, 0, 0)
+    before = {p["sku"]: p for p in await db.products.find({}, {"_id": 0}).to_list(None)}
+
+    again = await server.import_products(upload(rows))
+
+    assert (again["created"], again["updated"], again["unchanged"]) == (0, 0, 2)
+    after = {p["sku"]: p for p in await db.products.find({}, {"_id": 0}).to_list(None)}
+    assert after == before
+
+
+async def test_changed_row_moves_updated_at_and_keeps_other_fields(db, audits):
+    await server.import_products(upload(HEADER + "A-1,Chaise,Stoel,cat,piece,10\n"))
+    await db.products.update_one({"sku": "A-1"}, {"$set": {"updated_at": "2000-01-01T00:00:00+00:00", "stock_qty": 4}})
+
+    result = await server.import_products(upload(HEADER + "A-1,Chaise,Stoel,cat,piece,12.5\n"))
+
+    product = await db.products.find_one({"sku": "A-1"})
+    assert (result["updated"], result["unchanged"]) == (1, 0)
+    assert product["price_retail"] == 12.5 and product["name_fr"] == "Chaise" and product["stock_qty"] == 4
+    assert product["updated_at"] > "2000-01-01T00:00:00+00:00"
+
+
+async def test_unreadable_chunk_returns_partial_summary_and_audits(db, index, audits, monkeypatch):
+    def chunks(file, file_format):
+        yield [{"sku": "A-1", "name_fr": "Chaise", "name_nl": "Stoel", "category_id": "cat", "unit": "piece", "price_retail": "10"}]
+        raise ValueError("bad byte at line 1002")
+
+    monkeypatch.setattr(server, "_read_product_chunks", chunks)
+
+    result = await server.import_products(upload(HEADER))
+
+    assert (result["rows"], result["created"]) == (1, 1)
+    assert "bad byte at line 1002" in result["file_error"]
+    assert await db.products.count_documents({"sku": "A-1"}) == 1
+    assert index.get_by_code("A-1")["name_fr"] == "Chaise" and len(audits) == 1
+    assert audits[0][1]["metadata"]["file_error"] == result["file_error"]
+
+
+async def test_unreadable_file_is_a_400(db, audits):
+    with pytest.raises(server.HTTPException) as e:
+        await server.import_products(upload("garbage", filename="products.xlsx"))
+    assert e.value.status_code == 400 and not audits
+
+
+async def test_import_applies_category_deltas_and_index_upserts(db, index, audits, monkeypatch):
+    await db.categories.insert_many([
+        {"id": "cat", "product_count": 1, "in_stock_count": 1}, {"id": "new", "product_count": 0, "in_stock_count": 0},
+    ])
+    await db.products.insert_one({"id": "p0", "sku": "A-0", "name_fr": "Banc", "name_nl": "Bank", "category_id": "cat", "unit": "piece", "price_retail": 5, "stock_qty": 3})
+    index.upsert(await db.products.find_one({"sku": "A-0"}))
+    server.product_scan_cache.put("A-0", {"id": "p0", "category_id": "cat"})
+    recounts = []
+    monkeypatch.setattr(server, "recount_category_counts", lambda: recounts.append(1))
+    monkeypatch.setattr(index, "load", lambda: recounts.append(1))
+
+    result = await server.import_products(upload(
+        "sku,name_fr,name_nl,category_id,unit,price_retail,stock_qty\n"
+        "A-0,Banc,Bank,new,piece,5,99\n"  # Moved; stock is insert-only
+        "A-1,Chaise,Stoel,cat,piece,10,2\n"
+        "A-2,Table,Tafel,cat,piece,50,0\n"
+    ))
+
+    assert (result["created"], result["updated"]) == (2, 1) and not recounts
+    counts = {c["id"]: (c["product_count"], c["in_stock_count"]) for c in await db.categories.find().to_list(None)}
+    assert counts == {"cat": (2, 1), "new": (1, 1)}
+    assert index.get_by_code("A-0")["category_id"] == "new" and index.get_by_code("A-2")["price_retail"] == 50
+    assert server.product_scan_cache.get("A-0") is None
+
+
+async def test_xlsx_export_is_streamed_from_a_file(db, audits):
+    await server.import_products(upload(HEADER + "A-1,Chaise,Stoel,cat,piece,10\nA-2,Table,Tafel,cat,piece,50\n"))
+
+    response = await server.export_products(format="xlsx", category_id=None)
+    data = b"".join([chunk async for chunk in response.body_iterator])
+
+    rows = list(load_workbook(io.BytesIO(data), read_only=True)["products"].values)
+    assert rows[0] == tuple(server.PRODUCT_FILE_FIELDS)
+    assert [(row[1], row[rows[0].index("price_retail")]) for row in rows[1:]] == [("A-1", 10), ("A-2", 50)]
@@ -0,0 +1,77 @@
+import orjson
+import pytest
+from bson import ObjectId
+
+import server
+from server import ProductSearchIndex
+
+pytestmark = pytest.mark.anyio
+
+
+def product(product_id, name_fr, category_id="cat", **fields):
+    return {"id": product_id, "sku": product_id.upper(), "name_fr": name_fr, "name_nl": name_fr, "category_id": category_id, **fields}
+
+
+@pytest.fixture
+def index(search_index):
+    return search_index
+
+
+def test_terms_match_inside_words_without_accents(index):
+    index.upsert(product("p1", "Vis à béton 6x60", barcode="5410000000017"))
+    index.upsert(product("p2", "Cheville béton"))
+    index.upsert(product("p3", "Vis bois"))
+
+    assert {p["id"] for p in index.search("BETON")} == {"p1", "p2"}
+    assert [p["id"] for p in index.search("vis eto")] == ["p1"]
+    assert [p["id"] for p in index.search("5410000000017")] == ["p1"]
+    # Exact SKU first, then names with a word starting with the term, by name
+    index.upsert(product("vis", "Boulon"))
+    assert [p["id"] for p in index.search("vis")][0] == "vis"
+    index.remove("vis")
+    assert [p["id"] for p in index.search("vis")] == ["p1", "p3"]
+    assert [p["id"] for p in index.search("ville")] == ["p2"]
+
+
+async def test_filters_apply_before_the_limit(db, index):
+    # 500 matches in "a" sort before the 5 in "b": filtering after the cap found none of them
+    for n in range(500):
+        index.upsert(product(f"a{n:03d}", f"Aaa vis {n:03d}", "a"))
+    for n in range(5):
+        index.upsert(product(f"b{n}", f"Zzz vis {n}", "b"))
+
+    response = await server.get_products(None, search="vis", category_id="b", barcode=None, low_stock=None)
+
+    assert [p["id"] for p in orjson.loads(response.body)] == [f"b{n}" for n in range(5)]
+    assert len(index.search("vis", limit=3, where=lambda p: p["category_id"] == "b")) == 3
+
+
+def test_remove_drops_every_entry(index):
+    oid = ObjectId()
+    index.upsert({"_id": oid, **product("p1", "Marteau", barcode="123")})
+    # A write path upserts without _id: the known one is kept
+    index.upsert(product("p1", "Marteau arrache-clou", barcode="123"))
+    assert index._oids == {oid: "p1"}
+
+    index.remove("p1")
+
+    assert len(index) == 0 and index.search("marteau") == []
+    assert index.get_by_code("123") is None and index.get_by_code("P1") is None
+    assert not index._postings and not index._oids and not index._oid_of
+
+
+async def test_change_stream_applies_other_workers_writes(index, change_stream):
+    oid = ObjectId()
+    index.upsert({"_id": oid, **product("p1", "Marteau")})
+    changes = [
+        {"operationType": "insert", "fullDocument": {"_id": ObjectId(), **product("p2", "Tournevis")}},
+        {"operationType": "update", "fullDocument": {"_id": oid, **product("p1", "Masse", stock_qty=4)}},
+        {"operationType": "delete", "documentKey": {"_id": oid}},
+    ]
+    change_stream(changes)
+
+    await index._watch()
+
+    assert [p["id"] for p in index.search("tournevis")] == ["p2"]
+    assert index.search("masse") == [] and index.search("marteau") == []
+    assert set(index._oids.values()) == {"p2"}
@@ -0,0 +1,56 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import DocumentCreate, DocumentItemCreate, DocumentType, PaymentCreate, PaymentMethod
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def customer(db):
+    await db.products.insert_one({"id": "p1", "sku": "S1", "stock_qty": 100})
+    await db.customers.insert_one({"id": "c1", "name": "Client", "type": "company", "credit_limit": 500.0, "balance": 0.0})
+    return db
+
+
+def invoice(unit_price, paid=0.0):
+    item = DocumentItemCreate(product_id="p1", sku="S1", name="Vis", qty=1, unit_price=unit_price, vat_rate=21)
+    payments = [PaymentCreate(method=PaymentMethod.CASH, amount=paid)] if paid else []
+    return DocumentCreate(doc_type=DocumentType.INVOICE, customer_id="c1", items=[item], payments=payments)
+
+
+async def balance(db):
+    return (await db.customers.find_one({"id": "c1"}))["balance"]
+
+
+async def test_credit_limit_refuses_only_the_unpaid_part(customer):
+    await customer.customers.update_one({"id": "c1"}, {"$set": {"balance": -400.0}})
+
+    with pytest.raises(HTTPException) as e:
+        await server.create_document(invoice(100))  # 121 more would make 521 owed
+    assert e.value.status_code == 400 and "521.00" in e.value.detail
+    assert await customer.documents.count_documents({}) == 0
+
+    # Paid at the till, or leaving no more than the limit unpaid: accepted
+    await server.create_document(invoice(100, paid=121))
+    await server.create_document(invoice(50, paid=0.5))
+    assert await balance(customer) == -460.0
+
+
+async def test_ledger_deltas_keep_the_balance_in_cents(customer):
+    sale = await server.create_document(invoice(100))
+    for amount in (0.1, 0.1, 0.1, 80.2):  # As float $inc deltas these leave -40.500000000000014
+        await server.add_payment(sale.id, PaymentCreate(method=PaymentMethod.CARD, amount=amount))
+
+    assert await balance(customer) == -40.5
+    [aging] = await server.receivables_aging("c1")
+    assert aging["open"] == pytest.approx(40.5) and aging["documents"] == 1
+
+    await server.add_payment(sale.id, PaymentCreate(method=PaymentMethod.CASH, amount=40.5))
+    assert await balance(customer) == 0
+    assert await customer.ar_ledger.count_documents({"settled": False}) == 0
+    assert await server.receivables_aging("c1") == []
+
+    await server.rebuild_ar_ledger()
+    assert await balance(customer) == 0 and await customer.ar_ledger.count_documents({}) == 6
@@ -0,0 +1,69 @@
+import pytest
+
+import server
+from server import apply_sales_rollups, rebuild_sales_rollups, report_date_query
+
+pytestmark = pytest.mark.anyio
+
+
+def sale(number, created_at, customer_id=None, total=12.1, doc_type="receipt"):
+    return {
+        "id": number, "doc_type": doc_type, "status": "paid", "created_at": created_at, "register_number": 1,
+        "customer_id": customer_id, "total": total,
+        "items": [{"product_id": "p1", "name": "Vis", "qty": 1, "unit_price": 10, "line_subtotal": 10, "vat_rate": 21.0}],
+        "vat_breakdown": [{"rate": 21.0, "base": 10, "vat": 2.1, "total": 12.1}],
+        "payments": [{"method": "cash", "amount": total}],
+    }
+
+
+async def write(db, before, after):
+    if after is None:
+        await db.documents.delete_one({"id": before["id"]})
+    else:
+        await db.documents.replace_one({"id": after["id"]}, after, upsert=True)
+    await apply_sales_rollups((before, after))
+
+
+async def dashboards(date_from, date_to):
+    from_documents = await server.get_reports_dashboard(date_from, date_to, source="documents")
+    from_rollups = await server.get_reports_dashboard(date_from, date_to, source="rollups")
+    return from_documents, from_rollups
+
+
+def test_period_end_is_exclusive_next_day():
+    assert report_date_query("2024-05-01", "2024-05-31") == {"created_at": {"$gte": "2024-05-01", "$lt": "2024-06-01"}}
+    with pytest.raises(server.HTTPException):
+        report_date_query(None, "2024-02-30")
+
+
+async def test_last_second_of_the_period_is_reported(db):
+    await write(db, None, sale("late", "2024-05-31T23:59:59.600000+00:00", "c1"))
+    await write(db, None, sale("next", "2024-06-01T00:00:00+00:00", "c2"))
+
+    from_documents, from_rollups = await dashboards("2024-05-01", "2024-05-31")
+
+    assert from_documents["summary"]["transactions_count"] == 1
+    assert from_documents["summary"] == from_rollups["summary"]
+
+    await rebuild_sales_rollups("2024-05-01", "2024-05-31")
+    assert (await dashboards("2024-05-01", "2024-05-31"))[1]["summary"]["transactions_count"] == 1
+
+
+async def test_customers_are_counted_outside_the_rows(db):
+    await write(db, None, sale("s1", "2024-05-02T10:00:00+00:00", "c1"))
+    await write(db, None, sale("s2", "2024-05-02T11:00:00+00:00", "c1"))
+    await write(db, None, sale("s3", "2024-05-03T11:00:00+00:00", "c2"))
+
+    rows = await db.sales_daily.find({}, {"_id": 0}).to_list(None)
+    assert rows and not any("customers" in row for row in rows)
+    from_documents, from_rollups = await dashboards("2024-05-01", "2024-05-31")
+    assert from_rollups["summary"]["active_customers"] == from_documents["summary"]["active_customers"] == 2
+
+    # c2's only sale goes away: they are no longer active
+    await write(db, sale("s3", "2024-05-03T11:00:00+00:00", "c2"), None)
+    from_documents, from_rollups = await dashboards("2024-05-01", "2024-05-31")
+    assert from_rollups["summary"]["active_customers"] == from_documents["summary"]["active_customers"] == 1
+
+    await rebuild_sales_rollups()
+    entries = await db.sales_daily_customers.find({}, {"_id": 0}).to_list(None)
+    assert entries == [{"date": "2024-05-02", "doc_type": "receipt", "customer_id": "c1", "count": 2}]
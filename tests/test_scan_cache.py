@@ -0,0 +1,68 @@
+import pytest
+from bson import ObjectId
+
+import server
+from server import ProductScanCache, ProductSearchIndex
+
+pytestmark = pytest.mark.anyio
+
+
+class Clock:
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    return clock
+
+
+def test_least_recently_used_code_is_evicted(clock):
+    cache = ProductScanCache(2, ttl=30)
+    cache.put("111", {"id": "p1"})
+    cache.put("222", {"id": "p2"})
+    cache.get("111")
+    cache.put("333", {"id": "p3"})
+
+    assert cache.get("222") is None and cache.get("111") == {"id": "p1"}
+    assert cache.stats()["evictions"] == 1 and cache._codes.keys() == {"p1", "p3"}
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ProductScanCache(10, ttl=30)
+    cache.put("111", {"id": "p1", "price_retail": 10})
+    clock.now += 29
+    assert cache.get("111")["price_retail"] == 10
+    clock.now += 2
+
+    assert cache.get("111") is None
+    assert cache.stats()["expirations"] == 1 and not cache._codes
+
+
+async def test_change_stream_invalidates_other_workers_products(db, change_stream, monkeypatch):
+    cache = ProductScanCache(10)
+    index = ProductSearchIndex()
+    monkeypatch.setattr(server, "product_scan_cache", cache)
+    oid = ObjectId()
+    index.upsert({"_id": oid, "id": "p1", "sku": "S1", "barcode": "111"})
+    cache.put("111", {"id": "p1", "price_retail": 10})
+    cache.put("S2", {"id": "p2", "price_retail": 5})
+    # Another worker reprices p1 and replaces p2
+    change_stream([
+        {"operationType": "update", "fullDocument": {"_id": oid, "id": "p1", "sku": "S1", "barcode": "111", "price_retail": 12}},
+        {"operationType": "replace", "fullDocument": {"_id": ObjectId(), "id": "p2", "sku": "S2", "price_retail": 6}},
+    ])
+
+    await index._watch()
+
+    assert cache.get("111") is None and cache.get("S2") is None
+    assert cache.stats()["invalidations"] == 2
+
+    cache.put("111", {"id": "p1", "price_retail": 12})
+    change_stream([{"operationType": "delete", "documentKey": {"_id": oid}}])
+    await index._watch()
+    assert cache.get("111") is None
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import DocumentCreate, DocumentItemCreate, DocumentType, StockMovementType, record_stock_movements
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def catalog(db):
+    await db.categories.insert_many([{"id": "cat", "product_count": 2, "in_stock_count": 1}])
+    await db.products.insert_many([
+        {"id": "p1", "sku": "S1", "category_id": "cat", "stock_qty": 10},
+        {"id": "p2", "sku": "S2", "category_id": "cat", "stock_qty": 0},
+        {"id": "p3", "sku": "S3", "category_id": "cat", "stock_qty": 1, "prevent_negative_stock": True},
+    ])
+    return db
+
+
+def line(product_id, qty):
+    return DocumentItemCreate(product_id=product_id, sku=product_id.upper(), name=product_id, qty=qty, unit_price=1)
+
+
+async def stock(db, product_id):
+    return (await db.products.find_one({"id": product_id}))["stock_qty"]
+
+
+async def test_concurrent_sales_record_consistent_before_after(catalog):
+    sales = [[line("p1", 1), line("p1", 2)] for _ in range(3)]
+    await asyncio.gather(*(record_stock_movements(items, StockMovementType.SALE, "document", f"d{i}") for i, items in enumerate(sales)))
+
+    movements = await catalog.stock_movements.find({"product_id": "p1"}).to_list(None)
+    assert await stock(catalog, "p1") == 1
+    assert all(m["stock_before"] - m["stock_after"] == m["qty"] for m in movements)
+    # The six movements form one unbroken chain from 10 down to 1
+    chain = sorted(movements, key=lambda m: -m["stock_before"])
+    assert chain[0]["stock_before"] == 10 and chain[-1]["stock_after"] == 1
+    assert all(a["stock_after"] == b["stock_before"] for a, b in zip(chain, chain[1:]))
+
+
+async def test_category_in_stock_count_follows_zero_crossings(catalog):
+    await record_stock_movements([line("p2", 3)], StockMovementType.RETURN)
+    assert (await catalog.categories.find_one({"id": "cat"}))["in_stock_count"] == 2
+    await record_stock_movements([line("p1", 10), line("p2", 3)], StockMovementType.SALE)
+    assert (await catalog.categories.find_one({"id": "cat"}))["in_stock_count"] == 0
+
+
+async def test_refused_guard_reverts_other_products(catalog):
+    with pytest.raises(HTTPException) as error:
+        await record_stock_movements([line("p1", 2), line("p3", 5)], StockMovementType.SALE)
+    assert error.value.status_code == 400
+    assert await stock(catalog, "p1") == 10
+    assert await stock(catalog, "p3") == 1
+    assert await catalog.stock_movements.count_documents({}) == 0
+
+
+async def test_failed_document_insert_undoes_stock(catalog, monkeypatch):
+    collection_type = type(catalog.documents)
+    insert_one = collection_type.insert_one
+
+    async def broken_insert(self, document, *args, **kwargs):
+        if self.name == "documents":
+            raise RuntimeError("insert failed")
+        return await insert_one(self, document, *args, **kwargs)
+
+    monkeypatch.setattr(collection_type, "insert_one", broken_insert)
+    with pytest.raises(RuntimeError):
+        await server.create_document(DocumentCreate(doc_type=DocumentType.RECEIPT, items=[line("p1", 4)]))
+    assert await stock(catalog, "p1") == 10
+    assert await catalog.stock_movements.count_documents({}) == 0
+    assert (await catalog.categories.find_one({"id": "cat"}))["in_stock_count"] == 1
+
+
+async def test_one_read_and_one_bulk_write_per_sale(catalog, monkeypatch):
+    calls = []
+    collection_type = type(catalog.products)
+    for name in ("find", "find_one_and_update", "bulk_write"):
+        method = getattr(collection_type, name)
+        monkeypatch.setattr(collection_type, name, lambda self, *a, _m=method, _n=name, **k: calls.append((self.name, _n)) or _m(self, *a, **k))
+
+    await record_stock_movements([line("p1", 1), line("p2", 2), line("p1", 3)], StockMovementType.SALE)
+
+    assert [call for call in calls if call[0] == "products"] == [("products", "find"), ("products", "bulk_write")]
+    assert await stock(catalog, "p1") == 6 and await stock(catalog, "p2") == -2
+
+
+async def test_product_changed_after_the_read_is_retried(catalog, monkeypatch):
+    collection_type = type(catalog.products)
+    bulk_write = collection_type.bulk_write
+    writes = []
+
+    async def racing_bulk_write(self, requests, *args, **kwargs):
+        writes.append(len(requests))
+        if len(writes) == 1:
+            # Another sale takes 5 of p2 between this sale's read and its write
+            await self.update_one({"id": "p2"}, {"$inc": {"stock_qty": -5}})
+        return await bulk_write(self, requests, *args, **kwargs)
+
+    monkeypatch.setattr(collection_type, "bulk_write", racing_bulk_write)
+    await record_stock_movements([line("p1", 1), line("p2", 1)], StockMovementType.SALE, "document", "d1")
+
+    assert writes == [2, 1]  # p1 went through, p2 was read and written again
+    assert await stock(catalog, "p1") == 9 and await stock(catalog, "p2") == -6
+    p2 = await catalog.stock_movements.find_one({"product_id": "p2"})
+    assert (p2["stock_before"], p2["stock_after"]) == (-5, -6)
+    assert await catalog.products.count_documents({}) == 3
+
+
+async def test_single_movement_guard_allows_zero_and_refuses_below(catalog):
+    with pytest.raises(HTTPException) as error:
+        await server.record_stock_movement("p3", "S3", StockMovementType.SALE, 2)
+    assert error.value.status_code == 400 and "S3" in error.value.detail
+    assert await stock(catalog, "p3") == 1 and await catalog.stock_movements.count_documents({}) == 0
+
+    movement = await server.record_stock_movement("p3", "S3", StockMovementType.SALE, 1)
+    assert (movement.stock_before, movement.stock_after) == (1, 0)
+    # Unguarded products may go negative
+    movement = await server.record_stock_movement("p2", "S2", StockMovementType.SALE, 2)
+    assert (movement.stock_before, movement.stock_after) == (0, -2) and await stock(catalog, "p2") == -2
+
+
+async def test_concurrent_single_movements_chain(catalog):
+    await asyncio.gather(*(server.record_stock_movement("p1", "S1", StockMovementType.SALE, 1, "document", f"d{i}") for i in range(10)))
+
+    movements = await catalog.stock_movements.find({"product_id": "p1"}).to_list(None)
+    assert await stock(catalog, "p1") == 0
+    assert sorted((m["stock_before"], m["stock_after"]) for m in movements) == [(n + 1, n) for n in range(10)]
+
+
+async def test_unknown_product_records_nothing(catalog):
+    assert await server.record_stock_movement("nope", "X", StockMovementType.SALE, 1) is None
+    assert await catalog.stock_movements.count_documents({}) == 0
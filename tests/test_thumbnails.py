@@ -0,0 +1,143 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def png(width, height):
+    out = BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(out, "PNG")
+    return out.getvalue()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves /image.png, and /hop redirecting to the Location given in the query"""
+
+    image = png(800, 600)
+    hits = []
+    hosts = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        self.hosts.append(self.headers["Host"])
+        if self.path.startswith("/hop?to="):
+            self.send_response(302)
+            self.send_header("Location", self.path.split("=", 1)[1])
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.image)))
+        self.end_headers()
+        self.wfile.write(self.image)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    ImageHandler.hits = []
+    ImageHandler.hosts = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def thumbnails(db, tmp_path, monkeypatch):
+    cache = server.ThumbnailCache(tmp_path, 50 * 1024 * 1024)
+    monkeypatch.setattr(server, "thumbnail_cache", cache)
+    monkeypatch.setattr(server, "THUMBNAIL_ALLOWED_HOSTS", {"localhost"})
+    return db
+
+
+async def thumbnail(db, url, **kwargs):
+    await db.products.replace_one({"id": "p1"}, {"id": "p1", "image_url": url}, upsert=True)
+    return await server.get_product_thumbnail("p1", size=kwargs.get("size", 128), if_none_match=kwargs.get("etag"))
+
+
+async def test_thumbnail_is_resized_and_revalidated_without_fetching(thumbnails, image_server):
+    url = f"http://localhost:{image_server}/image.png"
+    response = await thumbnail(thumbnails, url)
+    assert response.status_code == 200
+    assert Image.open(BytesIO(response.body)).size == (128, 96)
+    assert ImageHandler.hits == ["/image.png"]
+
+    etag = response.headers["etag"]
+    revalidated = await thumbnail(thumbnails, url, etag=etag)
+    assert revalidated.status_code == 304 and revalidated.headers["etag"] == etag
+    assert ImageHandler.hits == ["/image.png"]
+
+
+async def test_private_addresses_are_refused(thumbnails, image_server):
+    # 127.0.0.1 is not on the allow list, even when reached through an allowed host
+    for url in (f"http://127.0.0.1:{image_server}/image.png",
+                f"http://localhost:{image_server}/hop?to=http://127.0.0.1:{image_server}/image.png"):
+        with pytest.raises(server.HTTPException) as e:
+            await thumbnail(thumbnails, url)
+        assert e.value.status_code == 502
+    assert ImageHandler.hits == ["/hop?to=http://127.0.0.1:%d/image.png" % image_server]
+
+
+async def test_oversized_source_is_refused_before_reading(thumbnails, image_server, monkeypatch):
+    monkeypatch.setattr(server, "THUMBNAIL_MAX_SOURCE_BYTES", 1000)
+    with pytest.raises(server.HTTPException) as e:
+        await thumbnail(thumbnails, f"http://localhost:{image_server}/image.png")
+    assert e.value.status_code == 502
+
+
+async def test_download_connects_to_the_checked_address(thumbnails, image_server, monkeypatch):
+    # A rebinding DNS server answers the check with one address and the fetch with another
+    resolve = server.socket.getaddrinfo
+    answers = []
+
+    def rebinding(host, *args, **kwargs):
+        if host != "localhost":
+            return resolve(host, *args, **kwargs)
+        answers.append(host)
+        return resolve("127.0.0.1" if len(answers) == 1 else "192.0.2.1", *args, **kwargs)
+
+    monkeypatch.setattr(server.socket, "getaddrinfo", rebinding)
+
+    response = await thumbnail(thumbnails, f"http://localhost:{image_server}/image.png")
+
+    assert response.status_code == 200 and answers == ["localhost"]
+    assert ImageHandler.hosts == [f"localhost:{image_server}"]
+
+
+async def test_least_recently_used_files_are_evicted_without_rescanning(tmp_path, monkeypatch):
+    cache = server.ThumbnailCache(tmp_path, 1000)
+    scans = []
+    scan = cache._scan
+    monkeypatch.setattr(cache, "_scan", lambda: scans.append(1) or scan())
+    paths = [cache._path("thumbs", f"{n:02d}") for n in range(4)]
+    for path in paths[:3]:
+        await cache._store(path, b"x" * 300)
+    assert await cache._load(paths[0]) == b"x" * 300  # Now the most recently used
+
+    await cache._store(paths[3], b"x" * 300)
+
+    assert [path.exists() for path in paths] == [True, False, True, True]
+    assert cache._size == 900 and list(cache._files) == [paths[2], paths[0], paths[3]]
+    assert len(scans) == 1
+
+
+async def test_locks_are_dropped_when_released(thumbnails, image_server):
+    await thumbnail(thumbnails, f"http://localhost:{image_server}/image.png")
+    assert server.thumbnail_cache._locks == {}
+
+
+@pytest.mark.parametrize("url", ["file:///etc/passwd", "ftp://example.com/a.png", "http:///a.png"])
+def test_only_http_urls_with_a_host(url):
+    with pytest.raises(ValueError):
+        server.check_image_url(url)
@@ -0,0 +1,77 @@
+import pytest
+
+import server
+from server import BELGIAN_VAT_GRIDS, document_vat_breakdown, vat_line_rows, vat_report_from_groups
+
+pytestmark = pytest.mark.anyio
+
+
+def group(rate, doc_type, base, vat):
+    return {"rate": rate, "doc_type": doc_type, "base": base, "vat": vat, "total": round(base + vat, 2)}
+
+
+def test_credit_notes_net_against_sales():
+    groups = [group(21, "invoice", 100, 21), group(21, "receipt", 50, 10.5), group(21.0, "credit_note", -40, -8.4)]
+
+    report = vat_report_from_groups(groups, {"invoice": 2, "receipt": 1, "credit_note": 1}, "2024-05-01", "2024-05-31")
+
+    assert report["breakdown"] == [{
+        "rate": 21, "base": 110, "vat": 23.1, "total": 133.1,
+        "sales": {"base": 150, "vat": 31.5}, "credit_notes": {"base": -40, "vat": -8.4}
+    }]
+    assert report["totals"] == {"base": 110, "vat": 23.1, "total": 133.1}
+    assert report["by_doc_type"]["credit_note"] == {"documents": 1, "base": -40, "vat": -8.4, "total": -48.4}
+    assert report["documents_count"] == 4
+    assert report["period"] == {"from": "2024-05-01", "to": "2024-05-31"}
+
+
+def test_integer_and_float_rates_are_one_line():
+    report = vat_report_from_groups([group(6, "invoice", 10, 0.6), group(6.0, "receipt", 5, 0.3)], {}, None, None)
+
+    assert [(line["rate"], line["base"], line["vat"]) for line in report["breakdown"]] == [(6, 15, 0.9)]
+    assert type(report["breakdown"][0]["rate"]) is int
+    assert report["grids"]["01"] == 15
+
+
+def test_unmapped_rates_are_reported_and_kept_out_of_the_grids():
+    report = vat_report_from_groups([group(5.5, "invoice", 100, 5.5), group(21, "invoice", 10, 2.1)], {}, None, None)
+
+    assert report["unmapped_rates"] == [5.5]
+    assert [line["rate"] for line in report["breakdown"]] == [5.5, 21]
+    assert report["grids"]["54"] == 2.1 and report["totals"]["vat"] == 7.6
+
+
+def test_return_grids():
+    groups = [
+        group(0, "invoice", 20, 0), group(6, "invoice", 10, 0.6), group(12, "receipt", 10, 1.2),
+        group(21, "invoice", 100, 21), group(6, "credit_note", -10, -0.6), group(21, "credit_note", -0.1, -0.02),
+    ]
+
+    grids = vat_report_from_groups(groups, {}, None, None)["grids"]
+
+    assert list(grids) == BELGIAN_VAT_GRIDS
+    assert grids == {"00": 20, "01": 10, "02": 10, "03": 100, "54": 22.8, "49": 10.1, "64": 0.62}
+
+
+async def test_documents_without_breakdown_give_one_line_per_rate(db):
+    legacy = {
+        "id": "old", "number": "FA-1", "doc_type": "invoice", "status": "paid", "created_at": "2024-05-02T10:00:00+00:00",
+        "items": [
+            {"vat_rate": 6, "line_subtotal": 10, "line_vat": 0.6, "line_total": 10.6},
+            {"vat_rate": 6.0, "line_subtotal": 5, "line_vat": 0.3, "line_total": 5.3},
+            {"line_subtotal": 2, "line_vat": 0.42, "line_total": 2.42},
+            {"vat_rate": 21, "line_subtotal": 1, "line_vat": 0.21, "line_total": 1.21},
+        ],
+    }
+    await db.documents.insert_one(dict(legacy))
+
+    rows = [row async for row in vat_line_rows(db.documents, "2024-05-01", "2024-05-31")]
+
+    lines = sorted((row["rate"], row["base"], row["vat"], row["total"]) for row in rows)
+    expected = sorted((line["rate"], line["base"], line["vat"], line["total"]) for line in document_vat_breakdown(legacy))
+    assert lines == pytest.approx(expected)
+    assert [rate for rate, *_ in lines] == [6, 21]
+
+    report = await server.get_vat_report("2024-05-01", "2024-05-31", source="documents")
+    assert [(line["rate"], line["base"]) for line in report["breakdown"]] == [(6, 15), (21, 3)]
+    assert report["grids"]["01"] == 15 and report["grids"]["03"] == 3